@@ -0,0 +1,44 @@
+import argparse
+import asyncio
+
+from .codec import codec_types
+from .storage import convert_codec, migrate, storage_types
+
+
+def main(argv: list[str] = None) -> None:
+    """Command line tools of AshenDB.
+
+    Example:
+        .. code-block:: console
+
+            $ ashendb migrate .ashendb/cluster/db/users segment
+            $ ashendb convert .ashendb/cluster/db/users msgpack
+    """
+    parser = argparse.ArgumentParser(prog="ashendb")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser(
+        "migrate", help="Move the documents of a collection to another storage."
+    )
+    migrate_parser.add_argument(
+        "path", help="The path of the collection, e.g. .ashendb/cluster/db/users"
+    )
+    migrate_parser.add_argument("storage", choices=list(storage_types))
+
+    convert_parser = commands.add_parser(
+        "convert", help="Rewrite the documents of a collection with another codec."
+    )
+    convert_parser.add_argument(
+        "path", help="The path of the collection, e.g. .ashendb/cluster/db/users"
+    )
+    convert_parser.add_argument("codec", choices=list(codec_types))
+
+    args = parser.parse_args(argv)
+    if args.command == "migrate":
+        asyncio.run(migrate(args.path, args.storage))
+    elif args.command == "convert":
+        asyncio.run(convert_codec(args.path, args.codec))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+from contextlib import aclosing
+from heapq import nsmallest
+from operator import itemgetter
+from typing import Any, Callable, Generator
+
+from .exception import InvalidOperator
+from .helper import (
+    _path_steps,
+    compile_path,
+    compile_projection,
+    compile_query,
+    compile_sort,
+    sort_key,
+)
+from .index import value_key
+
+# Stands for an accumulator which hasn't seen a value yet.
+_missing = object()
+
+
+def compile_expression(expression: Any) -> Callable[[dict], Any]:
+    """Compile an expression of a stage into a function of the document.
+
+    A string starting with ``$`` is the value of a key, None if it is missing. A dict is evaluated key by key, anything else is a constant.
+
+    Example:
+        >>> compile_expression({"year": "$date.year", "one": 1})({"date": {"year": 2023}})
+        {"year": 2023, "one": 1}
+    """
+    if isinstance(expression, str) and expression.startswith("$"):
+        getter = compile_path(expression[1:])
+
+        def value(document):
+            try:
+                return getter(document)
+            except (KeyError, IndexError, TypeError):
+                return None
+
+        return value
+    if isinstance(expression, dict):
+        parts = {key: compile_expression(value) for key, value in expression.items()}
+        return lambda document: {key: part(document) for key, part in parts.items()}
+    return lambda document: expression
+
+
+def _number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _add_to_set(state: dict, value: Any) -> dict:
+    state.setdefault(value_key(value), value)
+    return state
+
+
+# name: (initial state, step(state, value) -> state, result(state))
+accumulators = {
+    "$sum": (lambda: 0, lambda s, v: s + v if _number(v) else s, lambda s: s),
+    "$avg": (
+        lambda: [0, 0],
+        lambda s, v: [s[0] + v, s[1] + 1] if _number(v) else s,
+        lambda s: s[0] / s[1] if s[1] else None,
+    ),
+    "$min": (
+        lambda: None,
+        lambda s, v: v if v is not None and (s is None or sort_key(v) < sort_key(s)) else s,
+        lambda s: s,
+    ),
+    "$max": (
+        lambda: None,
+        lambda s, v: v if v is not None and (s is None or sort_key(v) > sort_key(s)) else s,
+        lambda s: s,
+    ),
+    "$first": (lambda: _missing, lambda s, v: v if s is _missing else s, lambda s: s),
+    "$last": (lambda: _missing, lambda s, v: v, lambda s: s),
+    "$push": (list, lambda s, v: s.append(v) or s, lambda s: s),
+    "$addToSet": (dict, _add_to_set, lambda s: list(s.values())),
+    "$count": (lambda: 0, lambda s, v: s + 1, lambda s: s),
+}
+
+
+async def match(docs: Generator, query: dict) -> Generator[dict, None, None]:
+    """``$match``: keep the documents matching a query."""
+    predicate = compile_query(query)
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            if predicate(doc):
+                yield doc
+
+
+async def project(docs: Generator, projection: dict) -> Generator[dict, None, None]:
+    """``$project``: include or exclude keys, see :func:`ashendb.helper.compile_projection`."""
+    trim = compile_projection(projection)
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            yield trim(doc)
+
+
+async def group(docs: Generator, spec: dict) -> Generator[dict, None, None]:
+    """``$group``: one document per distinct ``_id`` expression, with accumulated fields.
+
+    Groups are yielded in the order they were first seen.
+
+    Raises:
+        ValueError: If ``_id`` is missing.
+        InvalidOperator: If an accumulator is unknown.
+    """
+    if "_id" not in spec:
+        raise ValueError("$group needs an _id")
+    key = compile_expression(spec["_id"])
+    fields = []
+    for name, accumulator in spec.items():
+        if name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise ValueError(f"'{name}' must be a single accumulator")
+        [(operator, expression)] = accumulator.items()
+        if operator not in accumulators:
+            raise InvalidOperator(f"{operator} is not a valid accumulator")
+        fields.append((name, *accumulators[operator], compile_expression(expression)))
+
+    # value key of the _id -> (_id, states)
+    groups: dict[str, tuple[Any, list]] = {}
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            id = key(doc)
+            entry = groups.get(value_key(id))
+            if entry is None:
+                entry = groups[value_key(id)] = (id, [field[1]() for field in fields])
+            states = entry[1]
+            for i, (_, _, step, _, value) in enumerate(fields):
+                states[i] = step(states[i], value(doc))
+
+    for id, states in groups.values():
+        final = {"_id": id}
+        for (name, _, _, result, _), state in zip(fields, states):
+            state = result(state)
+            final[name] = None if state is _missing else state
+        yield final
+
+
+async def sort_docs(
+    docs: Generator, key: Callable[[dict], tuple], top: int | None = None
+) -> Generator[dict, None, None]:
+    """Sort documents by a key function.
+
+    With ``top`` only the best ``top`` documents are kept. The buffer is cut back whenever it doubles, so memory stays O(top).
+    """
+    best = []
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            best.append((key(doc), doc))
+            if top is not None and len(best) >= 2 * top:
+                best = nsmallest(top, best, key=itemgetter(0))
+    if top is None:
+        best.sort(key=itemgetter(0))
+    else:
+        best = nsmallest(top, best, key=itemgetter(0))
+    for _, doc in best:
+        yield doc
+
+
+async def sort(docs: Generator, spec: dict) -> Generator[dict, None, None]:
+    """``$sort``: order the documents, see :func:`ashendb.helper.compile_sort`."""
+    async with aclosing(sort_docs(docs, compile_sort(spec))) as docs:
+        async for doc in docs:
+            yield doc
+
+
+async def skip(docs: Generator, count: int) -> Generator[dict, None, None]:
+    """``$skip``: leave out the first documents."""
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            if count > 0:
+                count -= 1
+                continue
+            yield doc
+
+
+async def limit(docs: Generator, count: int) -> Generator[dict, None, None]:
+    """``$limit``: stop after a number of documents. The previous stages stop too."""
+    if count <= 0:
+        return
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            yield doc
+            count -= 1
+            if count == 0:
+                return
+
+
+def _replace(value: Any, steps: list[str | int], new: Any) -> Any:
+    # Copies the containers along the path, the document itself is left alone.
+    step, *rest = steps
+    copy = list(value) if isinstance(value, list) else dict(value)
+    copy[step] = new if not rest else _replace(value[step], rest, new)
+    return copy
+
+
+async def unwind(docs: Generator, spec: str | dict) -> Generator[dict, None, None]:
+    """``$unwind``: one document per item of an array.
+
+    The spec is either ``"$key"`` or a dict with ``path``, and optionally ``includeArrayIndex`` and ``preserveNullAndEmptyArrays``. A value which isn't an array counts as an array of itself.
+    """
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec["path"]
+    if not isinstance(path, str) or not path.startswith("$"):
+        raise ValueError("$unwind path must start with $")
+    steps = _path_steps(path[1:])
+    getter = compile_path(path[1:])
+    index_key = spec.get("includeArrayIndex")
+    preserve = spec.get("preserveNullAndEmptyArrays", False)
+
+    async with aclosing(docs) as docs:
+        async for doc in docs:
+            try:
+                value = getter(doc)
+            except (KeyError, IndexError, TypeError):
+                value = None
+            if not isinstance(value, list):
+                value = [] if value is None else [value]
+            if not value:
+                if preserve:
+                    yield dict(doc) if index_key is None else {**doc, index_key: None}
+                continue
+            for i, item in enumerate(value):
+                final = _replace(doc, steps, item)
+                if index_key is not None:
+                    final[index_key] = i
+                yield final
+
+
+stage_types = {
+    "$match": match,
+    "$project": project,
+    "$group": group,
+    "$sort": sort,
+    "$skip": skip,
+    "$limit": limit,
+    "$unwind": unwind,
+}
+
+
+def parse(pipeline: list[dict]) -> list[tuple[str, Any]]:
+    """Turn a pipeline into ``(stage, spec)`` pairs.
+
+    Raises:
+        TypeError: If the pipeline isn't a list of single key dicts.
+        InvalidOperator: If a stage is unknown.
+        ValueError: If a ``$skip`` or ``$limit`` isn't a positive int.
+    """
+    if not isinstance(pipeline, list):
+        raise TypeError("Pipeline must be a list")
+    stages = []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise TypeError("Every stage must be a dict with a single key")
+        [(name, spec)] = stage.items()
+        if name not in stage_types:
+            raise InvalidOperator(f"{name} is not a valid stage")
+        if name in ("$skip", "$limit") and (
+            not isinstance(spec, int) or spec < (0 if name == "$skip" else 1)
+        ):
+            raise ValueError(f"{name} must be a positive int")
+        stages.append((name, spec))
+    return stages
+
+
+def push_down(stages: list[tuple[str, Any]]) -> tuple[dict, list[tuple[str, Any]]]:
+    """Split off the leading stages a collection scan does itself.
+
+    Those are the ``$match`` stages, then a ``$sort``, then ``$skip`` and ``$limit``, then a ``$project``. Matches go through the indexes, a sort with a limit keeps only the top documents and a projection may be answered from the indexes alone.
+
+    Returns:
+        The ``query``, ``sort``, ``skip``, ``limit`` and ``projection`` arguments of the scan, and the remaining stages.
+    """
+    scan = {"query": {}, "sort": None, "skip": 0, "limit": None, "projection": None}
+    i = 0
+    while i < len(stages) and stages[i][0] == "$match":
+        query = stages[i][1]
+        # Top level operators other than $and can't be merged.
+        if any(op in scan["query"] and op != "$and" for op in query):
+            break
+        for op, queries in query.items():
+            scan["query"][op] = scan["query"].get(op, []) + list(queries)
+        i += 1
+    if i < len(stages) and stages[i][0] == "$sort":
+        scan["sort"] = stages[i][1]
+        i += 1
+    while i < len(stages) and stages[i][0] in ("$skip", "$limit"):
+        name, count = stages[i]
+        if name == "$skip":
+            # A skip after a limit can't be expressed by the scan.
+            if scan["limit"] is not None:
+                break
+            scan["skip"] += count
+        else:
+            scan["limit"] = count if scan["limit"] is None else min(scan["limit"], count)
+        i += 1
+    if i < len(stages) and stages[i][0] == "$project":
+        scan["projection"] = stages[i][1]
+        i += 1
+    scan["query"] = scan["query"] or None
+    return scan, stages[i:]
+
+
+def _top(stages: list[tuple[str, Any]]) -> int | None:
+    # How many documents a sort followed by these stages has to keep.
+    skipped = 0
+    for name, count in stages:
+        if name == "$skip":
+            skipped += count
+        elif name == "$limit":
+            return skipped + count
+        else:
+            return None
+    return None
+
+
+def run(docs: Generator, stages: list[tuple[str, Any]]) -> Generator[dict, None, None]:
+    """Chain the stages of a pipeline onto a stream of documents.
+
+    A ``$sort`` followed by ``$skip`` and ``$limit`` only keeps the top documents.
+    """
+    for i, (name, spec) in enumerate(stages):
+        if name == "$sort":
+            docs = sort_docs(docs, compile_sort(spec), _top(stages[i + 1 :]))
+        else:
+            docs = stage_types[name](docs, spec)
+    return docs
@@ -0,0 +1,251 @@
+import errno
+import os
+import shutil
+from uuid import uuid4
+
+import aiofiles
+import aiofiles.os as aios
+
+from . import metrics
+
+# Paths below this root are kept in memory.
+MEMORY_ROOT = ":memory:"
+
+
+class DiskBackend:
+    """Keeps clusters in the ``.ashendb`` directory. This is the default.
+
+    A backend holds the namespace of a cluster, its databases, collections and metadata files such as indexes. The documents themselves go through the storage of their collection, see :mod:`ashendb.storage`.
+    """
+
+    kind = "disk"
+
+    def __init__(self) -> None:
+        # Clusters whose directory was already created, keyed by the normalized path.
+        self.clusters: set[str] = set()
+
+    async def create_cluster(self, path: str) -> None:
+        """Create the directory of a cluster, and ``.ashendb`` above it, on first use.
+
+        Raises:
+            Exception: If a file named ``.ashendb`` already exists.
+        """
+        key = os.path.normpath(path)
+        if key in self.clusters:
+            return
+        root = os.path.dirname(key)
+        if await aios.path.exists(root) and not await aios.path.isdir(root):
+            raise Exception(f"A file named '{root}' already exists.")
+        await aios.makedirs(key, exist_ok=True)
+        self.clusters.add(key)
+
+    async def listdir(self, path: str) -> list[str]:
+        return await aios.listdir(path)
+
+    async def stamp(self, path: str) -> tuple:
+        """Changes whenever an entry is added to or removed from a directory, or a file is written."""
+        stat = await aios.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    async def exists(self, path: str) -> bool:
+        return await aios.path.exists(path)
+
+    async def isdir(self, path: str) -> bool:
+        return await aios.path.isdir(path)
+
+    async def mkdir(self, path: str) -> None:
+        await aios.mkdir(path)
+
+    async def makedirs(self, path: str) -> None:
+        await aios.makedirs(path, exist_ok=True)
+
+    async def removedirs(self, path: str) -> None:
+        """Remove an empty directory, then its parents as long as they are empty."""
+        await aios.removedirs(path)
+        # The directory of a cluster may have gone with it.
+        self.clusters.clear()
+
+    async def rmtree(self, path: str) -> None:
+        await aios.wrap(shutil.rmtree)(path)
+
+    async def read_file(self, path: str) -> bytes:
+        async with aiofiles.open(path, "rb") as f:
+            data = await f.read()
+        metrics.count_io(read=len(data))
+        return data
+
+    async def write_file(self, path: str, data: bytes) -> None:
+        """Replace a file atomically, through a temporary file.
+
+        Every write has a temporary file of its own, so concurrent writers of a file don't race on it, the last one to finish wins.
+        """
+        temp = f"{path}.{uuid4().hex}.tmp"
+        try:
+            async with aiofiles.open(temp, "wb") as f:
+                await f.write(data)
+            metrics.count_io(written=len(data))
+            await aios.replace(temp, path)
+        except BaseException:
+            try:
+                await aios.remove(temp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    async def append_file(self, path: str, data: bytes) -> None:
+        """Append to a file, created if needed."""
+        async with aiofiles.open(path, "ab") as f:
+            await f.write(data)
+        metrics.count_io(written=len(data))
+
+    async def remove(self, path: str) -> None:
+        await aios.remove(path)
+
+
+class MemoryBackend:
+    """Keeps clusters in memory, nothing touches the disk.
+
+    Collections of an in-memory cluster store their documents with :class:`ashendb.storage.MemoryStorage`. Everything is lost when the process exits.
+    """
+
+    kind = "memory"
+
+    def __init__(self) -> None:
+        # directory -> names of its entries, keyed by the normalized path
+        self.directories: dict[str, set[str]] = {MEMORY_ROOT: set()}
+        self.files: dict[str, bytes] = {}
+        # collection -> id -> encoded document
+        self.documents: dict[str, dict[str, bytes]] = {}
+        # Bumped whenever an entry is added or removed anywhere.
+        self.version = 0
+
+    def _directory(self, path: str) -> set[str]:
+        key = os.path.normpath(path)
+        if key in self.directories:
+            return self.directories[key]
+        if key in self.files:
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+        raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
+
+    def _add(self, path: str) -> None:
+        key = os.path.normpath(path)
+        parent = self._directory(os.path.dirname(key))
+        if key in self.directories or key in self.files:
+            raise FileExistsError(errno.EEXIST, "File exists", path)
+        self.directories[key] = set()
+        parent.add(os.path.basename(key))
+        self.version += 1
+
+    def _rmdir(self, path: str) -> None:
+        key = os.path.normpath(path)
+        if self._directory(key) or self.documents.get(key):
+            raise OSError(errno.ENOTEMPTY, "Directory not empty", path)
+        del self.directories[key]
+        self.documents.pop(key, None)
+        self.directories[os.path.dirname(key)].discard(os.path.basename(key))
+        self.version += 1
+
+    async def create_cluster(self, path: str) -> None:
+        """Create the root directory of a cluster, if it doesn't exist yet."""
+        key = os.path.normpath(path)
+        if key not in self.directories:
+            self._add(key)
+
+    async def listdir(self, path: str) -> list[str]:
+        return list(self._directory(path))
+
+    async def stamp(self, path: str) -> int:
+        """Changes whenever an entry is added to or removed from a directory, or a file grows."""
+        key = os.path.normpath(path)
+        if key in self.files:
+            return len(self.files[key])
+        self._directory(key)
+        return self.version
+
+    async def exists(self, path: str) -> bool:
+        key = os.path.normpath(path)
+        return key in self.directories or key in self.files
+
+    async def isdir(self, path: str) -> bool:
+        return os.path.normpath(path) in self.directories
+
+    async def mkdir(self, path: str) -> None:
+        self._add(path)
+
+    async def makedirs(self, path: str) -> None:
+        key = os.path.normpath(path)
+        if key in self.directories:
+            return
+        await self.makedirs(os.path.dirname(key))
+        self._add(key)
+
+    async def removedirs(self, path: str) -> None:
+        """Remove an empty directory, then its parents as long as they are empty."""
+        self._rmdir(path)
+        parent = os.path.dirname(os.path.normpath(path))
+        while parent != MEMORY_ROOT:
+            try:
+                self._rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    async def rmtree(self, path: str) -> None:
+        key = os.path.normpath(path)
+        self._directory(key)
+        prefix = key + os.sep
+        for entries in (self.directories, self.files, self.documents):
+            for name in [name for name in entries if name.startswith(prefix)]:
+                del entries[name]
+        self.documents.pop(key, None)
+        del self.directories[key]
+        self.directories[os.path.dirname(key)].discard(os.path.basename(key))
+        self.version += 1
+
+    async def read_file(self, path: str) -> bytes:
+        key = os.path.normpath(path)
+        if key not in self.files:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
+        return self.files[key]
+
+    async def write_file(self, path: str, data: bytes) -> None:
+        key = os.path.normpath(path)
+        if key in self.directories:
+            raise IsADirectoryError(errno.EISDIR, "Is a directory", path)
+        if key not in self.files:
+            self._directory(os.path.dirname(key)).add(os.path.basename(key))
+            self.version += 1
+        self.files[key] = bytes(data)
+
+    async def append_file(self, path: str, data: bytes) -> None:
+        key = os.path.normpath(path)
+        if key in self.directories:
+            raise IsADirectoryError(errno.EISDIR, "Is a directory", path)
+        if key not in self.files:
+            self._directory(os.path.dirname(key)).add(os.path.basename(key))
+            self.version += 1
+            self.files[key] = b""
+        self.files[key] += bytes(data)
+
+    async def remove(self, path: str) -> None:
+        key = os.path.normpath(path)
+        if key not in self.files:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
+        del self.files[key]
+        self.directories[os.path.dirname(key)].discard(os.path.basename(key))
+        self.version += 1
+
+
+disk = DiskBackend()
+memory = MemoryBackend()
+
+backend_types = {
+    DiskBackend.kind: disk,
+    MemoryBackend.kind: memory,
+}
+
+
+def get_backend(path: str) -> DiskBackend | MemoryBackend:
+    """The backend holding a path, :data:`memory` for the paths below ``:memory:``."""
+    root = os.path.normpath(path).split(os.sep, 1)[0]
+    return memory if root == MEMORY_ROOT else disk
@@ -0,0 +1,143 @@
+import os
+from collections import OrderedDict
+from typing import Any
+
+import aiofiles.os as aios
+
+from . import metrics
+from .codec import decode, open_buffer
+
+# Enabled caches, keyed by the normalized collection path.
+_caches: dict[str, "DocumentCache"] = {}
+
+
+def _copy(value: Any) -> Any:
+    # Cached documents only hold json types, so this is much cheaper than deepcopy.
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _read(path: str) -> tuple[dict, int]:
+    with open_buffer(path) as buffer:
+        return decode(buffer), len(buffer)
+
+
+class DocumentCache:
+    """A bounded LRU cache of parsed documents.
+
+    Entries are validated before they are used, either by the ``(mtime, size)`` of the file or by a generation counter bumped on every write made through AshenDB in this process. The latter needs no I/O at all on a hit, but doesn't notice files changed by other processes.
+
+    Args:
+        max_entries: The maximum number of cached documents.
+        max_bytes: The maximum total size of the cached files. No limit if None.
+        validate: Either ``"stat"`` or ``"generation"``.
+
+    Raises:
+        ValueError: If validate is unknown.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int | None = None,
+        validate: str = "stat",
+    ) -> None:
+        if validate not in ("stat", "generation"):
+            raise ValueError(f"Unknown validation '{validate}'")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.entries: OrderedDict[str, tuple[Any, int, dict]] = OrderedDict()
+        self.generations: dict[str, int] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, path: str) -> dict:
+        """Read a document, from the cache if it is still valid.
+
+        Raises:
+            FileNotFoundError: If the document does not exist.
+        """
+        if self.validate == "stat":
+            try:
+                stat = await aios.stat(path)
+            except FileNotFoundError:
+                self.invalidate(path)
+                raise
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        else:
+            stamp = self.generations.get(path, 0)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            metrics.count("cache_hits")
+            self.entries.move_to_end(path)
+            return _copy(entry[2])
+        self.misses += 1
+        metrics.count("cache_misses")
+        data, size = await aios.wrap(_read)(path)
+        self.put(path, stamp, data, size)
+        return _copy(data)
+
+    def put(self, path: str, stamp: Any, data: dict, size: int) -> None:
+        """Cache a parsed document and evict the least recently used ones over the limits."""
+        self.discard(path)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self.entries[path] = (stamp, size, data)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+    def discard(self, path: str) -> None:
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def invalidate(self, path: str) -> None:
+        """Forget a document after it was written or deleted."""
+        self.generations[path] = self.generations.get(path, 0) + 1
+        self.discard(path)
+
+    def clear(self) -> None:
+        """Empty the cache and reset the counters."""
+        self.entries.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> dict:
+        """Counters of the cache.
+
+        Example:
+            >>> coll.cache.info()
+            {"hits": 10, "misses": 2, "entries": 2, "bytes": 120, "max_entries": 1024, "max_bytes": None}
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def get_cache(path: str) -> DocumentCache | None:
+    """The cache enabled for a collection, if any."""
+    return _caches.get(os.path.normpath(path))
+
+
+def set_cache(path: str, cache: DocumentCache | None) -> None:
+    """Enable a cache for a collection, or disable it with None."""
+    if cache is None:
+        _caches.pop(os.path.normpath(path), None)
+    else:
+        _caches[os.path.normpath(path)] = cache
@@ -1,25 +1,57 @@
-import aiofiles.os as aios
+import os
 from typing import Generator
 
+from . import metrics
+from .backend import MEMORY_ROOT, MemoryBackend, backend_types
 from .database import Database
+from .handles import add_handle, get_handles, remove_handle
 from .exception import *
+from .index import load_indexes
+from .storage import get_storage
+from .versioning import is_versioned
 
 
 # Client Class
+@metrics.instrumented
 class AshenDB:
     """
     Entry point for AshenDB. This class is used to create, get, and delete databases.
 
     Args:
         cluster: The name of the cluster to use. Defaults to "ashendb".
+        backend: Where the cluster is kept, either ``"disk"`` (the ``.ashendb`` directory) or ``"memory"``, which never touches the disk and is lost when the process exits. See :mod:`ashendb.backend`.
+
+    Raises:
+        InvalidClusterName: If the name isn't alphanumeric.
+        ValueError: If the backend is unknown.
+
+    Example:
+        >>> client = AshenDB("scratch", backend="memory")
     """
 
-    def __init__(self, cluster: str) -> None:
+    def __init__(self, cluster: str, backend: str = "disk") -> None:
         if not cluster.isalnum():
             raise InvalidClusterName(
                 "Cluster name must be alphanumeric and cannot contain spaces."
             )
-        self.cluster = ".ashendb/" + cluster + "/"
+        if backend not in backend_types:
+            raise ValueError(f"Unknown backend '{backend}'")
+        self.name = cluster
+        self.backend = backend_types[backend]
+        if isinstance(self.backend, MemoryBackend):
+            self.cluster = MEMORY_ROOT + "/" + cluster + "/"
+        else:
+            self.cluster = ".ashendb/" + cluster + "/"
+
+    async def _ready(self) -> None:
+        # The directory of the cluster is created on first use rather than on import.
+        await self.backend.create_cluster(self.cluster)
+
+    async def _handles(self) -> dict[str, Database]:
+        await self._ready()
+        return await get_handles(
+            self.cluster, lambda name: Database(self.cluster + name + "/")
+        )
 
     async def get_db(self, db_name: str) -> Database:
         """Get a single database from database name.
@@ -36,9 +68,9 @@ class AshenDB:
             <Database: test>
         """
         db_name = str(db_name)
-        for name in await aios.listdir(self.cluster):
-            if name == db_name:
-                return Database(self.cluster + name + "/")
+        db = (await self._handles()).get(db_name)
+        if db is not None:
+            return db
         raise NotFound(f"Database '{db_name}' does not exist.")
 
     async def get_dbs(self, db_names: list[str] = None) -> list[Database]:
@@ -62,10 +94,10 @@ class AshenDB:
             >>> dbs
             [<Database: test>, <Database: test2>, <Database: test3>]
         """
+        await self._ready()
         final = []
         if db_names is None or len(db_names) == 0:
-            for name in await aios.listdir(self.cluster):
-                final.append(Database(self.cluster + name + "/"))
+            final.extend((await self._handles()).values())
         elif isinstance(db_names, list) and len(db_names) > 0:
             for name in db_names:
                 final.append(await self.get_db(name))
@@ -94,9 +126,10 @@ class AshenDB:
             >>> dbs
             [<Database: test>, <Database: test2>, <Database: test3>]
         """
+        await self._ready()
         if db_names is None or len(db_names) == 0:
-            for name in await aios.listdir(self.cluster):
-                yield Database(self.cluster + name + "/")
+            for db in list((await self._handles()).values()):
+                yield db
         elif isinstance(db_names, list) and len(db_names) > 0:
             for name in db_names:
                 yield await self.get_db(name)
@@ -119,11 +152,14 @@ class AshenDB:
         """
         db_name = str(db_name)
         path = self.cluster + db_name
-        if await aios.path.exists(path):
+        await self._ready()
+        if await self.backend.exists(path):
             raise AlreadyExists(f"Database '{db_name}' already exists.")
         else:
-            await aios.mkdir(path)
-            return Database(path + "/")
+            await self.backend.mkdir(path)
+            db = Database(path + "/")
+            await add_handle(self.cluster, db_name, db)
+            return db
 
     async def create_dbs(self, db_names: list[str]) -> list[Database]:
         """Create multiple databases.
@@ -190,8 +226,10 @@ class AshenDB:
 
         """
         path = self.cluster + db_name
-        if await aios.path.exists(path):
-            await aios.removedirs(path)
+        await self._ready()
+        if await self.backend.exists(path):
+            await self.backend.removedirs(path)
+            await remove_handle(self.cluster, db_name)
             return
         else:
             raise Exception(f"Database '{db_name}' does not exist.")
@@ -210,10 +248,46 @@ class AshenDB:
         Example:
             >>> await AshenDB.delete_dbs(["test", "test2"])
         """
+        await self._ready()
         if db_names is None:
-            for name in await aios.listdir(self.cluster):
+            for name in await self.backend.listdir(self.cluster):
                 await self.delete_db(name)
             return
         for name in db_names:
             await self.delete_db(name)
         return
+
+    async def load_into_memory(self) -> "AshenDB":
+        """Copy the cluster into an in-memory cluster of the same name.
+
+        Documents are copied with their codec and indexes are rebuilt, documents still in a write-ahead log included. Read-mostly workloads can then be served without touching the disk, writes made to the copy don't reach the disk.
+
+        Raises:
+            ValueError: If the cluster already is in memory.
+            AlreadyExists: If the in-memory cluster already holds databases.
+
+        Example:
+            >>> client = await AshenDB("main").load_into_memory()
+            >>> db = await client.get_db("test")
+        """
+        if isinstance(self.backend, MemoryBackend):
+            raise ValueError("Cluster is already in memory.")
+        copy = AshenDB(self.name, backend=MemoryBackend.kind)
+        await copy._ready()
+        if await copy.backend.listdir(copy.cluster):
+            raise AlreadyExists(f"In-memory cluster '{self.name}' already exists.")
+        for db in await self.get_dbs():
+            target = await copy.create_db(os.path.basename(os.path.normpath(db.path)))
+            for coll in await db.get_colls():
+                storage = await get_storage(coll.path)
+                new = await target.create_coll(
+                    os.path.basename(os.path.normpath(coll.path)),
+                    codec=storage.codec.name,
+                    versioned=await is_versioned(coll.path),
+                )
+                new_storage = await get_storage(new.path)
+                async for id, data in storage.read_many(await storage.ids()):
+                    await new_storage.write(id, data)
+                for field, index in (await load_indexes(coll.path)).items():
+                    await new.create_index(field, index.kind)
+        return copy
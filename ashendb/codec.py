@@ -0,0 +1,369 @@
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from typing import Any, Generator
+
+from . import metrics
+from .backend import get_backend
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_FILE = ".codec"
+
+# Spans of files from this size on are memory mapped instead of read into memory.
+MMAP_THRESHOLD = 64 * 1024
+
+# Chosen codecs, keyed by the normalized collection path.
+_codecs: dict[str, "JsonCodec | OrjsonCodec | MsgpackCodec"] = {}
+
+
+class JsonCodec:
+    """Stores documents as json text with the standard library. This is the default."""
+
+    name = "json"
+
+    def encode(self, data: dict) -> bytes:
+        return json.dumps(data).encode()
+
+
+class OrjsonCodec:
+    """Stores documents as json text with `orjson <https://github.com/ijl/orjson>`_, which is several times faster.
+
+    Raises:
+        ImportError: If orjson is not installed.
+    """
+
+    name = "orjson"
+
+    def __init__(self) -> None:
+        if orjson is None:
+            raise ImportError("The orjson codec needs the orjson package")
+
+    def encode(self, data: dict) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MsgpackCodec:
+    """Stores documents in the binary `MessagePack <https://msgpack.org>`_ format, which is smaller than json.
+
+    The msgpack package is used if it is installed, otherwise a pure Python encoder.
+    """
+
+    name = "msgpack"
+
+    def encode(self, data: dict) -> bytes:
+        if msgpack is not None:
+            return msgpack.packb(_string_keys(data))
+        out = bytearray()
+        _pack(data, out)
+        return bytes(out)
+
+
+codec_types = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name: str) -> JsonCodec | OrjsonCodec | MsgpackCodec:
+    """A codec by its name.
+
+    Raises:
+        ValueError: If the codec is unknown.
+        ImportError: If the codec needs a package which is not installed.
+    """
+    if name not in codec_types:
+        raise ValueError(f"Unknown codec '{name}'")
+    return codec_types[name]()
+
+
+def detect(raw: bytes) -> str:
+    """The name of the format a document was encoded in.
+
+    Json documents start with ``{``, MessagePack ones with a map header.
+
+    Raises:
+        ValueError: If the format is unknown.
+    """
+    if raw:
+        first = raw[0]
+        if first in b"{[ \t\r\n":
+            return JsonCodec.name
+        if 0x80 <= first <= 0x8F or first in (0xDE, 0xDF):
+            return MsgpackCodec.name
+    raise ValueError("Unknown document format")
+
+
+def decode(raw: bytes | memoryview | mmap.mmap) -> dict:
+    """Decode a document, whichever codec it was encoded with.
+
+    Json is parsed with orjson when it is installed. Buffers such as memory maps are parsed in place by orjson and msgpack, the standard library needs a copy.
+    """
+    if detect(raw) == MsgpackCodec.name:
+        if msgpack is not None:
+            return msgpack.unpackb(raw)
+        return _unpack(raw, 0)[0]
+    with memoryview(raw) as view:
+        if orjson is not None:
+            try:
+                return orjson.loads(view)
+            except orjson.JSONDecodeError:
+                # e.g. NaN, which the standard library writes but orjson doesn't read.
+                pass
+        return json.loads(raw if isinstance(raw, (bytes, bytearray)) else view.tobytes())
+
+
+@contextmanager
+def open_buffer(
+    filepath: str, offset: int = 0, length: int | None = None
+) -> Generator[bytes | memoryview | mmap.mmap, None, None]:
+    """Open a span of a file as a read-only buffer, by default the whole file.
+
+    Spans of :data:`MMAP_THRESHOLD` bytes or more are memory mapped. They are parsed straight from the page cache, which every process reading the file shares, instead of being copied into memory first. Smaller spans are read, which is cheaper than setting up a mapping.
+
+    The whole file is either bytes or the map itself, which both support ``find``. A span of a mapped file is a memoryview.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+    """
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if length is None:
+            length = size - offset
+        metrics.count_io(read=length)
+        if length < MMAP_THRESHOLD or size == 0:
+            f.seek(offset)
+            yield f.read(length)
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = None
+    try:
+        if offset == 0 and length == size:
+            yield mapped
+        else:
+            view = memoryview(mapped)[offset : offset + length]
+            yield view
+    finally:
+        if view is not None:
+            view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # A slice of the buffer is still referenced, e.g. by a traceback. The map
+            # is closed once it is collected.
+            pass
+
+
+def read_document(filepath: str, offset: int = 0, length: int | None = None) -> dict:
+    """Read and decode a document stored in a span of a file, see :func:`open_buffer`.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+    """
+    with open_buffer(filepath, offset, length) as buffer:
+        return decode(buffer)
+
+
+async def load_codec(path: str) -> JsonCodec | OrjsonCodec | MsgpackCodec:
+    """The codec new documents of a collection are written with.
+
+    It is read from the ``.codec`` file of the collection, json if there is none.
+    """
+    key = os.path.normpath(path)
+    codec = _codecs.get(key)
+    if codec is None:
+        try:
+            raw = await get_backend(key).read_file(os.path.join(key, CODEC_FILE))
+            codec = get_codec(raw.decode().strip())
+        except FileNotFoundError:
+            codec = JsonCodec()
+        _codecs[key] = codec
+    return codec
+
+
+async def save_codec(
+    path: str, name: str
+) -> JsonCodec | OrjsonCodec | MsgpackCodec:
+    """Choose the codec new documents of a collection are written with.
+
+    Raises:
+        ValueError: If the codec is unknown.
+    """
+    codec = get_codec(name)
+    filepath = os.path.join(os.path.normpath(path), CODEC_FILE)
+    backend = get_backend(path)
+    if codec.name == JsonCodec.name:
+        try:
+            await backend.remove(filepath)
+        except FileNotFoundError:
+            pass
+    else:
+        await backend.write_file(filepath, codec.name.encode())
+    _codecs[os.path.normpath(path)] = codec
+    return codec
+
+
+def forget_codec(path: str) -> None:
+    """Drop the loaded codec of a collection, e.g. after it was deleted."""
+    _codecs.pop(os.path.normpath(path), None)
+
+
+# A pure Python MessagePack encoder and decoder for json types, used without the msgpack package.
+
+_uint = [(0xFF, 0xCC, ">B"), (0xFFFF, 0xCD, ">H"), (0xFFFFFFFF, 0xCE, ">I")]
+_int = [(0x7F, 0xD0, ">b"), (0x7FFF, 0xD1, ">h"), (0x7FFFFFFF, 0xD2, ">i")]
+
+
+def _pack_length(
+    length: int, fix: int, fix_max: int, headers: tuple, out: bytearray
+) -> None:
+    if length <= fix_max:
+        out.append(fix | length)
+    elif length <= 0xFFFF:
+        out.append(headers[0])
+        out += struct.pack(">H", length)
+    else:
+        out.append(headers[1])
+        out += struct.pack(">I", length)
+
+
+def _string_keys(value: Any) -> Any:
+    # The keys _pack writes, for the msgpack package which would keep them as they are.
+    if isinstance(value, dict):
+        return {
+            key if isinstance(key, str) else json.dumps(key): _string_keys(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [_string_keys(item) for item in value]
+    return value
+
+
+def _pack(value: Any, out: bytearray) -> None:
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        if -32 <= value < 0x80:
+            out.append(value & 0xFF)
+            return
+        for limit, header, fmt in _uint if value > 0 else _int:
+            if -limit - 1 <= value <= limit:
+                out.append(header)
+                out += struct.pack(fmt, value)
+                return
+        if 0 < value <= 0xFFFFFFFFFFFFFFFF:
+            out.append(0xCF)
+            out += struct.pack(">Q", value)
+        elif -0x8000000000000000 <= value < 0:
+            out.append(0xD3)
+            out += struct.pack(">q", value)
+        else:
+            raise OverflowError("Integer too large for msgpack")
+    elif isinstance(value, float):
+        out.append(0xCB)
+        out += struct.pack(">d", value)
+    elif isinstance(value, str):
+        raw = value.encode()
+        if 32 <= len(raw) <= 0xFF:
+            out.append(0xD9)
+            out.append(len(raw))
+        else:
+            _pack_length(len(raw), 0xA0, 31, (0xDA, 0xDB), out)
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        _pack_length(len(value), 0x90, 15, (0xDC, 0xDD), out)
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, dict):
+        _pack_length(len(value), 0x80, 15, (0xDE, 0xDF), out)
+        for key, item in value.items():
+            # Keys are turned into strings like json does.
+            _pack(key if isinstance(key, str) else json.dumps(key), out)
+            _pack(item, out)
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+_fixed = {
+    0xCA: struct.Struct(">f"),
+    0xCB: struct.Struct(">d"),
+    0xCC: struct.Struct(">B"),
+    0xCD: struct.Struct(">H"),
+    0xCE: struct.Struct(">I"),
+    0xCF: struct.Struct(">Q"),
+    0xD0: struct.Struct(">b"),
+    0xD1: struct.Struct(">h"),
+    0xD2: struct.Struct(">i"),
+    0xD3: struct.Struct(">q"),
+}
+# header -> (struct of the length, kind)
+_sized = {
+    0xC4: (struct.Struct(">B"), bytes),
+    0xC5: (struct.Struct(">H"), bytes),
+    0xC6: (struct.Struct(">I"), bytes),
+    0xD9: (struct.Struct(">B"), str),
+    0xDA: (struct.Struct(">H"), str),
+    0xDB: (struct.Struct(">I"), str),
+    0xDC: (struct.Struct(">H"), list),
+    0xDD: (struct.Struct(">I"), list),
+    0xDE: (struct.Struct(">H"), dict),
+    0xDF: (struct.Struct(">I"), dict),
+}
+_constants = {0xC0: None, 0xC2: False, 0xC3: True}
+
+
+def _unpack(raw: bytes, offset: int) -> tuple[Any, int]:
+    byte = raw[offset]
+    offset += 1
+    if byte < 0x80:
+        return byte, offset
+    if byte >= 0xE0:
+        return byte - 0x100, offset
+    if byte in _constants:
+        return _constants[byte], offset
+    if byte in _fixed:
+        fmt = _fixed[byte]
+        return fmt.unpack_from(raw, offset)[0], offset + fmt.size
+    if byte <= 0x8F:
+        kind, length = dict, byte & 0x0F
+    elif byte <= 0x9F:
+        kind, length = list, byte & 0x0F
+    elif byte <= 0xBF:
+        kind, length = str, byte & 0x1F
+    elif byte in _sized:
+        fmt, kind = _sized[byte]
+        length = fmt.unpack_from(raw, offset)[0]
+        offset += fmt.size
+    else:
+        raise ValueError(f"Unsupported msgpack type 0x{byte:02x}")
+
+    if kind is str:
+        return str(raw[offset : offset + length], "utf-8"), offset + length
+    if kind is bytes:
+        return bytes(raw[offset : offset + length]), offset + length
+    if kind is list:
+        final = []
+        for _ in range(length):
+            item, offset = _unpack(raw, offset)
+            final.append(item)
+        return final, offset
+    final = {}
+    for _ in range(length):
+        key, offset = _unpack(raw, offset)
+        final[key], offset = _unpack(raw, offset)
+    return final, offset
@@ -1,16 +1,61 @@
+import asyncio
 import json
-import subprocess
-import urllib
-from typing import Generator, Union
+import os
+import time
+from contextlib import aclosing
+from typing import Generator, Iterable, Union
 from uuid import uuid4
 
 import aiofiles
 import aiofiles.os as aios
-import httpx
 
-from .document import Document
+from . import aggregate, metrics
+from .aggregate import sort_docs
+from .cache import DocumentCache, _copy, get_cache, set_cache
+from . import parallel
+from .document import Document, Projection
 from .exception import *
-from .helper import match_data, update_data
+from .helper import (
+    compile_projection,
+    compile_query,
+    compile_sort,
+    projected_fields,
+    update_data,
+)
+from .codec import decode, get_codec
+from .columnar import ColumnarSnapshot, build_snapshot, drop_snapshot, load_snapshot
+from .storage import (
+    DirectoryStorage,
+    convert_codec,
+    get_storage,
+    migrate,
+    storage_types,
+)
+from .versioning import (
+    VERSION_FIELD,
+    compare_and_swap,
+    is_versioned,
+    retry_on_conflict,
+    set_versioned,
+)
+from .index import (
+    SortedIndex,
+    candidate_ids,
+    count_matches,
+    covering_indexes,
+    delete_index,
+    index_types,
+    load_indexes,
+    log_index,
+    query_fields,
+    save_index,
+    used_indexes,
+)
+
+
+async def _aiter(items: Iterable) -> Generator:
+    for item in items:
+        yield item
 
 
 def gen_id() -> str:
@@ -22,9 +67,317 @@ def gen_id() -> str:
     return str(uuid4())
 
 
+@metrics.instrumented
 class Collection:
-    def __init__(self, path):
+    """A directory of json documents.
+
+    Args:
+        path: The path of the collection directory.
+        scan_concurrency: How many files are read at once while scanning the collection.
+        scan_ordered: Yield scanned documents in directory order. If False they are yielded as soon as they are read.
+        write_concurrency: How many documents are written at once by bulk writes.
+        use_processes: Match queries in worker processes when a scan covers at least ``process_threshold`` documents. Workers are spawned and import the main module again, which must guard its work with ``if __name__ == "__main__":``. See :func:`ashendb.parallel.start_pool`.
+        process_threshold: The smallest scan sent to worker processes.
+        process_chunk_size: How many documents a worker reads and matches at once.
+    """
+
+    def __init__(
+        self,
+        path,
+        scan_concurrency: int = 16,
+        scan_ordered: bool = True,
+        write_concurrency: int = 16,
+        use_processes: bool = False,
+        process_threshold: int = 5000,
+        process_chunk_size: int = 500,
+    ) -> None:
         self.path = path
+        self.scan_concurrency = scan_concurrency
+        self.scan_ordered = scan_ordered
+        self.write_concurrency = write_concurrency
+        self.use_processes = use_processes
+        self.process_threshold = process_threshold
+        self.process_chunk_size = process_chunk_size
+
+    def _doc_path(self, id: str) -> str:
+        return os.path.join(self.path, f"{id}.json")
+
+    @staticmethod
+    def _doc_id(filepath: str) -> str:
+        return os.path.basename(filepath)[: -len(".json")]
+
+    async def _read_docs(
+        self, ids: list[str], ordered: bool | None = None
+    ) -> Generator[Document, None, None]:
+        # Every document is read and parsed exactly once, documents deleted meanwhile are skipped.
+        storage = await get_storage(self.path)
+        if ordered is None:
+            ordered = self.scan_ordered
+        items = storage.read_many(ids, self.scan_concurrency, ordered)
+        async with aclosing(items) as items:
+            async for id, data in items:
+                yield Document.from_data(self._doc_path(id), data, self)
+
+    async def _query_ids(self, query: dict) -> list[str]:
+        ids = candidate_ids(query, await load_indexes(self.path))
+        if ids is None:
+            return await (await get_storage(self.path)).ids()
+        return sorted(ids)
+
+    def _in_processes(self, storage, ids: list[str], query: dict) -> bool:
+        # Workers read the document files themselves, which are only up to date without a
+        # write-ahead log in front of the directory storage.
+        return (
+            self.use_processes
+            and isinstance(storage, DirectoryStorage)
+            and len(ids) >= self.process_threshold
+            and parallel.picklable(query)
+        )
+
+    async def _match_docs(self, query: dict) -> Generator[Document, None, None]:
+        storage = await get_storage(self.path)
+        ids = await self._query_ids(query)
+        if self._in_processes(storage, ids, query):
+            paths = [storage.doc_path(id) for id in ids]
+            scan = parallel.scan(paths, query, self.process_chunk_size)
+            async with aclosing(scan) as chunks:
+                async for chunk in chunks:
+                    for path, data in chunk:
+                        yield Document.from_data(path, data, self)
+            return
+
+        match = compile_query(query)
+        async with aclosing(self._read_docs(ids)) as docs:
+            async for doc in docs:
+                if match(doc):
+                    yield doc
+
+    @staticmethod
+    def _index_doc(id: str, covering: dict[str, SortedIndex]) -> dict:
+        # Rebuild the part of a document held by the indexes. Shallower fields come first,
+        # a field below one which was already set is part of its value.
+        document = {}
+        assigned = set()
+        for field in sorted(covering, key=lambda field: field.count(".")):
+            index = covering[field]
+            if id not in index.values:
+                continue
+            prefixes = (field[:i] for i, c in enumerate(field) if c == ".")
+            if any(prefix in assigned for prefix in prefixes):
+                continue
+            *steps, last = field.split(".")
+            parent = document
+            for step in steps:
+                parent = parent.setdefault(step, {})
+            parent[last] = _copy(index.values[id])
+            assigned.add(field)
+        return document
+
+    def _covered_docs(
+        self, ids: list[str], query: dict | None, covering: dict[str, SortedIndex]
+    ) -> Generator[dict, None, None]:
+        match = compile_query(query) if query else None
+        for id in ids:
+            document = self._index_doc(id, covering)
+            if match is None or match(document):
+                yield document
+
+    async def _ordered_docs(
+        self, ids: list[str], query: dict | None
+    ) -> Generator[Document, None, None]:
+        match = compile_query(query) if query else None
+        async with aclosing(self._read_docs(ids, ordered=True)) as docs:
+            async for doc in docs:
+                if match is None or match(doc):
+                    yield doc
+
+    async def _docs_by_id(self, ids: list) -> Generator[Document, None, None]:
+        for id in ids:
+            yield await self.get_doc(id=id)
+
+    async def _choose_plan(
+        self, query: dict | None, projection: dict | None, sort: dict | None
+    ) -> dict:
+        # Decides how a query is answered, see explain for the keys of the plan. "ids" are
+        # the ids to read in order, None when the query or the whole collection is scanned.
+        indexes = await load_indexes(self.path)
+        if query:
+            compile_query(query)
+        if sort:
+            # Invalid sorts raise whichever plan answers them.
+            compile_sort(sort)
+        candidates = candidate_ids(query, indexes) if query else None
+        plan = {
+            "stage": "scan" if candidates is None else "index",
+            "indexes": used_indexes(query, indexes) if candidates is not None else [],
+            "ordered": False,
+            "ids": None,
+        }
+        order = None
+        if sort and len(sort) == 1:
+            [(field, direction)] = sort.items()
+            index = indexes.get(field)
+            if index is not None and index.kind == SortedIndex.kind:
+                order = [
+                    id
+                    for id in index.iter_ids(descending=direction == -1)
+                    if candidates is None or id in candidates
+                ]
+                plan.update(stage="sorted_index", ordered=True, ids=order)
+                plan["indexes"] = sorted(set(plan["indexes"]) | {field})
+
+        fields = projected_fields(projection) if projection is not None else None
+        if fields is not None and indexes:
+            # When indexes hold every field the query, the sort and the projection look at,
+            # the documents aren't read at all.
+            covering = covering_indexes(
+                set(fields) | query_fields(query or {}) | set(sort or ()), indexes
+            )
+            if covering:
+                if order is None:
+                    # Sorted indexes hold every document of the collection.
+                    everything = next(iter(covering.values())).keys
+                    order = sorted(everything if candidates is None else candidates)
+                plan.update(
+                    stage="covered",
+                    indexes=sorted(covering),
+                    ids=order,
+                    covering=covering,
+                )
+        return plan
+
+    async def _plan(
+        self, query: dict | None, projection: dict | None, sort: dict | None
+    ) -> tuple[Generator, bool]:
+        # Returns the matching documents and whether they already come in the sort order.
+        plan = await self._choose_plan(query, projection, sort)
+        if plan["stage"] == "covered":
+            docs = self._covered_docs(plan["ids"], query, plan["covering"])
+            return _aiter(docs), plan["ordered"]
+        if plan["stage"] == "sorted_index":
+            return self._ordered_docs(plan["ids"], query), True
+        if query:
+            return self._match_docs(query), False
+        return self._read_docs(await (await get_storage(self.path)).ids()), False
+
+    async def _find(
+        self,
+        ids: list | None,
+        query: dict | None,
+        projection: dict | None,
+        sort: dict | None = None,
+        skip: int = 0,
+        limit: int | None = None,
+    ) -> Generator[Document | Projection, None, None]:
+        project = compile_projection(projection) if projection is not None else None
+        if ids:
+            docs, ordered = self._docs_by_id(ids), False
+        else:
+            docs, ordered = await self._plan(query, projection, sort)
+        end = skip + limit if limit else None
+        if sort and not ordered:
+            docs = sort_docs(docs, compile_sort(sort), end)
+
+        # Leaving the loop closes the scan, nothing past the limit is read.
+        async with aclosing(docs) as docs:
+            position = 0
+            async for doc in docs:
+                position += 1
+                if position <= skip:
+                    continue
+                yield doc if project is None else Projection(project(doc))
+                if end is not None and position >= end:
+                    return
+
+    async def _read_data(self, filepath: str) -> dict:
+        storage = await get_storage(self.path)
+        return await storage.read(self._doc_id(filepath))
+
+    async def _write_doc(self, document: Document) -> None:
+        storage = await get_storage(self.path)
+        id = self._doc_id(document.filepath)
+        if await is_versioned(self.path):
+            await compare_and_swap(storage, self.path, id, document)
+        else:
+            await storage.write(id, document)
+        await self._on_write(document)
+
+    async def _swap_doc(
+        self, storage, doc: Document, data: dict, match, retries: int
+    ) -> Document | None:
+        # Writes a document changed by update_docs to a versioned collection. On a
+        # conflict the update is applied again to the stored document, if it still matches.
+        id = self._doc_id(doc.filepath)
+        for attempt in range(retries + 1):
+            try:
+                await compare_and_swap(storage, self.path, id, doc)
+                return doc
+            except VersionConflict:
+                if attempt >= retries:
+                    raise
+            try:
+                doc = Document.from_data(doc.filepath, await storage.read(id), self)
+            except NotFound:
+                return None
+            if match is not None and not match(doc):
+                return None
+            before = json.dumps(doc)
+            await update_data(doc, data, save=False)
+            if json.dumps(doc) == before:
+                return None
+
+    async def _delete_doc(self, filepath: str) -> None:
+        storage = await get_storage(self.path)
+        await storage.delete(self._doc_id(filepath))
+        await self._on_delete(filepath)
+
+    async def _on_write(self, document: Document) -> None:
+        await self._on_writes([document])
+
+    async def _on_writes(self, documents: list[Document]) -> None:
+        # Every changed index is logged to once, however many documents were written.
+        cache = get_cache(self.path)
+        if cache is not None:
+            for document in documents:
+                cache.invalidate(document.filepath)
+        indexes = await load_indexes(self.path)
+        ids = [self._doc_id(document.filepath) for document in documents]
+        # Records are taken along with the changes, the indexes may be reloaded while
+        # they are logged.
+        changes = [
+            (
+                index,
+                [
+                    index.record(id)
+                    for id, document in zip(ids, documents)
+                    if index.add(id, document)
+                ],
+            )
+            for index in indexes.values()
+        ]
+        for index, records in changes:
+            if records:
+                await log_index(self.path, index, records)
+        snapshot = await load_snapshot(self.path)
+        if snapshot is not None:
+            await snapshot.update(
+                [(self._doc_id(document.filepath), document) for document in documents]
+            )
+
+    async def _on_delete(self, filepath: str) -> None:
+        cache = get_cache(self.path)
+        if cache is not None:
+            cache.invalidate(filepath)
+        indexes = await load_indexes(self.path)
+        id = self._doc_id(filepath)
+        changes = [
+            (index, index.record(id)) for index in indexes.values() if index.remove(id)
+        ]
+        for index, record in changes:
+            await log_index(self.path, index, [record])
+        snapshot = await load_snapshot(self.path)
+        if snapshot is not None:
+            await snapshot.remove([id])
 
     async def w3m(self) -> None:
         """Show the collection in w3m.
@@ -32,11 +385,16 @@ class Collection:
         Note:
             Your system must have w3m installed.
         """
+        # Only needed here, so importing AshenDB stays fast.
+        import subprocess
+        import urllib.parse
+
+        import httpx
 
         json_data = []
-        for file in await aios.scandir(self.path):
-            async with aiofiles.open(file.path, "r") as f:
-                json_data.append(json.loads(await f.read()))
+        ids = await (await get_storage(self.path)).ids()
+        async for doc in self._read_docs(ids):
+            json_data.append(dict(doc))
 
         safe_data = urllib.parse.quote(str(json_data).replace("'", '"'))
         safe_data = safe_data.replace("%20", "+")
@@ -61,11 +419,50 @@ class Collection:
         )
         return None
 
+    @property
+    def cache(self) -> DocumentCache | None:
+        """The document cache of the collection, None if it is disabled."""
+        return get_cache(self.path)
+
+    def enable_cache(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int | None = None,
+        validate: str = "stat",
+    ) -> DocumentCache:
+        """Cache parsed documents read by id.
+
+        Only collections using the directory storage without a write-ahead log are cached. The cache is shared by every handle of the collection in this process. Each hit is validated by the ``(mtime, size)`` of the file, or with ``validate="generation"`` by a counter bumped on every write made through AshenDB, which needs no I/O but misses changes made by other processes.
+
+        Args:
+            max_entries: The maximum number of cached documents.
+            max_bytes: The maximum total size of the cached files. No limit if None.
+            validate: Either ``"stat"`` or ``"generation"``.
+
+        Raises:
+            ValueError: If validate is unknown.
+
+        Example:
+            >>> coll.enable_cache(max_entries=10000, validate="generation")
+            >>> doc = await coll.get_doc("user1")
+            >>> doc = await coll.get_doc("user1")
+            >>> coll.cache.info()["hits"]
+            1
+        """
+        cache = DocumentCache(max_entries, max_bytes, validate)
+        set_cache(self.path, cache)
+        return cache
+
+    def disable_cache(self) -> None:
+        """Drop the document cache of the collection."""
+        set_cache(self.path, None)
+
     async def get_doc(
         self,
         id: str | None = None,
         query: dict[str, list[dict[str, dict[str, str]]]] | None = None,
-    ) -> Document:
+        projection: dict[str, int] | None = None,
+    ) -> Document | Projection:
         """Get a single document.
 
         You can pass either an id or a query. If both are passed then the id will be used.
@@ -73,6 +470,7 @@ class Collection:
         Args:
             id: The id of the document.
             query: A query to match the document.
+            projection: Only return some fields, see :func:`ashendb.helper.compile_projection`. The result is a read-only :class:`~ashendb.document.Projection`.
 
         Raises:
             ValueError: If neither id nor query is passed.
@@ -86,30 +484,42 @@ class Collection:
             >>> doc = await coll.get_doc(query={"name": "test"})
             >>> print(doc)
             {"name": "test"}
+
+            >>> await coll.get_doc(1, projection={"name": 1, "_id": 0})
+            {"name": "test"}
         """
         if id:
             # check if the "{self.path}/{id}.json" file exists
-            path = f"{self.path}/{id}.json"
-            if not await aios.path.exists(path):
-                raise NotFound("No document found")
-            doc = Document(path)
-            await doc.__ainit__()
-            return doc
+            path = self._doc_path(id)
+            storage = await get_storage(self.path)
+            cache = get_cache(self.path)
+            if cache is not None and isinstance(storage, DirectoryStorage):
+                try:
+                    data = await cache.load(path)
+                except FileNotFoundError:
+                    raise NotFound("No document found")
+            else:
+                data = await storage.read(str(id))
+            if projection is not None:
+                return Projection(compile_projection(projection)(data))
+            return Document.from_data(path, data, self)
         elif query:
-            for file in await aios.scandir(self.path):
-                async with aiofiles.open(file.path, "r") as f:
-                    document = json.loads(await f.read())
-                    if await match_data(document, query):
-                        doc = Document(file.path)
-                        await doc.__ainit__()
-                        return doc
+            async with aclosing(self._find(None, query, projection)) as docs:
+                async for doc in docs:
+                    return doc
             raise NotFound("No document found")
         else:
             raise ValueError("Either id or query must be provided")
 
     async def get_docs(
-        self, ids: list[str or int] = None, query: dict = None
-    ) -> list[Document]:
+        self,
+        ids: list[str or int] = None,
+        query: dict = None,
+        projection: dict[str, int] = None,
+        sort: dict[str, int] = None,
+        skip: int = 0,
+        limit: int = None,
+    ) -> list[Document | Projection]:
         """Get multiple documents.
 
         You can pass either a list of ids or a query. If both are passed then the ids will be used.
@@ -117,6 +527,10 @@ class Collection:
         Args:
             ids: The ids of the documents.
             query: A query to match the documents.
+            projection: Only return some fields, see :meth:`get_doc`.
+            sort: Order the documents, see :meth:`iterate_docs`.
+            skip: How many documents to leave out first.
+            limit: The maximum number of documents. No limit if None or 0.
 
         Raises:
             NotFound: If no documents are found.
@@ -129,42 +543,40 @@ class Collection:
             >>> docs = await coll.get_docs(query={"name": "test"})
             >>> docs
             [<Document: 1>, <Document: 2>, <Document: 3>]
+
+            >>> newest = await coll.get_docs(sort={"created_at": -1}, limit=20)
         """
-        final = []
+        docs = self._find(ids, query, projection, sort, skip, limit)
+        final = [doc async for doc in docs]
         if ids:
-            for id in ids:
-                final.append(await self.get_doc(id=id))
-            return final
-        elif query:
-            for file in await aios.scandir(self.path):
-                async with aiofiles.open(file.path, "r") as f:
-                    data = json.loads(await f.read())
-                    if await match_data(data, query):
-                        doc = Document(file.path)
-                        await doc.__ainit__()
-                        final.append(doc)
-            if len(final) == 0 or len(final[0]) == 0:
-                raise NotFound("No documents found")
-            return final
-        else:
-            for file in await aios.scandir(self.path):
-                doc = Document(file.path)
-                await doc.__ainit__()
-                final.append(doc)
-            if len(final) == 0 or len(final[0]) == 0:
-                raise NotFound("No documents found")
             return final
+        if len(final) == 0 or (projection is None and len(final[0]) == 0):
+            raise NotFound("No documents found")
+        return final
 
     async def iterate_docs(
-        self, *, ids: list[str or int] = None, query: dict = None
-    ) -> Generator[Document, None, None]:
+        self,
+        *,
+        ids: list[str or int] = None,
+        query: dict = None,
+        projection: dict[str, int] = None,
+        sort: dict[str, int] = None,
+        skip: int = 0,
+        limit: int = None,
+    ) -> Generator[Document | Projection, None, None]:
         """Iterate over multiple documents.
 
         You can pass either a list of ids or a query. If both are passed then the ids will be used.
 
+        Without a sort the scan stops as soon as the limit is reached. A sort on a single field with a sorted index reads the documents in the order of the index, otherwise only the best ``skip + limit`` documents are kept while scanning.
+
         Args:
             ids: The ids of the documents.
             query: A query to match the documents.
+            projection: Only return some fields, see :meth:`get_doc`. Documents are trimmed as they are scanned, and if sorted indexes hold every field of the query, the sort and the projection they are answered from the indexes alone.
+            sort: The keys to order by mapped to 1 for ascending or -1 for descending order, see :func:`ashendb.helper.compile_sort`.
+            skip: How many documents to leave out first.
+            limit: The maximum number of documents. No limit if None or 0.
 
         Raises:
             ValueError: If neither ids nor query is passed.
@@ -186,25 +598,121 @@ class Collection:
             >>> docs = [doc async for doc in coll.iterate_docs([1, 2, 3])]
             >>> docs
             [<Document: 1>, <Document: 2>, <Document: 3>]
+
+            >>> async for doc in coll.iterate_docs(sort={"age": -1}, skip=10, limit=10):
+            ...     print(doc)
+        """
+        docs = self._find(ids, query, projection, sort, skip, limit)
+        async with aclosing(docs) as docs:
+            async for doc in docs:
+                yield doc
+
+    async def explain(
+        self,
+        query: dict = None,
+        ids: list[str or int] = None,
+        projection: dict[str, int] = None,
+        sort: dict[str, int] = None,
+        skip: int = 0,
+        limit: int = None,
+    ) -> dict:
+        """Run a query like :meth:`get_docs` and tell how it was answered and what it cost.
+
+        The ``stage`` of the plan is one of:
+
+        - ``"ids"``: the documents were read by id.
+        - ``"scan"``: every document of the collection was read and matched.
+        - ``"index"``: indexes narrowed the query down to candidates, which were read and matched.
+        - ``"sorted_index"``: the documents were read in the order of the sorted index on the sort key, so the scan stopped at the limit.
+        - ``"covered"``: indexes held every field of the query, the sort and the projection, no document was read.
+
+        Documents are read one at a time and bypass the document cache, so the time spent on I/O, decoding and matching can be told apart. The query itself reads up to ``scan_concurrency`` documents at once, its wall time is lower than the sum.
+
+        Args:
+            query: A query to match the documents.
+            ids: The ids of the documents. If passed the query is ignored, like :meth:`get_docs` does.
+            projection: Only return some fields, see :meth:`get_doc`.
+            sort: Order the documents, see :meth:`iterate_docs`.
+            skip: How many documents to leave out first.
+            limit: The maximum number of documents. No limit if None or 0.
+
+        Returns:
+            dict: The ``plan``, with its ``stage``, the ``indexes`` it used, the ``storage`` kind, whether the documents are sorted in memory (``in_memory_sort``) and matched in worker ``processes``. And the ``stats``: how many documents were ``examined`` and ``returned``, the ``bytes_read``, and the ``io_time``, ``decode_time``, ``match_time``, ``sort_time`` and ``total_time`` in seconds.
+
+        Example:
+            >>> await coll.explain({"$and": [{"$gte": {"age": 18}}]}, limit=10)
+            {"plan": {"stage": "index", "indexes": ["age"], "storage": "directory", "in_memory_sort": False, "processes": False}, "stats": {"examined": 12, "returned": 10, "bytes_read": 1536, "io_time": 0.0021, "decode_time": 0.0002, "match_time": 0.0001, "sort_time": 0.0, "total_time": 0.0027}}
         """
+        clock = time.perf_counter
+        started = clock()
+        storage = await get_storage(self.path)
         if ids:
-            for id in ids:
-                yield await self.get_doc(id=id)
-        elif query:
-            for file in await aios.scandir(self.path):
-                async with aiofiles.open(file.path, "r") as f:
-                    data = json.loads(await f.read())
-                    if await match_data(data, query):
-                        doc = Document(file.path)
-                        await doc.__ainit__()
-                        yield doc
+            plan = {"stage": "ids", "indexes": [], "ordered": False}
+            read = [str(id) for id in ids]
+            query = None
         else:
-            for file in await aios.scandir(self.path):
-                async with aiofiles.open(file.path, "r") as f:
-                    data = json.loads(await f.read())
-                    doc = Document(file.path)
-                    await doc.__ainit__()
-                    yield doc
+            plan = await self._choose_plan(query, projection, sort)
+            read = plan["ids"]
+            if read is None:
+                read = await self._query_ids(query) if query else await storage.ids()
+        in_memory_sort = bool(sort) and not plan["ordered"]
+        end = skip + limit if limit else None
+        match = compile_query(query) if query else None
+        covering = plan.get("covering")
+
+        stats = {
+            "examined": 0,
+            "returned": 0,
+            "bytes_read": 0,
+            "io_time": 0.0,
+            "decode_time": 0.0,
+            "match_time": 0.0,
+            "sort_time": 0.0,
+        }
+        matched = []
+        for id in read:
+            if end is not None and not in_memory_sort and len(matched) >= end:
+                break
+            if covering is not None:
+                # Rebuilding the document from the indexes stands in for decoding it.
+                start = clock()
+                data = self._index_doc(id, covering)
+                stats["decode_time"] += clock() - start
+            else:
+                start = clock()
+                try:
+                    raw = await storage.read_raw(id)
+                except NotFound:
+                    continue
+                read_at = clock()
+                data = decode(raw)
+                stats["io_time"] += read_at - start
+                stats["decode_time"] += clock() - read_at
+                stats["bytes_read"] += len(raw)
+            stats["examined"] += 1
+            start = clock()
+            if match is None or match(data):
+                matched.append(data)
+            stats["match_time"] += clock() - start
+        if in_memory_sort:
+            start = clock()
+            matched.sort(key=compile_sort(sort))
+            stats["sort_time"] = clock() - start
+        stats["returned"] = len(matched[skip:end])
+        stats["total_time"] = clock() - started
+
+        return {
+            "plan": {
+                "stage": plan["stage"],
+                "indexes": plan["indexes"],
+                "storage": storage.kind,
+                "in_memory_sort": in_memory_sort,
+                "processes": plan["stage"] in ("scan", "index")
+                and bool(query)
+                and self._in_processes(storage, read, query),
+            },
+            "stats": stats,
+        }
 
     async def create_doc(self, data: dict) -> Document:
         """Create a document.
@@ -228,35 +736,92 @@ class Collection:
         except KeyError:
             id = gen_id()
             data["_id"] = id
-        # Check if already exist
-        if await aios.path.exists(f"{self.path}/{id}.json"):
-            raise AlreadyExists("Document already exist")
-        async with aiofiles.open(f"{self.path}/{id}.json", "w") as f:
-            await f.write(json.dumps(data))
-        document = Document(f"{self.path}/{id}.json")
-        await document.__ainit__()
+        if await is_versioned(self.path):
+            data.setdefault(VERSION_FIELD, 1)
+        storage = await get_storage(self.path)
+        await storage.create(id, data)
+        document = Document.from_data(self._doc_path(id), data, self)
+        await self._on_write(document)
         return document
 
-    async def create_docs(self, datas: list[dict]) -> list[Document]:
+    async def create_docs(
+        self, datas: list[dict], ordered: bool = True
+    ) -> list[Document]:
         """Create multiple documents.
 
+        Up to ``write_concurrency`` documents are written at once, and the existing ids are only listed once. Like MongoDB's ``insert_many``, an ordered insert stops at the first invalid or duplicate item, while an unordered one inserts every valid item.
+
         Args:
             datas: The data to be stored in the documents.
+            ordered: Stop at the first failing item.
 
         Raises:
             TypeError: If datas is not a list.
+            BulkWriteError: If some of the items failed. It holds the inserted documents and the error of every failed item.
 
         Example:
             >>> docs = await coll.create_docs([{"name": "test1"}, {"name": "test2"}])
             >>> docs
             [<Document: 1>, <Document: 2>]
+
+            >>> try:
+            ...     await coll.create_docs([{"_id": "a"}, {"_id": "a"}], ordered=False)
+            ... except BulkWriteError as e:
+            ...     print(e.errors)
+            [{"index": 1, "error": AlreadyExists("Document already exist")}]
         """
         if not isinstance(datas, list):
             raise TypeError("Datas must be a list")
 
-        final = []
-        for data in datas:
-            final.append(await self.create_doc(data))
+        storage = await get_storage(self.path)
+        existing = set(await storage.ids())
+        versioned = await is_versioned(self.path)
+        items = []
+        errors = []
+        for index, data in enumerate(datas):
+            if not isinstance(data, dict):
+                errors.append({"index": index, "error": TypeError("Data must be a dict")})
+            else:
+                try:
+                    id = str(data["_id"])
+                except KeyError:
+                    id = gen_id()
+                    data["_id"] = id
+                if id in existing:
+                    errors.append(
+                        {"index": index, "error": AlreadyExists("Document already exist")}
+                    )
+                else:
+                    existing.add(id)
+                    if versioned:
+                        data.setdefault(VERSION_FIELD, 1)
+                    items.append((index, id, data))
+                    continue
+            if ordered:
+                break
+
+        semaphore = asyncio.Semaphore(max(1, self.write_concurrency))
+
+        async def create(index: int, id: str, data: dict) -> Document | None:
+            async with semaphore:
+                try:
+                    # Another writer may have created it since the ids were listed.
+                    await storage.create(id, data)
+                except AlreadyExists as e:
+                    errors.append({"index": index, "error": e})
+                    return None
+            return Document.from_data(self._doc_path(id), data, self)
+
+        results = await asyncio.gather(*(create(*item) for item in items))
+        final = [doc for doc in results if doc is not None]
+        await self._on_writes(final)
+        if errors:
+            errors.sort(key=lambda error: error["index"])
+            raise BulkWriteError(
+                f"{len(errors)} of {len(datas)} documents failed",
+                inserted=final,
+                errors=errors,
+            )
         return final
 
     async def del_doc(self, id: str or int = None, query: dict = None) -> None:
@@ -276,10 +841,7 @@ class Collection:
             >>> await coll.delete_doc(1)
         """
         if id:
-            path = f"{self.path}/{id}.json"
-            if not await aios.path.exists(path):
-                raise NotFound("No document found")
-            await aios.remove(path)
+            await self._delete_doc(self._doc_path(id))
             return
         elif query:
             doc = await self.get_doc(query=query)
@@ -307,28 +869,36 @@ class Collection:
             for id in ids:
                 await self.del_doc(id)
         elif query:
-            async for doc in self.get_docs(query=query):
+            for doc in await self.get_docs(query=query):
                 await doc.delete()
         else:
             raise ValueError("Either ids or query must be provided")
 
     async def update_doc(
-        self, id: str or int = None, query: dict = None, data: dict = None
+        self,
+        id: str or int = None,
+        query: dict = None,
+        data: dict = None,
+        retries: int = 5,
     ) -> Document:
         """Update a document.
 
         You can pass either an id or a query. If both are passed then the id will be tried first, if it fails then the query will be used.
 
+        In a versioned collection the document is read and updated again whenever another writer saved it in between, see :meth:`enable_versioning`.
+
         Note:
             Not all update operators are supported. See helper_module for more info.
         Args:
             id: The id of the document.
             query: A query to match the document.
             data: The data to update the document with.
+            retries: How many times the update is retried after a conflict.
 
         Raises:
             ValueError: If neither id nor query is passed.
             NotFound: If no document is found.
+            VersionConflict: If the document was still written by someone else on the last retry.
 
         Example:
             >>> old_doc = await coll.update_doc(query={"name": "test"}}
@@ -339,18 +909,389 @@ class Collection:
             >>> new_doc
             {"name": "test2"}
         """
-        doc = await self.get_doc(id=id, query=query)
-        new_doc = await update_data(doc, data)
-        return new_doc
 
-    async def count_docs(self) -> int:
+        async def update() -> Document:
+            doc = await self.get_doc(id=id, query=query)
+            # An update which changes nothing isn't written.
+            doc._mark_clean()
+            return await update_data(doc, data)
+
+        return await retry_on_conflict(update, retries)
+
+    async def update_docs(
+        self,
+        query: dict = None,
+        data: dict = None,
+        ids: list[str or int] = None,
+        retries: int = 5,
+    ) -> dict:
+        """Update every document matching a query.
+
+        The collection is scanned once, the update is applied to each match in memory and the changed documents are written back, up to ``write_concurrency`` at once. Documents the update didn't change are not written.
+
+        In a versioned collection a document written by someone else since it was scanned is read again, and updated if it still matches. Other documents are written meanwhile.
+
+        Args:
+            query: A query to match the documents. Every document is updated if neither query nor ids is passed.
+            data: The update to apply, see :func:`ashendb.helper.update_data`.
+            ids: Only update the documents with these ids.
+            retries: How many times a document is read again after a conflict.
+
+        Raises:
+            ValueError: If data is not passed.
+            VersionConflict: If a document was still written by someone else on the last retry.
+
+        Returns:
+            dict: How many documents matched and how many were modified.
+
+        Example:
+            >>> await coll.update_docs({"$and": [{"$lt": {"age": 18}}]}, {"$set": {"minor": True}})
+            {"matched": 3, "modified": 2}
+        """
+        if not data:
+            raise ValueError("data must be provided")
+
+        storage = await get_storage(self.path)
+        match = None
+        if ids:
+            docs = self._read_docs([str(id) for id in ids])
+            if query:
+                match = compile_query(query)
+        elif query:
+            docs = self._match_docs(query)
+        else:
+            docs = self._read_docs(await storage.ids())
+        versioned = await is_versioned(self.path)
+        # Conflicting documents are matched again once they were read again.
+        recheck = compile_query(query) if versioned and query else None
+
+        async def write(doc: Document) -> Document | None:
+            if versioned:
+                return await self._swap_doc(storage, doc, data, recheck, retries)
+            await storage.write(self._doc_id(doc.filepath), doc)
+            return doc
+
+        def collect(results: list) -> None:
+            # Documents are only indexed once they were written.
+            written.extend(doc for doc in results if isinstance(doc, Document))
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+
+        matched = 0
+        written = []
+        pending = set()
+        limit = max(1, self.write_concurrency)
+        try:
+            async with aclosing(docs) as docs:
+                async for doc in docs:
+                    if match is not None and not match(doc):
+                        continue
+                    matched += 1
+                    before = json.dumps(doc)
+                    await update_data(doc, data, save=False)
+                    if json.dumps(doc) == before:
+                        continue
+                    if len(pending) >= limit:
+                        done, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        collect(await asyncio.gather(*done, return_exceptions=True))
+                    pending.add(asyncio.create_task(write(doc)))
+        finally:
+            # Writes already started are awaited even if the scan failed.
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            written.extend(doc for doc in results if isinstance(doc, Document))
+            await self._on_writes(written)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return {"matched": matched, "modified": len(written)}
+
+    async def count_docs(self, query: dict = None) -> int:
         """Count the number of documents in the collection.
 
+        The total is kept up to date by the storage, the directory isn't listed again unless it was changed by something else. A query made of ``$eq``, ``$in`` and range conditions on indexed keys is counted from the indexes. Any other query reads and matches the documents, without turning them into :class:`~ashendb.document.Document` objects.
+
+        Args:
+            query: Only count the documents matching the query.
+
         Example:
             >>> await coll.count_docs()
             3
+
+            >>> await coll.count_docs(query={"$and": [{"$gt": {"age": 18}}]})
+            2
         """
+        storage = await get_storage(self.path)
+        if not query:
+            return await storage.count()
+        match = compile_query(query)
+        count = count_matches(query, await load_indexes(self.path))
+        if count is not None:
+            return count
+        ids = await self._query_ids(query)
         count = 0
-        for _ in await aios.scandir(self.path):
-            count += 1
+        if self._in_processes(storage, ids, query):
+            paths = [storage.doc_path(id) for id in ids]
+            scan = parallel.scan(paths, query, self.process_chunk_size, with_data=False)
+            async with aclosing(scan) as chunks:
+                async for chunk in chunks:
+                    count += len(chunk)
+            return count
+        # The order doesn't matter for a count.
+        items = storage.read_many(ids, self.scan_concurrency, ordered=False)
+        async with aclosing(items) as items:
+            async for _, data in items:
+                if match(data):
+                    count += 1
         return count
+
+    async def aggregate(self, pipeline: list[dict]) -> Generator[dict, None, None]:
+        """Run an aggregation pipeline over the collection.
+
+        Supports the ``$match``, ``$project``, ``$group``, ``$sort``, ``$skip``, ``$limit`` and ``$unwind`` stages, see :mod:`ashendb.aggregate`. Documents stream through the stages one by one, only ``$group`` and ``$sort`` hold them.
+
+        The leading ``$match``, ``$sort``, ``$skip``, ``$limit`` and ``$project`` stages are done by the scan itself, like :meth:`iterate_docs` does them. A ``$sort`` followed by a ``$limit`` anywhere in the pipeline only keeps the top documents.
+
+        Args:
+            pipeline: The stages, each a dict with a single key.
+
+        Raises:
+            TypeError: If the pipeline isn't a list of single key dicts.
+            InvalidOperator: If a stage, an operator or an accumulator is unknown.
+
+        Example:
+            >>> pipeline = [
+            ...     {"$match": {"$and": [{"$gte": {"age": 18}}]}},
+            ...     {"$unwind": "$tags"},
+            ...     {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
+            ...     {"$sort": {"count": -1}},
+            ...     {"$limit": 3},
+            ... ]
+            >>> async for doc in coll.aggregate(pipeline):
+            ...     print(doc)
+            {"_id": "python", "count": 12}
+            {"_id": "rust", "count": 7}
+            {"_id": "go", "count": 3}
+        """
+        stages = aggregate.parse(pipeline)
+        scan, stages = aggregate.push_down(stages)
+        docs = self._find(
+            None,
+            scan["query"],
+            scan["projection"],
+            scan["sort"],
+            scan["skip"],
+            scan["limit"],
+        )
+        async with aclosing(aggregate.run(docs, stages)) as docs:
+            async for doc in docs:
+                yield doc
+
+    async def create_index(self, field: str, kind: str = "hash") -> None:
+        """Create an index on a field.
+
+        The index is stored with the collection and kept up to date on every write. Queries using ``$eq`` or ``$in`` on the field only read the matching documents instead of the whole collection. A ``"sorted"`` index also answers ``$gt``, ``$gte``, ``$lt`` and ``$lte`` and can be iterated in order with :meth:`iterate_sorted`.
+
+        Args:
+            field: The key of the field, e.g. ``"name.first"``.
+            kind: Either ``"hash"`` or ``"sorted"``.
+
+        Raises:
+            AlreadyExists: If the field is already indexed.
+            ValueError: If the kind is unknown.
+
+        Example:
+            >>> await coll.create_index("name")
+            >>> doc = await coll.get_doc(query={"$and": [{"$eq": {"name": "test"}}]})
+
+            >>> await coll.create_index("created_at", kind="sorted")
+            >>> docs = await coll.get_docs(query={"$and": [{"$gte": {"created_at": 1682208000}}]})
+        """
+        if kind not in index_types:
+            raise ValueError(f"Unknown index kind '{kind}'")
+        indexes = await load_indexes(self.path)
+        if field in indexes:
+            raise AlreadyExists(f"Index on '{field}' already exists.")
+        index = index_types[kind](field)
+        ids = await (await get_storage(self.path)).ids()
+        async for doc in self._read_docs(ids):
+            index.add(self._doc_id(doc.filepath), doc)
+        await save_index(self.path, index)
+
+    async def drop_index(self, field: str) -> None:
+        """Delete the index on a field.
+
+        Args:
+            field: The key of the field.
+
+        Raises:
+            NotFound: If the field is not indexed.
+
+        Example:
+            >>> await coll.drop_index("name")
+        """
+        indexes = await load_indexes(self.path)
+        if field not in indexes:
+            raise NotFound(f"Index on '{field}' does not exist.")
+        await delete_index(self.path, field)
+
+    async def list_indexes(self) -> list[str]:
+        """List the indexed fields.
+
+        Example:
+            >>> await coll.list_indexes()
+            ["name"]
+        """
+        return list(await load_indexes(self.path))
+
+    async def iterate_sorted(
+        self, field: str, descending: bool = False, query: dict = None
+    ) -> Generator[Document, None, None]:
+        """Iterate over documents ordered by a field with a sorted index.
+
+        Documents are read in index order, so no document outside of the query's range is opened.
+
+        Args:
+            field: The key of the field. It must have a ``"sorted"`` index.
+            descending: Iterate from the largest value to the smallest.
+            query: A query to match the documents.
+
+        Raises:
+            NotFound: If the field has no sorted index.
+
+        Example:
+            >>> await coll.create_index("created_at", kind="sorted")
+            >>> async for doc in coll.iterate_sorted("created_at", descending=True):
+            ...     print(doc)
+            {"created_at": 1682208300}
+            {"created_at": 1682208000}
+        """
+        indexes = await load_indexes(self.path)
+        index = indexes.get(field)
+        if index is None or index.kind != SortedIndex.kind:
+            raise NotFound(f"Sorted index on '{field}' does not exist.")
+        match = compile_query(query) if query else None
+        ids = candidate_ids(query, indexes) if query else None
+        if ids is None:
+            ordered = index.iter_ids(descending)
+        else:
+            ordered = sorted(
+                (id for id in ids if id in index.keys),
+                key=lambda id: (index.keys[id], id),
+                reverse=descending,
+            )
+        async with aclosing(self._read_docs(list(ordered))) as docs:
+            async for doc in docs:
+                if match is None or match(doc):
+                    yield doc
+
+    async def build_columnar_snapshot(self, fields: list[str]) -> ColumnarSnapshot:
+        """Store numeric fields column by column, for analytics without parsing documents.
+
+        The columns are NumPy arrays stored with the collection and kept up to date on every write, replacing the snapshot the collection had. Range filters, sums, min/max and histograms over them are vectorized. See :class:`ashendb.columnar.ColumnarSnapshot`.
+
+        Args:
+            fields: The keys of the fields, e.g. ``["age", "money"]``.
+
+        Raises:
+            ImportError: If numpy is not installed.
+
+        Example:
+            >>> snapshot = await coll.build_columnar_snapshot(["age", "money"])
+            >>> snapshot.sum("money", {"$and": [{"$gte": {"age": 18}}]})
+            >>> counts, edges = snapshot.histogram("age", bins=10)
+        """
+        storage = await get_storage(self.path)
+        ids = await storage.ids()
+        return await build_snapshot(self.path, fields, storage.read_many(ids))
+
+    async def columnar_snapshot(self) -> ColumnarSnapshot:
+        """The columnar snapshot built by :meth:`build_columnar_snapshot`.
+
+        Raises:
+            NotFound: If the collection has no snapshot.
+
+        Example:
+            >>> snapshot = await coll.columnar_snapshot()
+            >>> snapshot.max("age")
+        """
+        snapshot = await load_snapshot(self.path)
+        if snapshot is None:
+            raise NotFound("Collection has no columnar snapshot.")
+        return snapshot
+
+    async def drop_columnar_snapshot(self) -> None:
+        """Delete the columnar snapshot.
+
+        Example:
+            >>> await coll.drop_columnar_snapshot()
+        """
+        await drop_snapshot(self.path)
+
+    async def enable_versioning(self) -> None:
+        """Version the documents, so saving a document someone else saved since it was read fails instead of overwriting their changes.
+
+        Every document holds its version in the ``_version`` field, starting at 1 when it is created, or 0 if it was written before versioning was turned on. Writes compare the stored version with the one the document was read at and bump it, see :func:`ashendb.versioning.compare_and_swap`. Only writers of the same document are serialized, and only for the duration of the check.
+
+        :meth:`update_doc` and :meth:`update_docs` retry conflicting documents on their own, other read-modify-write code can use :func:`ashendb.versioning.retry_on_conflict`.
+
+        Example:
+            >>> await coll.enable_versioning()
+            >>> a, b = await coll.get_doc("1"), await coll.get_doc("1")
+            >>> await a.update({"name": "a"})
+            >>> await b.update({"name": "b"})
+            Traceback (most recent call last):
+            ...
+            ashendb.exception.VersionConflict: Document '1' is at version 2, expected 1
+        """
+        await set_versioned(self.path, True)
+
+    async def disable_versioning(self) -> None:
+        """Stop versioning the documents. Their ``_version`` field is kept but no longer checked.
+
+        Example:
+            >>> await coll.disable_versioning()
+        """
+        await set_versioned(self.path, False)
+
+    async def migrate_storage(self, kind: str) -> None:
+        """Move the documents to another storage.
+
+        ``"directory"`` keeps every document in its own json file. ``"segment"`` appends them to a few segment files, which scales to many more documents per collection. See :mod:`ashendb.storage`.
+
+        Args:
+            kind: Either ``"directory"`` or ``"segment"``.
+
+        Raises:
+            ValueError: If the kind is unknown.
+
+        Example:
+            >>> await coll.migrate_storage("segment")
+        """
+        if kind not in storage_types:
+            raise ValueError(f"Unknown storage '{kind}'")
+        self.disable_cache()
+        await migrate(self.path, kind)
+
+    async def convert_codec(self, codec: str) -> None:
+        """Rewrite the documents with another codec, which new documents are written with too.
+
+        ``"json"`` is the default. ``"orjson"`` writes the same json several times faster and needs the orjson package. ``"msgpack"`` writes the smaller binary MessagePack format. Documents are read whatever codec they were written with. See :mod:`ashendb.codec`.
+
+        Args:
+            codec: The name of the codec.
+
+        Raises:
+            ValueError: If the codec is unknown.
+            ImportError: If the codec needs a package which is not installed.
+
+        Example:
+            >>> await coll.convert_codec("msgpack")
+        """
+        get_codec(codec)
+        cache = self.cache
+        if cache is not None:
+            cache.clear()
+        await convert_codec(self.path, codec)
@@ -0,0 +1,457 @@
+import asyncio
+import json
+import os
+import shutil
+from contextlib import aclosing
+from typing import Any, Generator
+
+import aiofiles
+import aiofiles.os as aios
+
+from .backend import MemoryBackend, get_backend
+from .helper import compile_path
+from .index import _conditions
+
+# numpy is imported on first use, it is slow to import and optional.
+np = None
+
+COLUMN_DIR = ".columns"
+TAIL_FILE = "tail.jsonl"
+
+# Merge the tail into the columns once it holds this many records, or an eighth of the rows.
+MERGE_MIN = 1024
+
+# Loaded snapshots, keyed by the normalized collection path. None if the collection has none.
+_snapshots: dict[str, "ColumnarSnapshot | None"] = {}
+
+_int64 = (-(2**63), 2**63 - 1)
+
+comparisons = {
+    "$eq": lambda values, y: values == y,
+    "$gt": lambda values, y: values > y,
+    "$gte": lambda values, y: values >= y,
+    "$lt": lambda values, y: values < y,
+    "$lte": lambda values, y: values <= y,
+}
+
+
+def _import_numpy() -> bool:
+    # Whether numpy is installed.
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+def _cell(value: Any) -> int | float | None:
+    # The value stored in a column, None if it isn't a number.
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(value, int) and not _int64[0] <= value <= _int64[1]:
+        return float(value)
+    return value
+
+
+def _column(cells: list[int | float | None]) -> tuple["np.ndarray", "np.ndarray"]:
+    # int64 if every value is an int, float64 otherwise.
+    kind = np.int64 if all(not isinstance(c, float) for c in cells) else np.float64
+    values = np.array([0 if c is None else c for c in cells], dtype=kind)
+    valid = np.array([c is not None for c in cells], dtype=bool)
+    return values, valid
+
+
+def _load_array(filepath: str, mode: str) -> "np.ndarray":
+    try:
+        return np.load(filepath, mmap_mode=mode)
+    except ValueError:
+        # Empty arrays can't be memory mapped.
+        return np.load(filepath)
+
+
+def _write_snapshot(directory: str, ids: list[str], columns: dict) -> None:
+    staging = directory + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    np.save(os.path.join(staging, "ids.npy"), np.array(ids, dtype=str))
+    np.save(os.path.join(staging, "live.npy"), np.ones(len(ids), dtype=bool))
+    for field, (values, valid) in columns.items():
+        np.save(os.path.join(staging, f"field.{field}.npy"), values)
+        np.save(os.path.join(staging, f"valid.{field}.npy"), valid)
+    with open(os.path.join(staging, "meta.json"), "w") as f:
+        f.write(json.dumps({"fields": list(columns)}))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+
+
+class ColumnarSnapshot:
+    """The numeric fields of every document of a collection, stored column by column.
+
+    Every field is a NumPy array, int64 if it only holds ints and float64 otherwise, with a boolean array marking the documents holding a number. Next to them are the ids and a boolean array of the rows still alive. The arrays are memory mapped, so range filters, sums, min/max and histograms run as vectorized operations without parsing a single document. Values which aren't numbers, booleans included, count as missing.
+
+    Writes to documents already in the columns update their row in place. New documents are appended to a ``tail.jsonl`` log, which is merged into the columns once it grows past :data:`MERGE_MIN` records or an eighth of the rows.
+
+    Queries use the syntax of :func:`ashendb.helper.match_data`, with ``$and`` and ``$or`` of ``$eq``, ``$in``, ``$gt``, ``$gte``, ``$lt`` and ``$lte`` on numbers.
+
+    Args:
+        path: The path of the collection.
+        fields: The keys of the fields, e.g. ``["age", "money"]``.
+    """
+
+    def __init__(self, path: str, fields: list[str]) -> None:
+        if not _import_numpy():
+            raise ImportError("Columnar snapshots need the numpy package")
+        self.path = path
+        self.directory = os.path.join(os.path.normpath(path), COLUMN_DIR)
+        self.fields = list(fields)
+        self.getters = {field: compile_path(field) for field in self.fields}
+        self.ids = np.array([], dtype=str)
+        self.live = np.array([], dtype=bool)
+        # field -> (values, valid)
+        self.columns: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        # id -> row, for the live rows only
+        self.rows: dict[str, int] = {}
+        self.dead = 0
+        # id -> {field: value}, for the documents not merged yet
+        self.tail: dict[str, dict[str, int | float]] = {}
+        self.tail_records = 0
+        self.lock = asyncio.Lock()
+
+    def _read(self) -> dict:
+        # Runs in a worker thread. The arrays are built aside and swapped in by _swap on
+        # the event loop, so readers never see them half loaded.
+        join = os.path.join
+        ids = _load_array(join(self.directory, "ids.npy"), "r")
+        live = _load_array(join(self.directory, "live.npy"), "r+")
+        columns = {
+            field: (
+                _load_array(join(self.directory, f"field.{field}.npy"), "r+"),
+                _load_array(join(self.directory, f"valid.{field}.npy"), "r+"),
+            )
+            for field in self.fields
+        }
+        rows = np.flatnonzero(live)
+        state = {
+            "ids": ids,
+            "live": live,
+            "columns": columns,
+            "rows": dict(zip(ids[rows].tolist(), rows.tolist())),
+            "dead": len(ids) - len(rows),
+            "tail": {},
+            "tail_records": 0,
+        }
+        try:
+            with open(join(self.directory, TAIL_FILE), "rb") as f:
+                contents = f.read()
+        except FileNotFoundError:
+            return state
+        for line in contents.split(b"\n"):
+            try:
+                id, cells = json.loads(line)
+            except ValueError:
+                # A write was cut off.
+                continue
+            state["tail_records"] += 1
+            if cells is None:
+                state["tail"].pop(id, None)
+            else:
+                state["tail"][id] = cells
+        return state
+
+    def _swap(self, state: dict) -> None:
+        # Called on the event loop, the readers see either the old or the new arrays.
+        self.__dict__.update(state)
+
+    @classmethod
+    def load(cls, path: str) -> "ColumnarSnapshot":
+        """Open the snapshot stored with a collection."""
+        directory = os.path.join(os.path.normpath(path), COLUMN_DIR)
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.loads(f.read())
+        snapshot = cls(path, meta["fields"])
+        snapshot._swap(snapshot._read())
+        return snapshot
+
+    def _cells(self, document: dict) -> dict[str, int | float]:
+        cells = {}
+        for field, getter in self.getters.items():
+            try:
+                cell = _cell(getter(document))
+            except (KeyError, IndexError, TypeError):
+                continue
+            if cell is not None:
+                cells[field] = cell
+        return cells
+
+    def _rewrite(self, ids: list[str], columns: dict) -> dict:
+        # The arrays in use stay mapped to the replaced files until the new ones are
+        # swapped in.
+        _write_snapshot(self.directory, ids, columns)
+        return self._read()
+
+    def _merge(self) -> dict:
+        live = np.flatnonzero(self.live)
+        tail_ids, tail_columns = self._tail_columns()
+        columns = {}
+        for field, (values, valid) in self.columns.items():
+            tail_values, tail_valid = tail_columns[field]
+            columns[field] = (
+                np.concatenate([values[live], tail_values]),
+                np.concatenate([valid[live], tail_valid]),
+            )
+        return self._rewrite(self.ids[live].tolist() + tail_ids, columns)
+
+    def _widen(self, field: str) -> "np.ndarray":
+        # A float was written to an int column. Returns the float column, which the
+        # caller swaps in.
+        filepath = os.path.join(self.directory, f"field.{field}.npy")
+        np.save(filepath + ".tmp.npy", self.columns[field][0].astype(np.float64))
+        os.replace(filepath + ".tmp.npy", filepath)
+        return _load_array(filepath, "r+")
+
+    def _update_rows(self, items: list[tuple[int, dict]]) -> None:
+        for field in self.fields:
+            values, valid = self.columns[field]
+            for row, cells in items:
+                cell = cells.get(field)
+                values[row] = 0 if cell is None else cell
+                valid[row] = cell is not None
+            for array in (values, valid):
+                if isinstance(array, np.memmap):
+                    array.flush()
+
+    async def _log(self, records: list[tuple[str, dict | None]]) -> None:
+        async with aiofiles.open(os.path.join(self.directory, TAIL_FILE), "ab") as f:
+            await f.write(
+                b"".join(json.dumps(record).encode() + b"\n" for record in records)
+            )
+        self.tail_records += len(records)
+        if self.tail_records + self.dead > max(MERGE_MIN, len(self.ids) // 8):
+            self._swap(await aios.wrap(self._merge)())
+
+    async def update(self, documents: list[tuple[str, dict]]) -> None:
+        """Refresh the columns after documents were written."""
+        async with self.lock:
+            in_place, records = [], []
+            for id, document in documents:
+                cells = self._cells(document)
+                row = self.rows.get(id)
+                if row is not None:
+                    in_place.append((row, cells))
+                elif self.tail.get(id) != cells:
+                    self.tail[id] = cells
+                    records.append((id, cells))
+            if in_place:
+                for field in self.fields:
+                    values, valid = self.columns[field]
+                    if values.dtype.kind == "i" and any(
+                        isinstance(cells.get(field), float) for _, cells in in_place
+                    ):
+                        wide = await aios.wrap(self._widen)(field)
+                        self.columns = {**self.columns, field: (wide, valid)}
+                await aios.wrap(self._update_rows)(in_place)
+            if records:
+                await self._log(records)
+
+    async def remove(self, ids: list[str]) -> None:
+        """Refresh the columns after documents were deleted."""
+        async with self.lock:
+            records = []
+            for id in ids:
+                row = self.rows.pop(id, None)
+                if row is not None:
+                    self.live[row] = False
+                    self.dead += 1
+                elif self.tail.pop(id, None) is not None:
+                    records.append((id, None))
+            if isinstance(self.live, np.memmap):
+                self.live.flush()
+            if records:
+                await self._log(records)
+
+    def _tail_columns(self) -> tuple[list[str], dict]:
+        ids = list(self.tail)
+        cells = list(self.tail.values())
+        return ids, {
+            field: _column([c.get(field) for c in cells]) for field in self.fields
+        }
+
+    def _mask(self, columns: dict, live: "np.ndarray", query: dict | None) -> "np.ndarray":
+        if not query:
+            return live.copy()
+        mask = live.copy()
+        for operator, queries in query.items():
+            if operator == "$and":
+                conditions = [c for qx in queries for c in _conditions(qx)]
+                mask &= self._conjunction(columns, conditions, len(live))
+            elif operator == "$or":
+                union = np.zeros(len(live), dtype=bool)
+                for qx in queries:
+                    union |= self._conjunction(columns, _conditions(qx), len(live))
+                mask &= union
+            else:
+                raise ValueError(f"{operator} can't be answered by a columnar snapshot")
+        return mask
+
+    def _conjunction(
+        self, columns: dict, conditions: list[tuple[str, str, Any]], size: int
+    ) -> "np.ndarray":
+        mask = np.ones(size, dtype=bool)
+        for operator, keycode, value in conditions:
+            if keycode not in columns:
+                raise ValueError(f"'{keycode}' is not in the columnar snapshot")
+            if operator not in comparisons and operator != "$in":
+                raise ValueError(f"{operator} can't be answered by a columnar snapshot")
+            values, valid = columns[keycode]
+            bounds = value if operator == "$in" else [value]
+            if not isinstance(bounds, (list, tuple, set)) or any(
+                _cell(bound) is None for bound in bounds
+            ):
+                raise ValueError(f"{operator} on '{keycode}' must compare numbers")
+            bounds = [_cell(bound) for bound in bounds]
+            if operator == "$in":
+                mask &= valid & np.isin(values, bounds)
+            else:
+                mask &= valid & comparisons[operator](values, bounds[0])
+        return mask
+
+    def _parts(self) -> Generator[tuple[Any, dict, "np.ndarray"], None, None]:
+        # The merged columns, then the tail.
+        yield self.ids, self.columns, self.live
+        if self.tail:
+            ids, columns = self._tail_columns()
+            yield ids, columns, np.ones(len(ids), dtype=bool)
+
+    def select(self, field: str, query: dict = None) -> "np.ndarray":
+        """The values of a field for the documents matching a query and holding a number.
+
+        Raises:
+            ValueError: If the field isn't in the snapshot or the query can't be answered.
+        """
+        if field not in self.fields:
+            raise ValueError(f"'{field}' is not in the columnar snapshot")
+        selected = []
+        for _, columns, live in self._parts():
+            values, valid = columns[field]
+            selected.append(values[self._mask(columns, live, query) & valid])
+        return np.concatenate(selected)
+
+    def ids_where(self, query: dict = None) -> list[str]:
+        """The ids of the documents matching a query.
+
+        Example:
+            >>> snapshot.ids_where({"$and": [{"$gte": {"age": 18}}, {"$lt": {"age": 30}}]})
+        """
+        final = []
+        for ids, columns, live in self._parts():
+            mask = self._mask(columns, live, query)
+            final.extend(np.asarray(ids)[mask].tolist())
+        return final
+
+    def count(self, query: dict = None) -> int:
+        """Count the documents matching a query."""
+        return sum(
+            int(np.count_nonzero(self._mask(columns, live, query)))
+            for _, columns, live in self._parts()
+        )
+
+    def sum(self, field: str, query: dict = None) -> int | float:
+        """Sum a field over the documents matching a query."""
+        return self.select(field, query).sum().item()
+
+    def mean(self, field: str, query: dict = None) -> float | None:
+        """Average a field over the documents matching a query, None if none holds a number."""
+        values = self.select(field, query)
+        return values.mean().item() if len(values) else None
+
+    def min(self, field: str, query: dict = None) -> int | float | None:
+        """The lowest value of a field, None if no matching document holds a number."""
+        values = self.select(field, query)
+        return values.min().item() if len(values) else None
+
+    def max(self, field: str, query: dict = None) -> int | float | None:
+        """The highest value of a field, None if no matching document holds a number."""
+        values = self.select(field, query)
+        return values.max().item() if len(values) else None
+
+    def histogram(
+        self,
+        field: str,
+        bins: int | list = 10,
+        range: tuple[float, float] = None,
+        query: dict = None,
+    ) -> tuple[list[int], list[float]]:
+        """Count the values of a field per bin, see :func:`numpy.histogram`.
+
+        Returns:
+            The counts and the edges of the bins.
+
+        Example:
+            >>> counts, edges = snapshot.histogram("age", bins=[0, 18, 30, 65, 120])
+        """
+        counts, edges = np.histogram(self.select(field, query), bins=bins, range=range)
+        return counts.tolist(), edges.tolist()
+
+
+async def load_snapshot(path: str) -> ColumnarSnapshot | None:
+    """The columnar snapshot of a collection, None if it has none.
+
+    Snapshots are opened once per process and shared by every handle of the collection. Without numpy the snapshot is left on disk but not opened, so it doesn't follow the writes made by this process. Rebuild it with :func:`build_snapshot` afterwards.
+
+    Args:
+        path: The path of the collection.
+    """
+    key = os.path.normpath(path)
+    if key not in _snapshots:
+        snapshot = None
+        directory = os.path.join(key, COLUMN_DIR)
+        if await get_backend(key).isdir(directory) and _import_numpy():
+            snapshot = await aios.wrap(ColumnarSnapshot.load)(path)
+        _snapshots[key] = snapshot
+    return _snapshots[key]
+
+
+async def build_snapshot(
+    path: str, fields: list[str], documents: Generator[tuple[str, dict], None, None]
+) -> ColumnarSnapshot:
+    """Write the columnar snapshot of a collection, replacing the one it had.
+
+    Args:
+        path: The path of the collection.
+        fields: The keys of the fields.
+        documents: The ``(id, document)`` pairs of the collection.
+
+    Raises:
+        ImportError: If numpy is not installed.
+        ValueError: If the collection is in memory.
+    """
+    if isinstance(get_backend(path), MemoryBackend):
+        raise ValueError("Columnar snapshots are stored on disk, not in memory clusters")
+    snapshot = ColumnarSnapshot(path, fields)
+    ids, rows = [], []
+    async with aclosing(documents) as documents:
+        async for id, document in documents:
+            ids.append(id)
+            rows.append(snapshot._cells(document))
+    columns = {field: _column([row.get(field) for row in rows]) for field in fields}
+    # Handles of the old snapshot keep reading its arrays.
+    _snapshots.pop(os.path.normpath(path), None)
+    snapshot._swap(await aios.wrap(snapshot._rewrite)(ids, columns))
+    _snapshots[os.path.normpath(path)] = snapshot
+    return snapshot
+
+
+async def drop_snapshot(path: str) -> None:
+    """Remove the columnar snapshot of a collection."""
+    forget_snapshot(path)
+    directory = os.path.join(os.path.normpath(path), COLUMN_DIR)
+    await aios.wrap(shutil.rmtree)(directory, ignore_errors=True)
+    _snapshots[os.path.normpath(path)] = None
+
+
+def forget_snapshot(path: str) -> None:
+    """Drop the loaded snapshot of a collection, e.g. after it was deleted."""
+    _snapshots.pop(os.path.normpath(path), None)
@@ -1,16 +1,36 @@
-import aiofiles
-import aiofiles.os as aios
 from typing import Generator
 
+from . import metrics
+from .backend import get_backend
 from .collection import Collection
 from .exception import *
+from .cache import set_cache
+from .codec import forget_codec, get_codec, save_codec
+from .columnar import forget_snapshot
+from .handles import add_handle, get_handles, remove_handle
+from .index import forget_indexes
+from .storage import SEGMENT_DIR, forget_storage, storage_types
+from .versioning import forget_versioning, set_versioned
+from .wal import WriteAheadLog, disable_wal, enable_wal, get_wal
 
 
 # Database Class
+@metrics.instrumented
 class Database:
     def __init__(self, db_path: str):
         super().__init__()
         self.path = db_path
+        self.backend = get_backend(db_path)
+
+    async def _handles(self) -> dict[str, Collection]:
+        # Hidden entries hold database metadata such as the write-ahead log, they are
+        # left out.
+        return await get_handles(
+            self.path, lambda name: Collection(self.path + name + "/")
+        )
+
+    async def _coll_names(self) -> list[str]:
+        return list(await self._handles())
 
     async def get_coll(self, collection_name: str) -> Collection:
         """Get a single collection.
@@ -26,9 +46,9 @@ class Database:
             >>> coll
             <Collection: test>
         """
-        for name in await aios.listdir(self.path):
-            if name == collection_name:
-                return Collection(self.path + name + "/")
+        coll = (await self._handles()).get(collection_name)
+        if coll is not None:
+            return coll
         raise NotFound(f"Collection '{collection_name}' does not exist.")
 
     async def get_colls(self, collection_names: list[str] = None) -> list[Collection]:
@@ -54,12 +74,11 @@ class Database:
         """
         final = []
         if collection_names is None or len(collection_names) == 0:
-            for name in collection_names:
-                final.append(await self.get_coll(name))
+            final.extend((await self._handles()).values())
             return final
         elif isinstance(collection_names, list) and len(collection_names) > 0:
-            for name in await aios.listdir(self.path):
-                final.append(Collection(self.path + name + "/"))
+            for name in collection_names:
+                final.append(await self.get_coll(name))
             return final
         else:
             raise InvalidArgumentType(f"Expected list, got {type(collection_names)}.")
@@ -95,34 +114,57 @@ class Database:
             [<Collection: test>, <Collection: test2>, <Collection: test3>]
         """
         if collection_names is None or len(collection_names) == 0:
-            for name in await aios.listdir(self.path):
-                yield Collection(self.path + name + "/")
+            for coll in list((await self._handles()).values()):
+                yield coll
         elif isinstance(collection_names, list) and len(collection_names) > 0:
             for name in collection_names:
                 yield await self.get_coll(name)
         else:
             raise InvalidArgumentType(f"Expected list, got {type(collection_names)}.")
 
-    async def create_coll(self, collection_name: str) -> Collection:
+    async def create_coll(
+        self,
+        collection_name: str,
+        storage: str = "directory",
+        codec: str = "json",
+        versioned: bool = False,
+    ) -> Collection:
         """Create a single collection.
 
         Args:
             collection_name: The name of the collection.
+            storage: How documents are stored, either ``"directory"`` (a json file per document) or ``"segment"``. See :mod:`ashendb.storage`.
+            codec: How documents are encoded, either ``"json"``, ``"orjson"`` or ``"msgpack"``. See :mod:`ashendb.codec`.
+            versioned: Version the documents, see :meth:`Collection.enable_versioning`.
 
         Raises:
             AlreadyExists: If the collection already exists.
+            ValueError: If the storage or the codec is unknown.
+            ImportError: If the codec needs a package which is not installed.
 
         Example:
             >>> coll = await db.create_coll("test")
             >>> coll
             <Collection: test>
+
+            >>> coll = await db.create_coll("events", storage="segment", codec="msgpack")
         """
+        if storage not in storage_types:
+            raise ValueError(f"Unknown storage '{storage}'")
+        get_codec(codec)
         path = self.path + collection_name
-        if await aios.path.exists(path):
+        if await self.backend.exists(path):
             raise AlreadyExists(f"Collection '{collection_name}' already exists.")
         else:
-            await aios.mkdir(path)
-            return Collection(path + "/")
+            await self.backend.mkdir(path)
+            if storage == "segment":
+                await self.backend.mkdir(path + "/" + SEGMENT_DIR)
+            await save_codec(path, codec)
+            if versioned:
+                await set_versioned(path, True)
+            coll = Collection(path + "/")
+            await add_handle(self.path, collection_name, coll)
+            return coll
 
     async def create_colls(self, collection_names: list[str]) -> list[Collection]:
         """Create multiple collections.
@@ -198,8 +240,8 @@ class Database:
             >>> await db.delete_coll("test")
         """
         path = self.path + collection_name
-        if await aios.path.exists(path):
-            await aios.removedirs(path)
+        if await self.backend.exists(path):
+            await self._delete_coll(collection_name)
             return
         else:
             raise NotFound(f"Collection '{collection_name}' does not exist.")
@@ -221,9 +263,72 @@ class Database:
             >>> await db.delete_colls()
         """
         if collection_names is None:
-            for name in await aios.listdir(self.path):
-                await aios.removedirs(self.path + name)
+            for name in await self._coll_names():
+                await self._delete_coll(name)
             return
         for name in collection_names:
-            await self.get_and_delete_collection(name)
+            await self.del_coll(name)
         return
+
+    async def _delete_coll(self, name: str) -> None:
+        # The hidden metadata of the collection, such as its indexes, segments and codec,
+        # goes along with it. The database is then removed if it was left empty.
+        path = self.path + name
+        await self.backend.rmtree(path)
+        try:
+            await self.backend.removedirs(self.path)
+        except OSError:
+            pass
+        await remove_handle(self.path, name)
+        forget_indexes(path)
+        forget_storage(path)
+        forget_codec(path)
+        forget_snapshot(path)
+        forget_versioning(path)
+        set_cache(path, None)
+
+    async def enable_wal(
+        self, window: float = 0.002, checkpoint_every: int = 1000
+    ) -> WriteAheadLog:
+        """Log the writes of every collection of the database ahead of applying them.
+
+        Writes are acknowledged once they are synced to the log. Concurrent writers share a single ``fsync`` per group, and the documents are written later by checkpoints. See :mod:`ashendb.wal`.
+
+        Args:
+            window: Seconds to wait for more writers before syncing a group.
+            checkpoint_every: Start a checkpoint in the background once this many documents are waiting for one.
+
+        Raises:
+            ValueError: If the database is in memory.
+
+        Example:
+            >>> await db.enable_wal()
+            >>> coll = await db.get_coll("test")
+            >>> await asyncio.gather(*(coll.create_doc({"n": i}) for i in range(100)))
+        """
+        wal = await enable_wal(self.path, window, checkpoint_every)
+        for name in await self._coll_names():
+            forget_storage(self.path + name)
+        return wal
+
+    async def disable_wal(self) -> None:
+        """Checkpoint and remove the write-ahead log of the database.
+
+        Example:
+            >>> await db.disable_wal()
+        """
+        await disable_wal(self.path)
+        for name in await self._coll_names():
+            forget_storage(self.path + name)
+
+    async def checkpoint(self) -> None:
+        """Write the logged documents to their collections.
+
+        Does nothing if the database has no write-ahead log.
+
+        Example:
+            >>> await db.checkpoint()
+        """
+        wal = await get_wal(self.path)
+        if wal is not None:
+            await wal.checkpoint()
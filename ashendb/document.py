@@ -1,44 +1,102 @@
 import aiofiles
+import aiofiles.os
 import json
 
+from . import metrics
 
+
+@metrics.instrumented
 class Document(dict):
-    def __init__(self, filepath):
+    """A document of a collection, changed like a dict and written back with :meth:`save`.
+
+    Once the document was read by ``async with``, or once it was written, it remembers its serialized contents. Saving it again only writes it if it changed since, nested values included. Documents returned by reads remember nothing, so reading costs no copy, and their first save always writes.
+    """
+
+    def __init__(self, filepath, collection=None):
         self.filepath = filepath
+        self.collection = collection
+        # The json contents as last read or written, None if they aren't known.
+        self._clean = None
 
-    async def __ainit__(self):
+    @classmethod
+    def from_data(cls, filepath: str, data: dict, collection=None) -> "Document":
+        """Create a document from data which was already read.
+
+        Args:
+            filepath: The path of the document file.
+            data: The parsed contents of the file.
+            collection: The collection the document belongs to.
+
+        Returns:
+            Document: The document, without reading the file again.
+        """
+        document = cls(filepath, collection)
+        super(Document, document).update(data)
+        return document
+
+    @property
+    def dirty(self) -> bool:
+        """Whether the document changed since it was last read or written. True if that isn't known, e.g. for documents yielded by scans."""
+        return self._clean is None or self._serialize() != self._clean
+
+    def _serialize(self) -> str | None:
+        # Compared as json, like update_docs does, so 1 and True or 0 and 0.0 differ.
+        try:
+            return json.dumps(self)
+        except (TypeError, ValueError):
+            return None
+
+    def _mark_clean(self) -> None:
+        # Nested values may be changed in place, so a snapshot is kept rather than a flag.
+        self._clean = self._serialize()
+
+    async def _read(self) -> dict:
+        # Documents of a collection go through its storage, which may not be a file per document.
+        if self.collection is not None:
+            return await self.collection._read_data(self.filepath)
         async with aiofiles.open(self.filepath, mode="r") as f:
-            contents = await f.read()
-            super().__init__(json.loads(contents))
+            text = await f.read()
+        metrics.count_io(read=len(text))
+        return json.loads(text)
+
+    async def _write(self) -> None:
+        if not self.dirty:
+            return
+        if self.collection is not None:
+            await self.collection._write_doc(self)
+        else:
+            text = json.dumps(self)
+            async with aiofiles.open(self.filepath, mode="w") as f:
+                await f.write(text)
+            metrics.count_io(written=len(text))
+        self._mark_clean()
+
+    async def __ainit__(self):
+        super().__init__(await self._read())
+        self._mark_clean()
 
     async def __aenter__(self):
-        async with aiofiles.open(self.filepath, mode="r") as f:
-            contents = await f.read()
-            super().__init__(json.loads(contents))
+        super().__init__(await self._read())
+        self._mark_clean()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        async with aiofiles.open(self.filepath, mode="w") as f:
-            contents = json.dumps(self)
-            await f.write(contents)
-        await self.update(json.loads(contents))
+        await self._write()
 
     async def update(self, update: dict):
         super().update(update)
-        async with aiofiles.open(self.filepath, mode="w") as f:
-            contents = json.dumps(self)
-            await f.write(contents)
+        await self._write()
         return self
 
     async def save(self):
         """Save changes made as dict
 
+        Nothing is written if the document is known not to have changed, see :attr:`dirty`.
+
         Returns:
             Document: self
         """
-        async with aiofiles.open(self.filepath, mode="w") as f:
-            contents = json.dumps(self)
-            await f.write(contents)
+        await self._write()
 
     async def delete(self) -> None:
         """Delete document
@@ -46,5 +104,26 @@ class Document(dict):
         Returns:
             Document: None
         """
+        if self.collection is not None:
+            await self.collection._delete_doc(self.filepath)
+            return
         await aiofiles.os.remove(self.filepath)
         return
+
+
+class Projection(dict):
+    """A read-only document holding only the projected fields.
+
+    Unlike :class:`Document` it isn't tied to a file, it can't be saved or deleted.
+    """
+
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Projected documents are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (Projection, (dict(self),))
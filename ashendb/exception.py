@@ -16,3 +16,35 @@ class InvalidClusterName(Exception):
 
 class InvalidOperator(Exception):
     pass
+
+
+class BulkWriteError(Exception):
+    """Some documents of a bulk write failed.
+
+    Attributes:
+        inserted: The documents which were written.
+        errors: The failed items, as dicts with the ``index`` of the item and the ``error`` raised for it.
+    """
+
+    def __init__(self, message: str, inserted: list = None, errors: list = None):
+        super().__init__(message)
+        self.inserted = inserted or []
+        self.errors = errors or []
+
+
+class VersionConflict(Exception):
+    """A document of a versioned collection was written by someone else since it was read.
+
+    Attributes:
+        id: The id of the document.
+        expected: The version the document was read at.
+        actual: The version it is stored at, None if it was deleted.
+    """
+
+    def __init__(
+        self, message: str, id: str = None, expected: int = None, actual: int = None
+    ):
+        super().__init__(message)
+        self.id = id
+        self.expected = expected
+        self.actual = actual
@@ -0,0 +1,63 @@
+import os
+from typing import Any, Callable
+
+from .backend import get_backend
+
+# Handles of the entries of listed directories, keyed by the normalized path of the
+# directory: (stamp of the directory, name -> handle).
+_listings: dict[str, tuple[Any, dict[str, Any]]] = {}
+
+
+async def get_handles(path: str, factory: Callable[[str], Any]) -> dict[str, Any]:
+    """The handles of the entries of a cluster or database directory, by name.
+
+    The directory is only listed again once its stamp changed, which costs a single ``stat`` on disk and nothing in memory. Entries which are still there keep their handle. Hidden entries hold metadata such as the write-ahead log and are left out.
+
+    Args:
+        path: The path of the directory.
+        factory: Creates the handle of an entry from its name.
+
+    Raises:
+        FileNotFoundError: If the directory does not exist.
+    """
+    key = os.path.normpath(path)
+    backend = get_backend(key)
+    stamp = await backend.stamp(key)
+    listing = _listings.get(key)
+    if listing is not None and listing[0] == stamp:
+        return listing[1]
+    old = listing[1] if listing is not None else {}
+    handles = {
+        name: old[name] if name in old else factory(name)
+        for name in await backend.listdir(key)
+        if not name.startswith(".")
+    }
+    _listings[key] = (stamp, handles)
+    return handles
+
+
+async def add_handle(path: str, name: str, handle: Any) -> None:
+    """Register the handle of an entry created through AshenDB, so the directory isn't listed again."""
+    key = os.path.normpath(path)
+    listing = _listings.get(key)
+    if listing is None:
+        return
+    listing[1][name] = handle
+    _listings[key] = (await get_backend(key).stamp(key), listing[1])
+
+
+async def remove_handle(path: str, name: str) -> None:
+    """Drop the handle of an entry deleted through AshenDB."""
+    key = os.path.normpath(path)
+    entry = os.path.join(key, name)
+    for other in [o for o in _listings if o == entry or o.startswith(entry + os.sep)]:
+        del _listings[other]
+    listing = _listings.pop(key, None)
+    if listing is None:
+        return
+    listing[1].pop(name, None)
+    try:
+        _listings[key] = (await get_backend(key).stamp(key), listing[1])
+    except FileNotFoundError:
+        # Removed with the entry, as it was left empty.
+        pass
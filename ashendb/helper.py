@@ -1,83 +1,396 @@
+import copy
+import json
 import time
+from typing import Any, Callable
 
 from .document import Document
 from .exception import InvalidOperator
 
 
+logical_operators = {
+    "$and": all,
+    "$or": any,
+    "$not": lambda results: not all(results),
+    "$nor": lambda results: not any(results),
+}
+
+comparison_operators = {
+    "$eq": lambda x, y: x == y,
+    "$ne": lambda x, y: x != y,
+    "$gt": lambda x, y: x > y,
+    "$gte": lambda x, y: x >= y,
+    "$lt": lambda x, y: x < y,
+    "$lte": lambda x, y: x <= y,
+    "$in": lambda x, y: x in y,
+    "$nin": lambda x, y: x not in y,
+}
+
+element_operators = {
+    "$exists": lambda x, y: y in x,
+    "$type": lambda x, y: type(x) == y,
+}
+
+evalutation_operators = {
+    "$mod": lambda x, y: x % y[0] == y[1],
+    "$regex": lambda x, y: y.match(x),
+    "$text": lambda x, y: y in x,
+    "$where": lambda x, y: y(x),
+}
+
+geospatial_operators = {
+    "$geoIntersects": lambda x, y: x in y,
+    "$geoWithin": lambda x, y: x in y,
+    "$near": lambda x, y: x in y,
+    "$nearSphere": lambda x, y: x in y,
+}
+
+array_operators = {
+    "$all": lambda x, y: all([i in x for i in y]),
+    "$size": lambda x, y: len(x) == y,
+}
+
+query_operators = {
+    **comparison_operators,
+    **element_operators,
+    **evalutation_operators,
+    **geospatial_operators,
+    **array_operators,
+}
+
+# Compiled predicates, keyed by the frozen query. Oldest entries are dropped first.
+QUERY_CACHE_SIZE = 256
+_query_cache: dict = {}
+
+# Stands for a path missing from a projected document.
+_missing = object()
+
+
+def _path_steps(keycode: str) -> list[str | int]:
+    keys = keycode.split(".")
+    if "]" in keys[-1]:
+        raise Exception("You can't perform operation on a value")
+    steps = []
+    for key in keys[:-1]:
+        if "[" in key:
+            kx, ki = key.split("[")
+            steps.append(kx)
+            steps.append(int(ki[:-1]))
+        else:
+            steps.append(key)
+    steps.append(keys[-1])
+    return steps
+
+
+def compile_path(keycode: str) -> Callable[[dict], Any]:
+    """Compile a dotted key into a getter.
+
+    The getter raises ``KeyError``, ``IndexError`` or ``TypeError`` if the path does not exist in the document.
+
+    Args:
+        keycode: The key to compile, e.g. ``"name.first[0].A"``.
+
+    Raises:
+        Exception: If the key ends with [index].
+
+    Example:
+        >>> getter = compile_path("name.first[0].A")
+        >>> getter({"name": {"first": [{"A": 1}]}})
+        1
+    """
+    *steps, last = _path_steps(keycode)
+
+    if not steps:
+        return lambda document: document[last]
+
+    def getter(document):
+        temp = document
+        for step in steps:
+            temp = temp[step]
+        return temp[last]
+
+    return getter
+
+
+def sort_key(value: Any) -> tuple:
+    """Key used to order values of different types.
+
+    Missing values and None come first, then numbers, then strings, then everything else.
+
+    Example:
+        >>> sorted([3, "a", None, 1.5], key=sort_key)
+        [None, 1.5, 3, 'a']
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, json.dumps(value, sort_keys=True))
+
+
+class _Descending:
+    """Inverts the order of a sort key."""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key: tuple) -> None:
+        self.key = key
+
+    def __eq__(self, other: "_Descending") -> bool:
+        return self.key == other.key
+
+    def __lt__(self, other: "_Descending") -> bool:
+        return other.key < self.key
+
+
+def compile_sort(sort: dict) -> Callable[[dict], tuple]:
+    """Compile a sort specification into a key function.
+
+    Fields are compared in the order of the specification with :func:`sort_key`, documents missing a field sort as None.
+
+    Args:
+        sort: The keys mapped to 1 for ascending or -1 for descending order.
+
+    Raises:
+        ValueError: If a direction is not 1 or -1.
+
+    Example:
+        >>> key = compile_sort({"age": -1, "name": 1})
+        >>> sorted([{"age": 1, "name": "b"}, {"age": 2, "name": "a"}], key=key)
+        [{"age": 2, "name": "a"}, {"age": 1, "name": "b"}]
+    """
+    getters = []
+    for keycode, direction in sort.items():
+        if direction not in (1, -1):
+            raise ValueError(f"Sort direction of '{keycode}' must be 1 or -1")
+        getters.append((compile_path(keycode), direction == -1))
+
+    def key(document):
+        final = []
+        for getter, descending in getters:
+            try:
+                value = getter(document)
+            except (KeyError, IndexError, TypeError):
+                value = None
+            final.append(_Descending(sort_key(value)) if descending else sort_key(value))
+        return tuple(final)
+
+    return key
+
+
+def _freeze(value: Any) -> Any:
+    """Turn a query into a hashable cache key. Raises ``TypeError`` for unhashable values."""
+    if isinstance(value, dict):
+        return (dict, tuple((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    hash(value)
+    return (type(value), value)
+
+
+def _compile_condition(operator: str, keycode: str, value: Any) -> Callable[[dict], bool]:
+    if operator not in query_operators:
+        raise InvalidOperator(f"Unknown operator {operator}")
+    function = query_operators[operator]
+    getter = compile_path(keycode)
+
+    def condition(document):
+        try:
+            current = getter(document)
+        except (KeyError, IndexError, TypeError):
+            return False
+        return function(current, value)
+
+    return condition
+
+
+def _compile_subquery(query: dict) -> Callable[[dict], bool]:
+    conditions = [
+        _compile_condition(operator, keycode, value)
+        for operator, data in query.items()
+        for keycode, value in data.items()
+    ]
+    if len(conditions) == 1:
+        return conditions[0]
+    return lambda document: all(condition(document) for condition in conditions)
+
+
+def _compile_query(query: dict) -> Callable[[dict], bool]:
+    clauses = []
+    for operator, queries in query.items():
+        if operator not in logical_operators:
+            raise InvalidOperator(f"Unknown operator {operator}")
+        reduce = logical_operators[operator]
+        subqueries = [_compile_subquery(qx) for qx in queries]
+        clauses.append(
+            lambda document, reduce=reduce, subqueries=subqueries: reduce(
+                subquery(document) for subquery in subqueries
+            )
+        )
+    if len(clauses) == 1:
+        return clauses[0]
+    return lambda document: all(clause(document) for clause in clauses)
+
+
+def compile_query(query: dict) -> Callable[[dict], bool]:
+    """Compile a query into a plain synchronous predicate.
+
+    Operators are resolved and keys are turned into getters once, so the returned function can be called for every document of a scan without re-walking the query. Compiled queries are cached by their shape.
+
+    Args:
+        query: The query to compile. See :func:`match_data`.
+
+    Raises:
+        InvalidOperator: If the query uses an unknown operator.
+
+    Example:
+        >>> match = compile_query({"$and": [{"$gt": {"age": 18}}]})
+        >>> match({"age": 20})
+        True
+    """
+    try:
+        key = _freeze(query)
+    except TypeError:
+        return _compile_query(query)
+    predicate = _query_cache.get(key)
+    if predicate is None:
+        # The predicate outlives the query it is cached for, which the caller may change
+        # in place later, so it holds a copy of the values.
+        predicate = _compile_query(copy.deepcopy(query))
+        if len(_query_cache) >= QUERY_CACHE_SIZE:
+            del _query_cache[next(iter(_query_cache))]
+        _query_cache[key] = predicate
+    return predicate
+
+
+def _split_projection(projection: dict) -> tuple[list[str], bool]:
+    """The paths of a projection and whether they are included."""
+    included = [key for key, value in projection.items() if value and key != "_id"]
+    excluded = [key for key, value in projection.items() if not value and key != "_id"]
+    if included and excluded:
+        raise ValueError("A projection can't both include and exclude fields")
+    keep_id = bool(projection.get("_id", 1))
+    # {"_id": 1} alone includes only the id, next to exclusions it just keeps it.
+    if included or (keep_id and "_id" in projection and not excluded):
+        return included + (["_id"] if keep_id else []), True
+    return excluded + ([] if keep_id else ["_id"]), False
+
+
+def _projection_tree(paths: list[str]) -> dict:
+    tree = {}
+    for path in paths:
+        *steps, last = _path_steps(path)
+        node = tree
+        for step in steps:
+            node = node.setdefault(step, {})
+            if node is True:
+                # A parent of the path is already projected as a whole.
+                break
+        else:
+            node[last] = True
+    return tree
+
+
+def _include(tree: dict, value: Any) -> Any:
+    if isinstance(value, dict):
+        final = {}
+        for key, node in tree.items():
+            if isinstance(key, str) and key in value:
+                item = value[key] if node is True else _include(node, value[key])
+                if item is not _missing:
+                    final[key] = item
+        return final
+    if isinstance(value, list):
+        positions = sorted(key for key in tree if isinstance(key, int))
+        if positions:
+            return [
+                value[i] if tree[i] is True else _include(tree[i], value[i])
+                for i in positions
+                if -len(value) <= i < len(value)
+            ]
+        # Keys below a list apply to each of its items.
+        return [_include(tree, item) for item in value if isinstance(item, (dict, list))]
+    return _missing
+
+
+def _exclude(tree: dict, value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            key: item if key not in tree else _exclude(tree[key], item)
+            for key, item in value.items()
+            if tree.get(key) is not True
+        }
+    if isinstance(value, list):
+        if any(isinstance(key, int) for key in tree):
+            return [
+                item if i not in tree else _exclude(tree[i], item)
+                for i, item in enumerate(value)
+                if tree.get(i) is not True
+            ]
+        return [_exclude(tree, item) for item in value]
+    return value
+
+
+def projected_fields(projection: dict) -> list[str] | None:
+    """The paths kept by a projection, None if it excludes paths instead.
+
+    Raises:
+        ValueError: If the projection both includes and excludes fields.
+
+    Example:
+        >>> projected_fields({"name.first": 1, "age": 1})
+        ["name.first", "age", "_id"]
+    """
+    paths, include = _split_projection(projection)
+    return paths if include else None
+
+
+def compile_projection(projection: dict) -> Callable[[dict], dict]:
+    """Compile a projection into a function trimming documents.
+
+    Like MongoDB, a projection either includes or excludes paths, ``_id`` is kept unless it is excluded. Paths are dotted keys as understood by :func:`decode_key`, keys below a list apply to each of its items.
+
+    Args:
+        projection: The paths mapped to 1 to include them or to 0 to exclude them.
+
+    Raises:
+        ValueError: If the projection both includes and excludes fields.
+
+    Example:
+        >>> project = compile_projection({"name.first": 1, "_id": 0})
+        >>> project({"_id": "1", "name": {"first": "A", "last": "B"}, "age": 20})
+        {"name": {"first": "A"}}
+    """
+    paths, include = _split_projection(projection)
+    tree = _projection_tree(paths)
+    if include:
+        return lambda document: _include(tree, document)
+    return lambda document: _exclude(tree, document)
+
+
 async def match_data(document: Document or dict, query: dict) -> bool:
-    async def and_operator(document: Document or dict, queries: list) -> bool:
-        # print("Step 3: ", document, queries)
-        truth = True
-        for qx in queries:
-            # print("Step 4: ", qx)
-            res = await match_query(document, qx)
-            truth = truth and res
-        return truth
-
-    async def or_operator(document: Document or dict, queries: list) -> bool:
-        # print("Step 3: ", document, queries)
-        truth = False
-        for qx in queries:
-            # print("Step 4: ", qx)
-            res = await match_query(document, qx)
-            truth = truth or res
-        return truth
-
-    async def not_operator(document: Document or dict, queries: list) -> bool:
-        # print("Step 3: ", document, queries)
-        truth = True
-        for qx in queries:
-            # print("Step 4: ", qx)
-            res = await match_query(document, qx)
-            truth = truth and res
-        return not truth
-
-    async def nor_operator(document: Document or dict, queries: list) -> bool:
-        # print("Step 3: ", document, queries)
-        truth = False
-        for qx in queries:
-            # print("Step 4: ", qx)
-            res = await match_query(document, qx)
-            truth = truth or res
-        return not truth
-
-    logical_operators = {
-        "$and": and_operator,
-        "$or": or_operator,
-        "$not": not_operator,
-        "$nor": nor_operator,
-    }
+    """Match a document with a query made of logical operators.
+
+    Args:
+        document: The document to match.
+        query: The query to match with.
+
+    Raises:
+        InvalidOperator: If the query uses an unknown operator.
 
-    # example:
-    # json1:
-    # {
-    #    "name":{"first": "Ashen"},
-    #   "age": 20,
-    #  "money": 3567
-    # }
-    # json2:
-    # {
-    #    "name":{"first": "Ashen"},
-    #   "age": 30,
-    #  "money": 3567
-    # }
-    # query 1: {
-    #     "$or": [
-    #         {"$eq": {"_id": "1f6fc89a-e641-440b-86dc-ece8af75007d"}},
-    #         {"$eq": {"name": "abc"}},
-    #         {"$eq": {"members.owner": "abc"}},
-    #     ]
-    # }
-    all_true = True
-    for q in query:
-        # print("Step 1: ", q)
-        if q not in logical_operators:
-            raise Exception(f"Unknown operator {q}")
-        # print("Step 2: ", query[q])
-        res = await logical_operators[q](document, query[q])
-        all_true = all_true and res
-
-    return all_true
+    Example:
+        >>> query = {
+        ...     "$or": [
+        ...         {"$eq": {"_id": "1f6fc89a-e641-440b-86dc-ece8af75007d"}},
+        ...         {"$eq": {"name": "abc"}},
+        ...         {"$eq": {"members.owner": "abc"}},
+        ...     ]
+        ... }
+        >>> await match_data({"name": "abc", "age": 20}, query)
+        True
+    """
+    return compile_query(query)(document)
 
 
 async def decode_key(document: Document or dict, data: dict) -> tuple:
@@ -186,102 +499,19 @@ async def match_query(document: Document or dict, query: dict) -> bool:
               -
 
     """
-
-    comparison_operators = {
-        "$eq": lambda x, y: x == y,
-        "$ne": lambda x, y: x != y,
-        "$gt": lambda x, y: x > y,
-        "$gte": lambda x, y: x >= y,
-        "$lt": lambda x, y: x < y,
-        "$lte": lambda x, y: x <= y,
-        "$in": lambda x, y: x in y,
-        "$nin": lambda x, y: x not in y,
-    }
-
-    element_operators = {
-        "$exists": lambda x, y: y in x,
-        "$type": lambda x, y: type(x) == y,
-    }
-    evalutation_operators = {
-        "$mod": lambda x, y: x % y[0] == y[1],
-        "$regex": lambda x, y: y.match(x),
-        "$text": lambda x, y: y in x,
-        "$where": lambda x, y: y(x),
-    }
-    geospatial_operators = {
-        "$geoIntersects": lambda x, y: x in y,
-        "$geoWithin": lambda x, y: x in y,
-        "$near": lambda x, y: x in y,
-        "$nearSphere": lambda x, y: x in y,
-    }
-
-    # async def elemMatch_operator(x, y):
-    #     for i in x:
-    #         if await match_data(i, y):
-    #             return True
-    #     return False
-
-    array_operators = {
-        "$all": lambda x, y: all([i in x for i in y]),
-        # "$elemMatch": elemMatch_operator,
-        "$size": lambda x, y: len(x) == y,
-    }
-
-    query_operators = {
-        **comparison_operators,
-        **element_operators,
-        **evalutation_operators,
-        **geospatial_operators,
-        **array_operators,
-    }
-
-    # example:
-    # json1:
-    # {
-    #    "name.first": "Ashen",
-    #   "age": 20,
-    #  "money": 3567
-    # }
-    # json2:
-    # {
-    #    "name.first": "Ashen",
-    #   "age": 30,
-    #  "money": 3567
-    # }
-    # query =  {
-    #         "$or": [
-    #             {"$eq": {"_id": "1f6fc89a-e641-440b-86dc-ece8af75007d"}},
-    #             {"$eq": {"name": "abc"}},
-    #             {"$eq": {"members.owner": "abc"}},
-    #         ]
-    #     }
-    result = True
-    for operator, data in query.items():
-        # print("Step 5: ", operator, data)
-        if operator not in query_operators:
-            raise Exception(f"Unknown operator {operator}")
-        for keycode, new_value in data.items():
-            # print("Step 6: ", keycode, new_value)
-            parent, key, old_value = await decode_key(document, {keycode: new_value})
-            # print("Step 7: ", parent, key, old_value)
-            # print("step x", result)
-            try:
-                # print("Step 8: ", parent[key], new_value)
-                result = result and query_operators[operator](parent[key], new_value)
-            except KeyError:
-                # print("Step 9: ", False)
-                result = False
-                continue
-    return result
+    return compile_query({"$and": [query]})(document)
 
 
-async def update_data(document: Document or dict, update: dict) -> Document:
+async def update_data(
+    document: Document or dict, update: dict, save: bool = True
+) -> Document:
     """
     Update a document with the given update query.
 
     Args:
         document (Document): The document to update.
         update (dict): The update query.
+        save (bool): Write the document afterwards. If False it is only updated in memory.
 
     Example:
         >>> document = {"name.first": "John", "age": 20}
@@ -431,5 +661,6 @@ async def update_data(document: Document or dict, update: dict) -> Document:
 
             update_operators[operator](parent, key, new_value)
 
-    await document.save()
+    if save:
+        await document.save()
     return document
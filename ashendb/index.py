@@ -0,0 +1,708 @@
+import asyncio
+import json
+import os
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
+from typing import Any, Generator
+
+from .backend import get_backend
+from .helper import compile_path, sort_key
+
+INDEX_DIR = ".indexes"
+
+# The log of an index is compacted into its file once it holds this many records, or
+# more records than the index has entries.
+COMPACT_MIN = 1024
+
+# Loaded indexes, keyed by the normalized collection path and then by field.
+_registry: dict[str, dict[str, "HashIndex | SortedIndex"]] = {}
+# Stamps of the index files the loaded indexes were read from, by collection path.
+_stamps: dict[str, Any] = {}
+# Serialize loading the indexes of a collection with writing them, by collection path.
+_locks: dict[str, asyncio.Lock] = {}
+
+range_operators = ("$gt", "$gte", "$lt", "$lte")
+
+# Stands for a field missing from a document.
+_missing = object()
+
+
+def value_key(value: Any) -> str:
+    """Turn a value into the key it is stored under in an index.
+
+    Values which are equal in Python get the same key, e.g. ``1``, ``1.0`` and ``True``.
+
+    Raises:
+        TypeError: If the value can't be serialized to json.
+
+    Example:
+        >>> value_key({"b": 1.0, "a": True})
+        '{"a": 1, "b": 1}'
+    """
+    return json.dumps(_canonical(value), sort_keys=True)
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+class HashIndex:
+    """Maps the values of a field to the ids of the documents holding them.
+
+    Args:
+        field: The key of the indexed field, e.g. ``"name.first"``.
+    """
+
+    kind = "hash"
+
+    def __init__(self, field: str) -> None:
+        self.field = field
+        self.getter = compile_path(field)
+        self.entries: dict[str, set[str]] = {}
+        self.keys: dict[str, str] = {}
+        # Records appended to the log since the index was saved whole.
+        self.logged = 0
+
+    def add(self, id: str, document: dict) -> bool:
+        """Index a document, replacing whatever was indexed for the id before.
+
+        Returns:
+            Whether the index changed.
+        """
+        try:
+            key = value_key(self.getter(document))
+        except (KeyError, IndexError, TypeError):
+            return self.remove(id)
+        if self.keys.get(id) == key:
+            return False
+        self.remove(id)
+        self.entries.setdefault(key, set()).add(id)
+        self.keys[id] = key
+        return True
+
+    def remove(self, id: str) -> bool:
+        """Remove a document from the index.
+
+        Returns:
+            Whether the index changed.
+        """
+        key = self.keys.pop(id, None)
+        if key is None:
+            return False
+        ids = self.entries[key]
+        ids.discard(id)
+        if not ids:
+            del self.entries[key]
+        return True
+
+    def lookup(self, value: Any) -> set[str]:
+        """Ids of the documents whose field equals the value."""
+        return set(self.entries.get(value_key(value), ()))
+
+    def lookup_many(self, values: list) -> set[str]:
+        """Ids of the documents whose field equals any of the values."""
+        final = set()
+        for value in values:
+            final |= self.entries.get(value_key(value), set())
+        return final
+
+    def count(self, value: Any) -> int:
+        """How many documents have a field equal to the value."""
+        return len(self.entries.get(value_key(value), ()))
+
+    def record(self, id: str) -> list:
+        """The log record of what is indexed for a document, ``["put", id, key]`` or ``["del", id]``."""
+        key = self.keys.get(id)
+        return ["del", id] if key is None else ["put", id, key]
+
+    def replay(self, records: list[list]) -> None:
+        """Apply log records made by :meth:`record`."""
+        for op, id, *entry in records:
+            self.remove(id)
+            if op == "put":
+                self.entries.setdefault(entry[0], set()).add(id)
+                self.keys[id] = entry[0]
+
+    def to_dict(self) -> dict:
+        return {
+            "field": self.field,
+            "kind": self.kind,
+            "entries": {key: sorted(ids) for key, ids in self.entries.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HashIndex":
+        index = cls(data["field"])
+        for key, ids in data["entries"].items():
+            index.entries[key] = set(ids)
+            for id in ids:
+                index.keys[id] = key
+        return index
+
+
+class SortedIndex:
+    """Keeps the ids of the documents ordered by the value of a field.
+
+    Values are ordered with :func:`ashendb.helper.sort_key`, documents missing the field sort as None. The exact value of every document is kept, so queries on indexed fields can be answered without reading the documents. Besides ``$eq`` and ``$in`` it answers ``$gt``, ``$gte``, ``$lt`` and ``$lte`` on numbers and strings, and iterates the documents in order.
+
+    Args:
+        field: The key of the indexed field, e.g. ``"created_at"``.
+    """
+
+    kind = "sorted"
+
+    def __init__(self, field: str) -> None:
+        self.field = field
+        self.getter = compile_path(field)
+        self.entries: list[tuple[tuple, str]] = []
+        self.keys: dict[str, tuple] = {}
+        self.values: dict[str, Any] = {}
+        # Records appended to the log since the index was saved whole.
+        self.logged = 0
+
+    def add(self, id: str, document: dict) -> bool:
+        """Index a document, replacing whatever was indexed for the id before.
+
+        Returns:
+            Whether the index changed.
+        """
+        try:
+            value = self.getter(document)
+        except (KeyError, IndexError, TypeError):
+            value = _missing
+        key = sort_key(None if value is _missing else value)
+        old = self.values.get(id, _missing)
+        if self.keys.get(id) == key and type(old) is type(value) and old == value:
+            return False
+        self.remove(id)
+        insort(self.entries, (key, id))
+        self.keys[id] = key
+        if value is not _missing:
+            self.values[id] = value
+        return True
+
+    def remove(self, id: str) -> bool:
+        """Remove a document from the index.
+
+        Returns:
+            Whether the index changed.
+        """
+        key = self.keys.pop(id, None)
+        if key is None:
+            return False
+        self.values.pop(id, None)
+        del self.entries[bisect_left(self.entries, (key, id))]
+        return True
+
+    def _between(self, lower: tuple, upper: tuple) -> list[tuple[tuple, str]]:
+        start = bisect_left(self.entries, lower, key=itemgetter(0))
+        end = bisect_right(self.entries, upper, key=itemgetter(0))
+        return self.entries[start:end]
+
+    def lookup(self, value: Any) -> set[str]:
+        """Ids of the documents whose field equals the value."""
+        key = sort_key(value)
+        return {id for _, id in self._between(key, key)}
+
+    def lookup_many(self, values: list) -> set[str]:
+        """Ids of the documents whose field equals any of the values."""
+        final = set()
+        for value in values:
+            final |= self.lookup(value)
+        return final
+
+    def count(self, value: Any) -> int:
+        """How many documents have a field equal to the value."""
+        key = sort_key(value)
+        getkey = itemgetter(0)
+        return bisect_right(self.entries, key, key=getkey) - bisect_left(
+            self.entries, key, key=getkey
+        )
+
+    def range(self, conditions: list[tuple[str, Any]]) -> set[str] | None:
+        """Ids of the documents whose field satisfies all the range conditions.
+
+        Args:
+            conditions: Pairs of operator and value, e.g. ``[("$gte", 10), ("$lt", 20)]``.
+
+        Returns:
+            The ids, or None if the conditions don't compare numbers or strings of a single kind.
+        """
+        bounds = self._bounds(conditions)
+        if bounds is None:
+            return None
+        return {id for _, id in self.entries[bounds[0] : bounds[1]]}
+
+    def count_range(self, conditions: list[tuple[str, Any]]) -> int | None:
+        """How many documents have a field satisfying all the range conditions, see :meth:`range`."""
+        bounds = self._bounds(conditions)
+        if bounds is None:
+            return None
+        return max(0, bounds[1] - bounds[0])
+
+    def _bounds(self, conditions: list[tuple[str, Any]]) -> tuple[int, int] | None:
+        ranks = {sort_key(value)[0] for _, value in conditions}
+        if len(ranks) != 1 or not ranks <= {1, 2}:
+            return None
+        rank = ranks.pop()
+        getkey = itemgetter(0)
+        start = bisect_left(self.entries, (rank,), key=getkey)
+        end = bisect_left(self.entries, (rank + 1,), key=getkey)
+        for operator, value in conditions:
+            key = (rank, value)
+            if operator == "$gt":
+                start = max(start, bisect_right(self.entries, key, key=getkey))
+            elif operator == "$gte":
+                start = max(start, bisect_left(self.entries, key, key=getkey))
+            elif operator == "$lt":
+                end = min(end, bisect_left(self.entries, key, key=getkey))
+            elif operator == "$lte":
+                end = min(end, bisect_right(self.entries, key, key=getkey))
+        return start, end
+
+    def record(self, id: str) -> list:
+        """The log record of what is indexed for a document.
+
+        That is ``["put", id, value]``, ``["put", id]`` if the document misses the field, or ``["del", id]``.
+        """
+        if id not in self.keys:
+            return ["del", id]
+        if id in self.values:
+            return ["put", id, self.values[id]]
+        return ["put", id]
+
+    def replay(self, records: list[list]) -> None:
+        """Apply log records made by :meth:`record`.
+
+        A few records are inserted one by one, many records sort the entries once at the end.
+        """
+        bulk = len(records) > len(self.entries) // 64
+        for op, id, *value in records:
+            if bulk:
+                self.keys.pop(id, None)
+                self.values.pop(id, None)
+            else:
+                self.remove(id)
+            if op == "put":
+                key = self.keys[id] = sort_key(value[0] if value else None)
+                if value:
+                    self.values[id] = value[0]
+                if not bulk:
+                    insort(self.entries, (key, id))
+        if bulk:
+            self.entries = sorted((key, id) for id, key in self.keys.items())
+
+    def iter_ids(self, descending: bool = False) -> Generator[str, None, None]:
+        """Iterate over the indexed ids in order."""
+        entries = reversed(self.entries) if descending else self.entries
+        for _, id in list(entries):
+            yield id
+
+    def to_dict(self) -> dict:
+        return {
+            "field": self.field,
+            "kind": self.kind,
+            # Documents missing the field are stored without a value.
+            "entries": [
+                [id, self.values[id]] if id in self.values else [id]
+                for _, id in self.entries
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SortedIndex":
+        index = cls(data["field"])
+        for id, *value in data["entries"]:
+            key = sort_key(value[0] if value else None)
+            index.entries.append((key, id))
+            index.keys[id] = key
+            if value:
+                index.values[id] = value[0]
+        index.entries.sort()
+        return index
+
+
+index_types = {
+    HashIndex.kind: HashIndex,
+    SortedIndex.kind: SortedIndex,
+}
+
+
+def _index_dir(path: str) -> str:
+    return os.path.join(os.path.normpath(path), INDEX_DIR)
+
+
+def _lock(path: str) -> asyncio.Lock:
+    return _locks.setdefault(os.path.normpath(path), asyncio.Lock())
+
+
+async def _stamp(path: str, fields) -> tuple | None:
+    # Changes whenever an index is saved, created or deleted, or a log appended to.
+    directory = _index_dir(path)
+    backend = get_backend(path)
+    try:
+        stamps = [await backend.stamp(directory)]
+    except FileNotFoundError:
+        return None
+    for field in sorted(fields):
+        try:
+            stamps.append(await backend.stamp(os.path.join(directory, f"{field}.log")))
+        except FileNotFoundError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+async def _restamp(key: str) -> None:
+    # After this process wrote index files, whose changes the loaded indexes already hold.
+    if key in _registry:
+        _stamps[key] = await _stamp(key, _registry[key])
+
+
+async def load_indexes(path: str) -> dict[str, HashIndex | SortedIndex]:
+    """Load the indexes of a collection.
+
+    Indexes are read from disk once and shared by every handle of the collection. They are read again once the stamps of their files changed, e.g. because another process wrote to the collection.
+
+    Args:
+        path: The path of the collection.
+    """
+    key = os.path.normpath(path)
+    async with _lock(key):
+        indexes = _registry.get(key)
+        if indexes is not None and _stamps.get(key) == await _stamp(key, indexes):
+            return indexes
+        indexes = {}
+        directory = _index_dir(key)
+        backend = get_backend(key)
+        names = await backend.listdir(directory) if await backend.isdir(directory) else []
+        fields = [name[: -len(".json")] for name in names if name.endswith(".json")]
+        stamp = await _stamp(key, fields)
+        for field in fields:
+            data = json.loads(await backend.read_file(os.path.join(directory, f"{field}.json")))
+            index = index_types[data["kind"]].from_dict(data)
+            try:
+                log = await backend.read_file(os.path.join(directory, f"{field}.log"))
+            except FileNotFoundError:
+                log = b""
+            records = []
+            for line in log.split(b"\n"):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # An empty line, or a record cut short by a crash.
+                    continue
+            index.replay(records)
+            index.logged = len(records)
+            indexes[field] = index
+        _registry[key] = indexes
+        _stamps[key] = stamp
+        return indexes
+
+
+async def _save(key: str, index: HashIndex | SortedIndex) -> None:
+    directory = _index_dir(key)
+    backend = get_backend(key)
+    await backend.makedirs(directory)
+    filepath = os.path.join(directory, f"{index.field}.json")
+    await backend.write_file(filepath, json.dumps(index.to_dict()).encode())
+    # The log only repeats what the saved index holds.
+    try:
+        await backend.remove(os.path.join(directory, f"{index.field}.log"))
+    except FileNotFoundError:
+        pass
+    index.logged = 0
+
+
+async def save_index(path: str, index: HashIndex | SortedIndex) -> None:
+    """Persist a whole index next to the documents of its collection, and add it to the loaded indexes."""
+    key = os.path.normpath(path)
+    async with _lock(key):
+        await _save(key, index)
+        if key in _registry:
+            _registry[key][index.field] = index
+        await _restamp(key)
+
+
+async def log_index(path: str, index: HashIndex | SortedIndex, records: list[list]) -> None:
+    """Persist changes of an index, by appending records made by its :meth:`~HashIndex.record` to its log.
+
+    A write costs the size of its records rather than of the whole index. Records hold the state of a document in the index rather than a change, so replaying one twice is harmless. Once the log holds more records than the index has entries, or :data:`COMPACT_MIN`, the index is saved whole and the log starts over.
+
+    Args:
+        path: The path of the collection.
+        index: The index the records were taken from, right after it was changed.
+        records: The records.
+    """
+    key = os.path.normpath(path)
+    async with _lock(key):
+        indexes = _registry.get(key)
+        if indexes is not None and index.field not in indexes:
+            # The index was dropped meanwhile.
+            return
+        directory = _index_dir(key)
+        backend = get_backend(key)
+        await backend.makedirs(directory)
+        data = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+        await backend.append_file(os.path.join(directory, f"{index.field}.log"), data)
+        if indexes is not None and indexes[index.field] is not index:
+            # The indexes were reloaded between the change and its record being written.
+            index = indexes[index.field]
+            index.replay(records)
+        index.logged += len(records)
+        if index.logged >= max(COMPACT_MIN, len(index.keys)):
+            await _save(key, index)
+        await _restamp(key)
+
+
+async def delete_index(path: str, field: str) -> None:
+    """Remove a persisted index, and drop it from the loaded indexes."""
+    key = os.path.normpath(path)
+    backend = get_backend(key)
+    async with _lock(key):
+        await backend.remove(os.path.join(_index_dir(key), f"{field}.json"))
+        try:
+            await backend.remove(os.path.join(_index_dir(key), f"{field}.log"))
+        except FileNotFoundError:
+            pass
+        _registry.get(key, {}).pop(field, None)
+        await _restamp(key)
+
+
+def forget_indexes(path: str) -> None:
+    """Drop the loaded indexes of a collection, e.g. after it was deleted."""
+    key = os.path.normpath(path)
+    _registry.pop(key, None)
+    _stamps.pop(key, None)
+    _locks.pop(key, None)
+
+
+def candidate_ids(
+    query: dict, indexes: dict[str, HashIndex | SortedIndex]
+) -> set[str] | None:
+    """Narrow a query down to the documents it can match, using indexes.
+
+    ``$eq`` and ``$in`` use any index on the key, ``$gt``, ``$gte``, ``$lt`` and ``$lte`` use sorted indexes. The documents still have to be matched against the query, the result is a superset of the matches.
+
+    Args:
+        query: The query. See :func:`ashendb.helper.match_data`.
+        indexes: The indexes of the collection.
+
+    Returns:
+        The candidate ids, or None if the whole collection has to be scanned.
+    """
+    if not indexes:
+        return None
+    sets = []
+    for operator, queries in query.items():
+        if operator == "$and":
+            conditions = [c for qx in queries for c in _conditions(qx)]
+            ids = _conjunction_candidates(conditions, indexes)
+            if ids is not None:
+                sets.append(ids)
+        elif operator == "$or" and queries:
+            union = set()
+            for qx in queries:
+                ids = _conjunction_candidates(_conditions(qx), indexes)
+                if ids is None:
+                    union = None
+                    break
+                union |= ids
+            if union is not None:
+                sets.append(union)
+    if not sets:
+        return None
+    return set.intersection(*sets)
+
+
+def used_indexes(query: dict, indexes: dict[str, HashIndex | SortedIndex]) -> list[str]:
+    """The keys whose indexes :func:`candidate_ids` narrows a query down with.
+
+    Example:
+        >>> used_indexes({"$and": [{"$eq": {"name": "A"}}, {"$gt": {"age": 18}}]}, indexes)
+        ["name"]
+    """
+
+    def usable(conditions: list[tuple[str, str, Any]]) -> set[str]:
+        keys = set()
+        for operator, keycode, value in conditions:
+            index = indexes.get(keycode)
+            if index is None:
+                continue
+            if (
+                operator == "$eq"
+                or (operator == "$in" and isinstance(value, (list, tuple, set)))
+                or (operator in range_operators and index.kind == SortedIndex.kind)
+            ):
+                keys.add(keycode)
+        return keys
+
+    used = set()
+    for operator, queries in query.items():
+        if operator == "$and":
+            used |= usable([c for qx in queries for c in _conditions(qx)])
+        elif operator == "$or" and queries:
+            branches = [usable(_conditions(qx)) for qx in queries]
+            # A branch without an index means the whole collection is scanned anyway.
+            if all(branches):
+                used = used.union(*branches)
+    return sorted(used)
+
+
+def query_fields(query: dict) -> set[str]:
+    """The keys a query looks at.
+
+    Example:
+        >>> query_fields({"$and": [{"$gt": {"age": 18}}, {"$eq": {"name.first": "A"}}]})
+        {"age", "name.first"}
+    """
+    return {
+        keycode
+        for queries in query.values()
+        for qx in queries
+        for _, keycode, _ in _conditions(qx)
+    }
+
+
+def covering_indexes(
+    fields: set[str], indexes: dict[str, HashIndex | SortedIndex]
+) -> dict[str, SortedIndex] | None:
+    """The sorted indexes holding every one of the fields.
+
+    Hash indexes only keep a canonical key of the values, so they can't stand in for the documents.
+
+    Returns:
+        The indexes by field, or None if some field isn't covered.
+    """
+    found = {}
+    for field in fields:
+        index = indexes.get(field)
+        if index is None or index.kind != SortedIndex.kind or "[" in field:
+            return None
+        found[field] = index
+    return found
+
+
+def _conditions(query: dict) -> list[tuple[str, str, Any]]:
+    return [
+        (operator, keycode, value)
+        for operator, data in query.items()
+        for keycode, value in data.items()
+    ]
+
+
+def _exact(index: HashIndex | SortedIndex, values: list) -> bool:
+    # Hash keys are equal exactly when the values are. Sorted indexes compare other
+    # values by their json, and treat a missing field as None.
+    return index.kind == HashIndex.kind or all(
+        sort_key(value)[0] in (1, 2) for value in values
+    )
+
+
+def _conjunction_candidates(
+    conditions: list[tuple[str, str, Any]],
+    indexes: dict[str, HashIndex | SortedIndex],
+    exact: bool = False,
+) -> set[str] | None:
+    sets = []
+    ranges = {}
+    for operator, keycode, value in conditions:
+        index = indexes.get(keycode)
+        used = False
+        if index is not None:
+            try:
+                if operator == "$eq":
+                    sets.append(index.lookup(value))
+                    used = _exact(index, [value])
+                elif operator == "$in" and isinstance(value, (list, tuple, set)):
+                    sets.append(index.lookup_many(value))
+                    used = _exact(index, value)
+                elif operator in range_operators and index.kind == SortedIndex.kind:
+                    ranges.setdefault(keycode, []).append((operator, value))
+                    used = True
+            except TypeError:
+                pass
+        if exact and not used:
+            return None
+    for keycode, bounds in ranges.items():
+        ids = indexes[keycode].range(bounds)
+        if ids is not None:
+            sets.append(ids)
+        elif exact:
+            return None
+    if not sets:
+        return None
+    return set.intersection(*sets)
+
+
+def matching_ids(
+    query: dict, indexes: dict[str, HashIndex | SortedIndex]
+) -> set[str] | None:
+    """The ids of the documents matching a query, if the indexes answer it exactly.
+
+    That is when every condition is an ``$eq`` or ``$in`` on an indexed key, or a range on a sorted index, combined with ``$and`` and ``$or``.
+
+    Returns:
+        The ids, or None if the documents have to be matched.
+    """
+    if not indexes:
+        return None
+    sets = []
+    for operator, queries in query.items():
+        if operator == "$and":
+            conditions = [c for qx in queries for c in _conditions(qx)]
+            ids = _conjunction_candidates(conditions, indexes, exact=True)
+        elif operator == "$or" and queries:
+            ids = set()
+            for qx in queries:
+                branch = _conjunction_candidates(_conditions(qx), indexes, exact=True)
+                if branch is None:
+                    return None
+                ids |= branch
+        else:
+            return None
+        if ids is None:
+            return None
+        sets.append(ids)
+    if not sets:
+        return None
+    return set.intersection(*sets)
+
+
+def count_matches(query: dict, indexes: dict[str, HashIndex | SortedIndex]) -> int | None:
+    """Count the documents matching a query, if the indexes answer it exactly.
+
+    A query on a single key is counted from the cardinalities of the index, without collecting ids. See :func:`matching_ids`.
+
+    Returns:
+        The count, or None if the documents have to be matched.
+    """
+    if not indexes:
+        return None
+    if list(query) == ["$and"]:
+        conditions = [c for qx in query["$and"] for c in _conditions(qx)]
+        keycodes = {keycode for _, keycode, _ in conditions}
+        index = indexes.get(keycodes.pop()) if len(keycodes) == 1 else None
+        try:
+            if index is not None and len(conditions) == 1:
+                operator, _, value = conditions[0]
+                if operator == "$eq" and _exact(index, [value]):
+                    return index.count(value)
+            if index is not None and index.kind == SortedIndex.kind:
+                if all(operator in range_operators for operator, _, _ in conditions):
+                    count = index.count_range(
+                        [(operator, value) for operator, _, value in conditions]
+                    )
+                    if count is not None:
+                        return count
+        except TypeError:
+            pass
+    ids = matching_ids(query, indexes)
+    return None if ids is None else len(ids)
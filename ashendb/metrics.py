@@ -0,0 +1,244 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import aclosing
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets in seconds, from 10 microseconds up to about 20
+# seconds. Slower calls fall into a last, unbounded bucket.
+BUCKETS = tuple(1e-5 * 2**i for i in range(22))
+
+COUNTERS = ("files_opened", "bytes_read", "bytes_written", "cache_hits", "cache_misses")
+
+enabled = False
+
+# Operations and counters may be recorded from the threads files are read in.
+_lock = threading.Lock()
+_histograms: dict[str, "Histogram"] = {}
+_counters: dict[str, int] = dict.fromkeys(COUNTERS, 0)
+_hooks: list[Callable[[str, float, BaseException | None], None]] = []
+
+
+class Histogram:
+    """The latencies of an operation, in exponential buckets."""
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, seconds: float, error: bool = False) -> None:
+        low, high = 0, len(BUCKETS)
+        while low < high:
+            middle = (low + high) // 2
+            if BUCKETS[middle] < seconds:
+                low = middle + 1
+            else:
+                high = middle
+        self.buckets[low] += 1
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """The upper bound of the bucket holding the ``q`` quantile, at most the slowest call."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                bound: count
+                for bound, count in zip(BUCKETS + (float("inf"),), self.buckets)
+                if count
+            },
+        }
+
+
+def enable_metrics() -> None:
+    """Start recording operations and counters.
+
+    Every public coroutine and async generator of :class:`~ashendb.client.AshenDB`, :class:`~ashendb.database.Database`, :class:`~ashendb.collection.Collection` and :class:`~ashendb.document.Document` is timed into the histogram of its operation, e.g. ``"Collection.get_doc"``, and counted as an error if it raised. Counters keep track of the files opened, the bytes read from and written to them, and the hits and misses of document caches. While metrics are disabled, which is the default, recording costs a function call and a flag check.
+
+    Example:
+        >>> enable_metrics()
+        >>> doc = await coll.get_doc("1")
+        >>> get_metrics()["operations"]["Collection.get_doc"]["count"]
+        1
+    """
+    global enabled
+    enabled = True
+
+
+def disable_metrics() -> None:
+    """Stop recording. What was recorded so far is kept, see :func:`reset_metrics`."""
+    global enabled
+    enabled = False
+
+
+def reset_metrics() -> None:
+    """Forget every recorded operation and counter."""
+    with _lock:
+        _histograms.clear()
+        _counters.update(dict.fromkeys(COUNTERS, 0))
+
+
+def get_metrics() -> dict:
+    """A snapshot of the metrics, safe to serialize to json.
+
+    Returns:
+        dict: Whether metrics are ``enabled``, the ``operations`` by name with their ``count``, ``errors``, ``total``, ``mean``, ``min`` and ``max`` seconds, ``p50``, ``p90`` and ``p99`` estimated from the buckets and the non-empty ``buckets`` by upper bound, and the ``counters``.
+
+    Example:
+        >>> get_metrics()
+        {"enabled": True, "operations": {"Collection.get_doc": {"count": 3, "errors": 0, "total": 0.0012, "mean": 0.0004, "min": 0.0003, "max": 0.0005, "p50": 0.00032, "p90": 0.0005, "p99": 0.0005, "buckets": {0.00032: 2, 0.00064: 1}}}, "counters": {"files_opened": 3, "bytes_read": 216, "bytes_written": 0, "cache_hits": 0, "cache_misses": 0}}
+    """
+    with _lock:
+        return {
+            "enabled": enabled,
+            "operations": {
+                name: histogram.snapshot()
+                for name, histogram in sorted(_histograms.items())
+            },
+            "counters": dict(_counters),
+        }
+
+
+def add_hook(hook: Callable[[str, float, BaseException | None], None]) -> None:
+    """Call a function after every recorded operation, e.g. to export it to a monitoring system.
+
+    The hook gets the name of the operation, its duration in seconds and the exception it raised, or None. It runs in the caller of the operation, so it should be quick. Exceptions raised by hooks are logged and don't fail the operation.
+
+    Example:
+        >>> add_hook(lambda name, seconds, error: statsd.timing(name, seconds * 1000))
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[str, float, BaseException | None], None]) -> None:
+    """Stop calling a hook added with :func:`add_hook`.
+
+    Raises:
+        ValueError: If the hook wasn't added.
+    """
+    _hooks.remove(hook)
+
+
+def record(name: str, seconds: float, error: BaseException | None = None) -> None:
+    """Record a call of an operation, even while metrics are disabled."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds, error is not None)
+    for hook in list(_hooks):
+        try:
+            hook(name, seconds, error)
+        except Exception:
+            logger.exception("Metrics hook %r failed", hook)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Add to a counter, if metrics are enabled."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def count_io(read: int = 0, written: int = 0) -> None:
+    """Count a file opened by AshenDB with the bytes read from and written to it, if metrics are enabled."""
+    if not enabled:
+        return
+    with _lock:
+        _counters["files_opened"] += 1
+        _counters["bytes_read"] += read
+        _counters["bytes_written"] += written
+
+
+async def _timed(name: str, coroutine) -> Any:
+    start = time.perf_counter()
+    try:
+        result = await coroutine
+    except BaseException as e:
+        record(name, time.perf_counter() - start, e)
+        raise
+    record(name, time.perf_counter() - start)
+    return result
+
+
+async def _timed_iteration(name: str, generator) -> Any:
+    # The whole iteration is one operation, including the time the consumer spends
+    # between items.
+    start = time.perf_counter()
+    try:
+        async with aclosing(generator) as items:
+            async for item in items:
+                yield item
+    except GeneratorExit:
+        # The consumer stopped early, e.g. at a limit.
+        record(name, time.perf_counter() - start)
+        raise
+    except BaseException as e:
+        record(name, time.perf_counter() - start, e)
+        raise
+    record(name, time.perf_counter() - start)
+
+
+def instrument(name: str, function: Callable) -> Callable:
+    """Wrap a coroutine or async generator function so its calls are recorded as ``name``.
+
+    While metrics are disabled the wrapper returns the coroutine or generator of ``function`` untouched.
+    """
+    if inspect.isasyncgenfunction(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            return _timed_iteration(name, function(*args, **kwargs))
+
+    else:
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            return _timed(name, function(*args, **kwargs))
+
+    return wrapper
+
+
+def instrumented(cls: type) -> type:
+    """Instrument the public coroutine and async generator methods of a class, see :func:`instrument`."""
+    for attribute, function in list(vars(cls).items()):
+        if attribute.startswith("_"):
+            continue
+        if inspect.iscoroutinefunction(function) or inspect.isasyncgenfunction(function):
+            setattr(cls, attribute, instrument(f"{cls.__name__}.{attribute}", function))
+    return cls
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Generator
+
+from .codec import read_document
+from .helper import compile_query
+
+logger = logging.getLogger(__name__)
+
+# The pool is started on first use and reused by every collection.
+_pool: ProcessPoolExecutor | None = None
+_max_workers: int | None = None
+# Set once the workers died, scans then run in this process until start_pool is called.
+_broken = False
+
+
+def start_pool(max_workers: int | None = None) -> ProcessPoolExecutor:
+    """Start the process pool used to scan collections, replacing any running one.
+
+    Workers are spawned rather than forked. A fork would copy the event loop, the locks and the threads of the calling process into every worker. Spawned workers import the main module of the program again, so a script must start its work under ``if __name__ == "__main__":``. Otherwise every worker runs the script itself and the pool breaks, after which scans fall back to this process, see :func:`scan`.
+
+    Args:
+        max_workers: The number of worker processes. Defaults to the number of CPUs.
+
+    Example:
+        >>> async def main():
+        ...     coll = await db.get_coll("test")
+        ...     coll.use_processes = True
+        ...     docs = await coll.get_docs(query={"$and": [{"$gte": {"age": 18}}]})
+        >>> if __name__ == "__main__":
+        ...     asyncio.run(main())
+    """
+    global _pool, _max_workers, _broken
+    shutdown_pool()
+    _broken = False
+    _max_workers = max_workers
+    _pool = ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    return _pool
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """The running process pool, started if needed."""
+    if _pool is None:
+        return start_pool(_max_workers)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    """Stop the worker processes. The pool is started again when needed."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def picklable(query: dict) -> bool:
+    """Whether a query can be sent to worker processes, e.g. ``$where`` with a lambda can't."""
+    try:
+        pickle.dumps(query)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def scan_chunk(paths: list[str], query: dict, with_data: bool = True) -> list:
+    """Read, parse and match a chunk of documents. Runs in a worker process.
+
+    Args:
+        paths: The paths of the document files.
+        query: The query to match the documents with.
+        with_data: Return the parsed documents, not only their paths.
+
+    Returns:
+        The ``(path, data)`` pairs of the matching documents, or only their paths.
+    """
+    match = compile_query(query)
+    final = []
+    for path in paths:
+        try:
+            data = read_document(path)
+        except FileNotFoundError:
+            continue
+        if match(data):
+            final.append((path, data) if with_data else path)
+    return final
+
+
+async def scan(
+    paths: list[str], query: dict, chunk_size: int, with_data: bool = True
+) -> Generator[list, None, None]:
+    """Match documents in worker processes, chunk by chunk.
+
+    The results of every chunk are yielded in the order of the paths. Only twice as many chunks as there are workers are queued at once.
+
+    If the workers die, e.g. because the main module has no ``if __name__ == "__main__":`` guard, the pool is shut down and the remaining chunks, as well as later scans, are matched in a thread of this process instead. :func:`start_pool` tries the workers again.
+
+    Args:
+        paths: The paths of the document files.
+        query: The query to match the documents with.
+        chunk_size: How many files each worker handles at once.
+        with_data: Return the parsed documents, not only their paths.
+    """
+    global _broken
+    loop = asyncio.get_running_loop()
+    chunks = [paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    window = 2 * (_max_workers or os.cpu_count() or 1)
+    pending = deque()
+    # How many chunks were yielded.
+    done = 0
+    try:
+        if not _broken:
+            pool = get_pool()
+            for chunk in chunks:
+                pending.append(
+                    loop.run_in_executor(pool, scan_chunk, chunk, query, with_data)
+                )
+                if len(pending) >= window:
+                    result = await pending.popleft()
+                    done += 1
+                    yield result
+            while pending:
+                result = await pending.popleft()
+                done += 1
+                yield result
+            return
+    except BrokenProcessPool:
+        logger.warning(
+            "Scan workers died, scanning in this process instead. Is the main module "
+            "missing an if __name__ == '__main__': guard?"
+        )
+        _broken = True
+        shutdown_pool()
+    finally:
+        for future in pending:
+            future.cancel()
+    for chunk in chunks[done:]:
+        yield await loop.run_in_executor(None, scan_chunk, chunk, query, with_data)
@@ -0,0 +1,854 @@
+import asyncio
+import json
+import os
+import shutil
+from collections import deque
+from itertools import islice
+from typing import Generator
+from uuid import uuid4
+
+import aiofiles
+import aiofiles.os as aios
+
+from . import metrics
+from .backend import MemoryBackend, get_backend, memory
+from .codec import (
+    JsonCodec,
+    decode,
+    load_codec,
+    open_buffer,
+    read_document,
+    save_codec,
+)
+from .exception import AlreadyExists, NotFound
+from .wal import LoggedStorage, get_wal
+
+SEGMENT_DIR = ".segments"
+
+# Opened storages, keyed by the normalized collection path.
+_storages: dict[str, "DirectoryStorage | SegmentStorage"] = {}
+# Held while a storage is opened, so concurrent first accesses share one storage.
+_opening: dict[str, asyncio.Lock] = {}
+
+
+def _fsync(paths: list[str], directory: str) -> None:
+    # Files which are gone were deleted, the directory makes that durable.
+    for path in paths + [directory]:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        except PermissionError:
+            # Directories can't be opened on Windows, nor need to be synced there.
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class DirectoryStorage:
+    """Stores every document in its own ``{id}.json`` file. This is the default.
+
+    The files keep their name whatever codec they are encoded with.
+
+    Args:
+        path: The path of the collection directory.
+        codec: Encodes the written documents, json by default. See :mod:`ashendb.codec`.
+    """
+
+    kind = "directory"
+
+    def __init__(self, path: str, codec=None) -> None:
+        self.path = path
+        self.codec = codec or JsonCodec()
+        # The number of documents and the stamp of the directory it was counted at.
+        self.counted: tuple[tuple, int] | None = None
+
+    def doc_path(self, id: str) -> str:
+        return os.path.join(self.path, f"{id}.json")
+
+    async def ids(self) -> list[str]:
+        """The ids of all documents, in directory order."""
+        # Hidden entries hold collection metadata such as indexes.
+        return [
+            file.name.removesuffix(".json")
+            for file in await aios.scandir(self.path)
+            if not file.name.startswith(".") and file.is_file()
+        ]
+
+    async def _stamp(self) -> tuple:
+        stat = await aios.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    async def count(self) -> int:
+        """The number of documents.
+
+        The directory is only listed again once its ``(mtime, size)`` changed, writes made through the storage keep the count up to date.
+        """
+        stamp = await self._stamp()
+        if self.counted is not None and self.counted[0] == stamp:
+            return self.counted[1]
+        count = len(await self.ids())
+        self.counted = (stamp, count)
+        return count
+
+    async def _before(self) -> tuple | None:
+        # The stamp before a write made through the storage, None if no count is kept.
+        return None if self.counted is None else await self._stamp()
+
+    async def _adjust(self, before: tuple | None, delta: int | None) -> None:
+        # Called after a write made through the storage, with the stamp _before took and
+        # the change of the number of documents, or None if it isn't known. The count is
+        # only kept if nothing else changed the directory since it was taken.
+        if before is None:
+            return
+        stamp = await self._stamp()
+        # Another writer may have dropped the count meanwhile.
+        counted = self.counted
+        if counted is None:
+            return
+        if delta is not None and counted[0] == before:
+            self.counted = (stamp, counted[1] + delta)
+        else:
+            self.counted = None
+
+    async def exists(self, id: str) -> bool:
+        return await aios.path.exists(self.doc_path(id))
+
+    async def read(self, id: str) -> dict:
+        """Read a document.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        try:
+            return await aios.wrap(read_document)(self.doc_path(id))
+        except FileNotFoundError:
+            raise NotFound("No document found")
+
+    async def read_raw(self, id: str) -> bytes:
+        """Read a document without decoding it.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        try:
+            async with aiofiles.open(self.doc_path(id), "rb") as f:
+                raw = await f.read()
+        except FileNotFoundError:
+            raise NotFound("No document found")
+        metrics.count_io(read=len(raw))
+        return raw
+
+    async def _read_or_none(self, id: str) -> tuple[str, dict | None]:
+        try:
+            return id, await self.read(id)
+        except NotFound:
+            return id, None
+
+    async def read_many(
+        self, ids: list[str], concurrency: int = 16, ordered: bool = True
+    ) -> Generator[tuple[str, dict], None, None]:
+        """Read documents, skipping the ones which don't exist.
+
+        Up to ``concurrency`` files are read at once. The next read only starts once the consumer has taken a result, so a slow consumer holds back the scan.
+
+        Args:
+            ids: The ids of the documents.
+            concurrency: How many files are read at once.
+            ordered: Yield the documents in the order of the ids. If False they are yielded as soon as they are read.
+
+        Yields:
+            The ``(id, data)`` pairs.
+        """
+        ids = iter(ids)
+        concurrency = max(1, concurrency)
+        if concurrency == 1:
+            for id in ids:
+                id, data = await self._read_or_none(id)
+                if data is not None:
+                    yield id, data
+            return
+
+        pending = deque(
+            asyncio.create_task(self._read_or_none(id))
+            for id in islice(ids, concurrency)
+        )
+        try:
+            while pending:
+                if ordered:
+                    done = [await pending.popleft()]
+                else:
+                    finished, _ = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in finished:
+                        pending.remove(task)
+                    done = [task.result() for task in finished]
+                for id in islice(ids, len(done)):
+                    pending.append(asyncio.create_task(self._read_or_none(id)))
+                for id, data in done:
+                    if data is not None:
+                        yield id, data
+        finally:
+            # Cancelling a read could leak the file it is opening, let them finish instead.
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def write(self, id: str, data: dict) -> None:
+        """Write a document, replacing it atomically.
+
+        Large documents are read through a memory map, see :func:`ashendb.codec.open_buffer`. Truncating the file in place would kill a process reading it with SIGBUS, so the file is always replaced.
+        """
+        await self.rewrite(id, data)
+
+    async def rewrite(self, id: str, data: dict) -> None:
+        """Replace a document atomically, through a temporary file.
+
+        Every write has a temporary file of its own, so concurrent writers of a document don't race on it, the last one to finish wins.
+        """
+        # Hidden, so listing the documents skips it.
+        temp = os.path.join(self.path, f".{id}.{uuid4().hex}.tmp")
+        body = self.codec.encode(data)
+        try:
+            async with aiofiles.open(temp, "wb") as f:
+                await f.write(body)
+            metrics.count_io(written=len(body))
+            before = await self._before()
+            # Only a replaced document leaves the count unchanged.
+            existed = before is not None and await self.exists(id)
+            await aios.replace(temp, self.doc_path(id))
+        except BaseException:
+            try:
+                await aios.remove(temp)
+            except FileNotFoundError:
+                pass
+            raise
+        await self._adjust(before, 0 if existed else None)
+
+    async def sync(self, ids: list[str]) -> None:
+        """Flush written documents to disk, along with the directory so their creation, replacement or deletion is durable too."""
+        await aios.wrap(_fsync)([self.doc_path(id) for id in ids], self.path)
+
+    async def create(self, id: str, data: dict) -> None:
+        """Write a new document.
+
+        The file is opened in exclusive mode, so checking that it doesn't exist costs no extra call and can't race with another writer.
+
+        Raises:
+            AlreadyExists: If the document already exists.
+        """
+        body = self.codec.encode(data)
+        before = await self._before()
+        try:
+            async with aiofiles.open(self.doc_path(id), "xb") as f:
+                await f.write(body)
+        except FileExistsError:
+            raise AlreadyExists("Document already exist")
+        metrics.count_io(written=len(body))
+        await self._adjust(before, 1)
+
+    async def delete(self, id: str) -> None:
+        """Delete a document.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        before = await self._before()
+        try:
+            await aios.remove(self.doc_path(id))
+        except FileNotFoundError:
+            raise NotFound("No document found")
+        await self._adjust(before, -1)
+
+
+class SegmentStorage:
+    """Appends documents to segment files inside ``.segments``.
+
+    Every write appends a record to the active segment and moves the document's entry in an in-memory id -> offset map, which is rebuilt from the segments when the collection is opened. Once the older segments are mostly made of overwritten or deleted records they are compacted in the background.
+
+    A record is made of a json header ``["put", id, length]`` or ``["del", id, 0]``, a tab, the encoded document of that length and a newline. Records written before the length was added end at the first newline.
+
+    Args:
+        path: The path of the collection directory.
+        segment_size: The size in bytes after which a new segment is started.
+        compact_ratio: Compact once this share of the sealed segments is dead.
+        codec: Encodes the written documents, json by default. See :mod:`ashendb.codec`.
+    """
+
+    kind = "segment"
+
+    def __init__(
+        self,
+        path: str,
+        segment_size: int = 4 * 1024 * 1024,
+        compact_ratio: float = 0.5,
+        codec=None,
+    ) -> None:
+        self.path = path
+        self.codec = codec or JsonCodec()
+        self.directory = os.path.join(path, SEGMENT_DIR)
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        # id -> (segment, offset of the document, length of the document, length of the record)
+        self.locations: dict[str, tuple[str, int, int, int]] = {}
+        # segment -> [total bytes, live bytes]
+        self.segments: dict[str, list[int]] = {}
+        self.lock = asyncio.Lock()
+        self.loaded = False
+        self.compaction: asyncio.Task | None = None
+        # Segments appended to since the last sync.
+        self.unsynced: set[str] = set()
+
+    def doc_path(self, id: str) -> str:
+        # Documents have no file of their own, the path only identifies them.
+        return os.path.join(self.path, f"{id}.json")
+
+    @staticmethod
+    def segment_name(sequence: int, generation: int = 0) -> str:
+        return f"{sequence:08d}-{generation:04d}.seg"
+
+    @staticmethod
+    def _sequence(name: str) -> int:
+        return int(name[:8])
+
+    @staticmethod
+    def _generation(name: str) -> int:
+        return int(name[9:13])
+
+    @property
+    def active(self) -> str | None:
+        return max(self.segments) if self.segments else None
+
+    async def load(self) -> None:
+        """Rebuild the id -> offset map from the segments. Called on first use."""
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            await aios.makedirs(self.directory, exist_ok=True)
+            names = sorted(
+                name for name in await aios.listdir(self.directory) if name.endswith(".seg")
+            )
+            for name in names:
+                await aios.wrap(self._replay)(name)
+            self.loaded = True
+
+    def _replay(self, name: str) -> None:
+        filepath = os.path.join(self.directory, name)
+        with open_buffer(filepath) as contents:
+            end = self._scan(name, contents)
+        if end is not None:
+            # A write was cut off, drop it so the next append starts on a new record.
+            os.truncate(filepath, end)
+
+    def _scan(self, name: str, contents: bytes) -> int | None:
+        # Returns the offset the segment has to be truncated at, if any.
+        stats = self.segments.setdefault(name, [0, 0])
+        offset = 0
+        while offset < len(contents):
+            end = -1
+            tab = contents.find(b"\t", offset)
+            if tab != -1:
+                op, id, *size = json.loads(contents[offset:tab])
+                if size:
+                    end = tab + 1 + size[0]
+                    if contents[end : end + 1] != b"\n":
+                        end = -1
+                else:
+                    end = contents.find(b"\n", tab)
+            if end == -1:
+                return offset
+            length = end + 1 - offset
+            self._forget(id)
+            if op == "put":
+                self.locations[id] = (name, tab + 1, end - tab - 1, length)
+                stats[1] += length
+            stats[0] += length
+            offset = end + 1
+
+    def _forget(self, id: str) -> None:
+        location = self.locations.pop(id, None)
+        if location is not None:
+            self.segments[location[0]][1] -= location[3]
+
+    async def _append(
+        self, op: str, id: str, body: bytes, exclusive: bool = False
+    ) -> None:
+        header = json.dumps([op, id, len(body)]).encode()
+        record = header + b"\t" + body + b"\n"
+        async with self.lock:
+            if exclusive and id in self.locations:
+                raise AlreadyExists("Document already exist")
+            name = self.active
+            if name is None or (
+                self.segments[name][0] > 0
+                and self.segments[name][0] + len(record) > self.segment_size
+            ):
+                name = self.segment_name(self._sequence(name) + 1 if name else 1)
+                self.segments[name] = [0, 0]
+            async with aiofiles.open(os.path.join(self.directory, name), "ab") as f:
+                offset = await f.tell()
+                await f.write(record)
+            metrics.count_io(written=len(record))
+            self.unsynced.add(name)
+            self._forget(id)
+            stats = self.segments[name]
+            stats[0] += len(record)
+            if op == "put":
+                start = offset + len(header) + 1
+                self.locations[id] = (name, start, len(body), len(record))
+                stats[1] += len(record)
+        self._maybe_compact()
+
+    async def ids(self) -> list[str]:
+        """The ids of all documents, in storage order."""
+        await self.load()
+        return sorted(self.locations, key=self.locations.__getitem__)
+
+    async def count(self) -> int:
+        await self.load()
+        return len(self.locations)
+
+    async def exists(self, id: str) -> bool:
+        await self.load()
+        return id in self.locations
+
+    async def read(self, id: str) -> dict:
+        """Read a document.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        await self.load()
+        # A compaction may remove the segment between the lookup and the read, retry once.
+        for _ in range(2):
+            location = self.locations.get(id)
+            if location is None:
+                break
+            name, offset, length, _ = location
+            try:
+                return await aios.wrap(read_document)(
+                    os.path.join(self.directory, name), offset, length
+                )
+            except FileNotFoundError:
+                continue
+        raise NotFound("No document found")
+
+    async def read_raw(self, id: str) -> bytes:
+        """Read a document without decoding it.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        await self.load()
+        for _ in range(2):
+            location = self.locations.get(id)
+            if location is None:
+                break
+            name, offset, length, _ = location
+            try:
+                async with aiofiles.open(os.path.join(self.directory, name), "rb") as f:
+                    await f.seek(offset)
+                    raw = await f.read(length)
+            except FileNotFoundError:
+                continue
+            metrics.count_io(read=len(raw))
+            return raw
+        raise NotFound("No document found")
+
+    async def read_many(
+        self, ids: list[str], concurrency: int = 16, ordered: bool = True
+    ) -> Generator[tuple[str, dict], None, None]:
+        """Read documents, skipping the ones which don't exist.
+
+        Consecutive ids stored in the same segment are read with a single read of the segment, so a scan in storage order reads every segment once. ``concurrency`` and ``ordered`` are accepted for compatibility, documents are always yielded in the order of the ids.
+
+        Yields:
+            The ``(id, data)`` pairs.
+        """
+        await self.load()
+        run = []
+        for id in ids:
+            location = self.locations.get(id)
+            if location is None:
+                continue
+            if run and run[-1][1][0] != location[0]:
+                async for item in self._read_run(run):
+                    yield item
+                run = []
+            run.append((id, location))
+        if run:
+            async for item in self._read_run(run):
+                yield item
+
+    async def _read_run(
+        self, run: list[tuple[str, tuple]]
+    ) -> Generator[tuple[str, dict], None, None]:
+        if len(run) == 1:
+            id = run[0][0]
+            try:
+                yield id, await self.read(id)
+            except NotFound:
+                pass
+            return
+        name = run[0][1][0]
+        start = min(location[1] for _, location in run)
+        end = max(location[1] + location[2] for _, location in run)
+        try:
+            docs = await aios.wrap(self._decode_run)(name, start, end - start, run)
+        except FileNotFoundError:
+            # Compacted meanwhile, fall back to reading the documents one by one.
+            for id, _ in run:
+                try:
+                    yield id, await self.read(id)
+                except NotFound:
+                    pass
+            return
+        for item in docs:
+            yield item
+
+    def _decode_run(
+        self, name: str, start: int, length: int, run: list[tuple[str, tuple]]
+    ) -> list[tuple[str, dict]]:
+        filepath = os.path.join(self.directory, name)
+        with open_buffer(filepath, start, length) as contents:
+            return [
+                (id, decode(contents[offset - start : offset - start + size]))
+                for id, (_, offset, size, _) in run
+            ]
+
+    async def write(self, id: str, data: dict) -> None:
+        await self.load()
+        await self._append("put", id, self.codec.encode(data))
+
+    async def create(self, id: str, data: dict) -> None:
+        """Write a new document.
+
+        Raises:
+            AlreadyExists: If the document already exists.
+        """
+        await self.load()
+        await self._append("put", id, self.codec.encode(data), exclusive=True)
+
+    async def delete(self, id: str) -> None:
+        """Delete a document.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        await self.load()
+        if id not in self.locations:
+            raise NotFound("No document found")
+        await self._append("del", id, b"")
+
+    async def sync(self, ids: list[str]) -> None:
+        """Flush the segments written since the last sync to disk, which hold the written documents."""
+        names, self.unsynced = self.unsynced, set()
+        paths = [os.path.join(self.directory, name) for name in names]
+        await aios.wrap(_fsync)(paths, self.directory)
+
+    def _maybe_compact(self) -> None:
+        if self.compaction is not None and not self.compaction.done():
+            return
+        sealed = [stats for name, stats in self.segments.items() if name != self.active]
+        total = sum(stats[0] for stats in sealed)
+        live = sum(stats[1] for stats in sealed)
+        if total and total - live >= self.compact_ratio * total:
+            self.compaction = asyncio.create_task(self.compact())
+            self.compaction.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+
+    def _live_bodies(self, name: str, records: list[tuple[tuple, str]]) -> list[bytes]:
+        # Only the pages holding live records are read from a mapped segment.
+        with open_buffer(os.path.join(self.directory, name)) as contents:
+            return [
+                bytes(contents[location[1] : location[1] + location[2]])
+                for location, _ in records
+            ]
+
+    async def compact(self) -> None:
+        """Rewrite the live records of the sealed segments into a single segment.
+
+        Writers are only blocked while the new segment is swapped in.
+        """
+        await self.load()
+        sealed = sorted(name for name in self.segments if name != self.active)
+        if not sealed:
+            return
+        last = sealed[-1]
+        target = self.segment_name(self._sequence(last), self._generation(last) + 1)
+        moved = sorted(
+            (location, id)
+            for id, location in self.locations.items()
+            if location[0] in sealed
+        )
+        new_locations = {}
+        filepath = os.path.join(self.directory, target)
+        async with aiofiles.open(filepath + ".tmp", "wb") as out:
+            offset = 0
+            for name in sealed:
+                records = [(location, id) for location, id in moved if location[0] == name]
+                if not records:
+                    continue
+                bodies = await aios.wrap(self._live_bodies)(name, records)
+                chunk = []
+                for (location, id), body in zip(records, bodies):
+                    header = json.dumps(["put", id, len(body)]).encode()
+                    record = header + b"\t" + body + b"\n"
+                    chunk.append(record)
+                    start = offset + len(header) + 1
+                    new_locations[id] = (location, (target, start, len(body), len(record)))
+                    offset += len(record)
+                await out.write(b"".join(chunk))
+            await out.flush()
+            await aios.wrap(os.fsync)(out.fileno())
+        metrics.count_io(written=offset)
+
+        async with self.lock:
+            await aios.replace(filepath + ".tmp", filepath)
+            stats = [offset, 0]
+            for id, (old, new) in new_locations.items():
+                # Documents written during the compaction keep their newer record.
+                if self.locations.get(id) == old:
+                    self.locations[id] = new
+                    stats[1] += new[3]
+            for name in sealed:
+                del self.segments[name]
+                await aios.remove(os.path.join(self.directory, name))
+            self.segments[target] = stats
+
+
+class MemoryStorage:
+    """Keeps the documents of a collection in memory, encoded with its codec.
+
+    Collections of an in-memory cluster always use it, see :class:`ashendb.backend.MemoryBackend`. Documents are encoded like on disk, so the data read back is a copy holding only json types.
+
+    Args:
+        path: The path of the collection.
+        codec: Encodes the written documents, json by default. See :mod:`ashendb.codec`.
+    """
+
+    kind = "memory"
+
+    def __init__(self, path: str, codec=None) -> None:
+        self.path = path
+        self.key = os.path.normpath(path)
+        self.codec = codec or JsonCodec()
+
+    @property
+    def documents(self) -> dict[str, bytes]:
+        # Owned by the backend, so they outlive the storage until the collection is deleted.
+        return memory.documents.setdefault(self.key, {})
+
+    def doc_path(self, id: str) -> str:
+        return os.path.join(self.path, f"{id}.json")
+
+    async def ids(self) -> list[str]:
+        """The ids of all documents, in insertion order."""
+        return list(self.documents)
+
+    async def count(self) -> int:
+        return len(self.documents)
+
+    async def exists(self, id: str) -> bool:
+        return id in self.documents
+
+    async def read(self, id: str) -> dict:
+        """Read a document.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        try:
+            return decode(self.documents[id])
+        except KeyError:
+            raise NotFound("No document found")
+
+    async def read_raw(self, id: str) -> bytes:
+        """Read a document without decoding it.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        try:
+            return self.documents[id]
+        except KeyError:
+            raise NotFound("No document found")
+
+    async def read_many(
+        self, ids: list[str], concurrency: int = 16, ordered: bool = True
+    ) -> Generator[tuple[str, dict], None, None]:
+        """Read documents, skipping the ones which don't exist.
+
+        ``concurrency`` and ``ordered`` are accepted for compatibility, documents are always yielded in the order of the ids.
+        """
+        documents = self.documents
+        for id in ids:
+            raw = documents.get(id)
+            if raw is not None:
+                yield id, decode(raw)
+
+    async def write(self, id: str, data: dict) -> None:
+        self.documents[id] = self.codec.encode(data)
+
+    async def create(self, id: str, data: dict) -> None:
+        """Write a new document.
+
+        Raises:
+            AlreadyExists: If the document already exists.
+        """
+        if id in self.documents:
+            raise AlreadyExists("Document already exist")
+        await self.write(id, data)
+
+    async def delete(self, id: str) -> None:
+        """Delete a document.
+
+        Raises:
+            NotFound: If the document does not exist.
+        """
+        try:
+            del self.documents[id]
+        except KeyError:
+            raise NotFound("No document found")
+
+
+storage_types = {
+    DirectoryStorage.kind: DirectoryStorage,
+    SegmentStorage.kind: SegmentStorage,
+}
+
+
+async def get_storage(
+    path: str,
+) -> DirectoryStorage | SegmentStorage | MemoryStorage | LoggedStorage:
+    """The storage of a collection.
+
+    Collections of an in-memory cluster use :class:`MemoryStorage`. Collections with a ``.segments`` directory use :class:`SegmentStorage`, the others :class:`DirectoryStorage`. If the database has a write-ahead log, the storage is wrapped in a :class:`ashendb.wal.LoggedStorage`. The storage is opened once per process and shared by every handle of the collection.
+
+    Args:
+        path: The path of the collection.
+    """
+    key = os.path.normpath(path)
+    storage = _storages.get(key)
+    if storage is not None:
+        return storage
+    async with _opening.setdefault(key, asyncio.Lock()):
+        storage = _storages.get(key)
+        if storage is None:
+            codec = await load_codec(path)
+            if isinstance(get_backend(path), MemoryBackend):
+                storage = MemoryStorage(path, codec=codec)
+            elif await aios.path.isdir(os.path.join(path, SEGMENT_DIR)):
+                storage = SegmentStorage(path, codec=codec)
+            else:
+                storage = DirectoryStorage(path, codec=codec)
+            wal = await get_wal(os.path.dirname(key))
+            if wal is not None:
+                storage = wal.attach(os.path.basename(key), storage)
+            _storages[key] = storage
+    return storage
+
+
+def forget_storage(path: str) -> None:
+    """Drop the opened storage of a collection, e.g. after it was deleted."""
+    _storages.pop(os.path.normpath(path), None)
+
+
+async def migrate(
+    path: str, kind: str
+) -> DirectoryStorage | SegmentStorage | LoggedStorage:
+    """Move the documents of a collection to another storage.
+
+    The new storage is filled completely before it replaces the old one, so an interrupted migration leaves the collection in its old storage.
+
+    Args:
+        path: The path of the collection.
+        kind: Either ``"directory"`` or ``"segment"``.
+
+    Raises:
+        ValueError: If the kind is unknown or the collection is in memory.
+
+    Example:
+        >>> await migrate(".ashendb/cluster/db/users/", "segment")
+    """
+    if kind not in storage_types:
+        raise ValueError(f"Unknown storage '{kind}'")
+    old = await get_storage(path)
+    if old.kind == MemoryStorage.kind:
+        raise ValueError("Collections of an in-memory cluster always use the memory storage")
+    if old.kind == kind:
+        return old
+    wal = None
+    if isinstance(old, LoggedStorage):
+        wal = old.wal
+        await wal.checkpoint()
+        old = old.storage
+    ids = await old.ids()
+    if kind == SegmentStorage.kind:
+        staging = os.path.join(path, SEGMENT_DIR + ".tmp")
+        await aios.wrap(shutil.rmtree)(staging, ignore_errors=True)
+        new = SegmentStorage(path, codec=old.codec)
+        new.directory = staging
+        async for id, data in old.read_many(ids):
+            await new.write(id, data)
+        if new.compaction is not None:
+            await new.compaction
+        await aios.replace(staging, os.path.join(path, SEGMENT_DIR))
+        new.directory = os.path.join(path, SEGMENT_DIR)
+        for id in ids:
+            await old.delete(id)
+    else:
+        new = DirectoryStorage(path, codec=old.codec)
+        async for id, data in old.read_many(ids):
+            await new.write(id, data)
+        if old.compaction is not None:
+            await old.compaction
+        await aios.wrap(shutil.rmtree)(old.directory)
+    if wal is not None:
+        new = wal.attach(os.path.basename(os.path.normpath(path)), new)
+    _storages[os.path.normpath(path)] = new
+    return new
+
+
+async def convert_codec(
+    path: str, name: str
+) -> DirectoryStorage | SegmentStorage | LoggedStorage:
+    """Rewrite the documents of a collection with another codec.
+
+    Documents are read whatever codec they were written with, so an interrupted conversion leaves a readable collection and can simply be run again.
+
+    Args:
+        path: The path of the collection.
+        name: The name of the codec, see :data:`ashendb.codec.codec_types`.
+
+    Raises:
+        ValueError: If the codec is unknown.
+        ImportError: If the codec needs a package which is not installed.
+
+    Example:
+        >>> await convert_codec(".ashendb/cluster/db/users/", "msgpack")
+    """
+    storage = await get_storage(path)
+    inner = storage
+    if isinstance(storage, LoggedStorage):
+        await storage.wal.checkpoint()
+        inner = storage.storage
+    inner.codec = await save_codec(path, name)
+    ids = await inner.ids()
+    if isinstance(inner, SegmentStorage):
+        async for id, data in inner.read_many(ids):
+            await inner.write(id, data)
+        if inner.compaction is not None:
+            await inner.compaction
+        await inner.compact()
+    elif isinstance(inner, DirectoryStorage):
+        async for id, data in inner.read_many(ids):
+            await inner.rewrite(id, data)
+    else:
+        async for id, data in inner.read_many(ids):
+            await inner.write(id, data)
+    return storage
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import random
+import weakref
+from typing import Awaitable, Callable, TypeVar
+
+from .backend import get_backend
+from .exception import NotFound, VersionConflict
+
+# The field holding the version of a document.
+VERSION_FIELD = "_version"
+VERSIONING_FILE = ".versioned"
+
+T = TypeVar("T")
+
+# Whether documents are versioned, keyed by the normalized collection path.
+_versioned: dict[str, bool] = {}
+# Locks of the documents being written, keyed by (collection, id). A lock only lives as
+# long as a writer holds or waits for it.
+_locks: "weakref.WeakValueDictionary[tuple[str, str], asyncio.Lock]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+async def is_versioned(path: str) -> bool:
+    """Whether the documents of a collection are versioned.
+
+    It is read from the ``.versioned`` file of the collection, once per process.
+    """
+    key = os.path.normpath(path)
+    versioned = _versioned.get(key)
+    if versioned is None:
+        versioned = await get_backend(key).exists(os.path.join(key, VERSIONING_FILE))
+        _versioned[key] = versioned
+    return versioned
+
+
+async def set_versioned(path: str, enabled: bool) -> None:
+    """Turn versioning of the documents of a collection on or off."""
+    key = os.path.normpath(path)
+    filepath = os.path.join(key, VERSIONING_FILE)
+    backend = get_backend(key)
+    if enabled:
+        await backend.write_file(filepath, b"")
+    else:
+        try:
+            await backend.remove(filepath)
+        except FileNotFoundError:
+            pass
+    _versioned[key] = enabled
+
+
+def forget_versioning(path: str) -> None:
+    """Drop the loaded setting of a collection, e.g. after it was deleted."""
+    _versioned.pop(os.path.normpath(path), None)
+
+
+def version_of(data: dict) -> int:
+    """The version of a document, 0 if it was written before versioning was turned on."""
+    return data.get(VERSION_FIELD, 0)
+
+
+async def compare_and_swap(storage, path: str, id: str, data: dict) -> None:
+    """Write a document of a versioned collection, unless it was written since it was read.
+
+    The stored version is compared with the version of ``data`` while holding a lock of the document, so writers of other documents never wait on each other. On success the version of ``data`` is bumped in place.
+
+    Note:
+        The lock is held by the process, writers in other processes are only noticed if their write landed before the stored version was read.
+
+    Args:
+        storage: The storage of the collection.
+        path: The path of the collection.
+        id: The id of the document.
+        data: The document, holding the version it was read at.
+
+    Raises:
+        VersionConflict: If the stored version differs, or the document was deleted.
+    """
+    key = (os.path.normpath(path), id)
+    lock = _locks.get(key)
+    if lock is None:
+        lock = _locks[key] = asyncio.Lock()
+    async with lock:
+        expected = version_of(data)
+        try:
+            actual = version_of(await storage.read(id))
+        except NotFound:
+            actual = None
+        if actual != expected:
+            raise VersionConflict(
+                f"Document '{id}' is at version {actual}, expected {expected}",
+                id=id,
+                expected=expected,
+                actual=actual,
+            )
+        data[VERSION_FIELD] = expected + 1
+        # Readers which didn't wait for the lock must not see the document half written,
+        # which a file per document only guarantees when it is replaced.
+        write = getattr(storage, "rewrite", storage.write)
+        try:
+            await write(id, data)
+        except BaseException:
+            data[VERSION_FIELD] = expected
+            raise
+
+
+async def retry_on_conflict(
+    operation: Callable[[], Awaitable[T]], retries: int = 5, backoff: float = 0.001
+) -> T:
+    """Run a read-modify-write operation again whenever it hits a :class:`~ashendb.exception.VersionConflict`.
+
+    The operation must read the documents it changes itself, so every attempt starts from their latest version. Attempts are spaced by a random wait, up to ``backoff`` seconds doubled after every conflict, which keeps contending writers from colliding again.
+
+    Args:
+        operation: Reads, changes and saves documents.
+        retries: How many times the operation is run again.
+        backoff: The longest wait before the first retry, in seconds.
+
+    Raises:
+        VersionConflict: If the last attempt conflicted as well.
+
+    Returns:
+        The result of the operation.
+
+    Example:
+        >>> async def rename():
+        ...     doc = await coll.get_doc("1")
+        ...     doc["name"] = doc["name"].title()
+        ...     await doc.save()
+        >>> await retry_on_conflict(rename)
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await operation()
+        except VersionConflict:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(random.uniform(0, backoff * 2**attempt))
@@ -0,0 +1,338 @@
+import asyncio
+import json
+import os
+import shutil
+from typing import Generator
+
+import aiofiles
+import aiofiles.os as aios
+
+from . import metrics
+from .backend import MemoryBackend, get_backend
+from .exception import AlreadyExists, NotFound
+
+WAL_DIR = ".wal"
+
+# Opened logs, keyed by the normalized database path. None if the database has no log.
+_wals: dict[str, "WriteAheadLog | None"] = {}
+# Held while a log is opened and recovered, so it happens once.
+_opening: dict[str, asyncio.Lock] = {}
+
+
+def _append_sync(filepath: str, data: bytes) -> None:
+    with open(filepath, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    metrics.count_io(written=len(data))
+
+
+class WriteAheadLog:
+    """A write-ahead log shared by the collections of a database.
+
+    Writes are appended to the log and acknowledged once it is synced to disk. Writers arriving while a sync is running are grouped into the next one, so many concurrent writers share a single ``fsync``. The documents themselves are written by :meth:`checkpoint`, until then reads are served from memory.
+
+    A record is one line made of a json header ``["put", collection, id]`` or ``["del", collection, id]``, a tab and the json document.
+
+    Args:
+        path: The path of the database directory.
+        window: Seconds to wait for more writers before syncing a group.
+        checkpoint_every: Start a checkpoint in the background once this many documents are waiting for one.
+    """
+
+    def __init__(
+        self, path: str, window: float = 0.002, checkpoint_every: int = 1000
+    ) -> None:
+        self.path = path
+        self.directory = os.path.join(path, WAL_DIR)
+        self.window = window
+        self.checkpoint_every = checkpoint_every
+        # collection -> id -> json document, or None if it was deleted
+        self.pending: dict[str, dict[str, bytes | None]] = {}
+        self.sequence = 0
+        self.buffer: list[bytes] = []
+        self.waiters: list[asyncio.Future] = []
+        self.flusher: asyncio.Task | None = None
+        self.checkpointer: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+        self.checkpoint_lock = asyncio.Lock()
+
+    @property
+    def current(self) -> str:
+        return os.path.join(self.directory, f"{self.sequence:08d}.log")
+
+    async def _logs(self) -> list[str]:
+        return sorted(
+            name for name in await aios.listdir(self.directory) if name.endswith(".log")
+        )
+
+    async def recover(self) -> None:
+        """Load the records which were not checkpointed yet."""
+        logs = await self._logs()
+        for name in logs:
+            async with aiofiles.open(os.path.join(self.directory, name), "rb") as f:
+                contents = await f.read()
+            metrics.count_io(read=len(contents))
+            for line in contents.split(b"\n"):
+                if not line:
+                    continue
+                tab = line.find(b"\t")
+                try:
+                    op, collection, id = json.loads(line[:tab])
+                    body = line[tab + 1 :] if op == "put" else None
+                    if body is not None:
+                        json.loads(body)
+                except ValueError:
+                    # A write was cut off, it was never acknowledged.
+                    continue
+                self.pending.setdefault(collection, {})[id] = body
+        if logs:
+            self.sequence = int(logs[-1][:8]) + 1
+
+    def attach(self, collection: str, storage) -> "LoggedStorage":
+        """Route the writes of a collection's storage through the log."""
+        return LoggedStorage(self, collection, storage)
+
+    async def log(self, collection: str, op: str, id: str, body: bytes = b"") -> None:
+        """Append a record and wait until it is synced to disk.
+
+        The document is pending, and visible to reads, before anything is awaited.
+        """
+        header = json.dumps([op, collection, id]).encode()
+        self.pending.setdefault(collection, {})[id] = body if op == "put" else None
+        future = asyncio.get_running_loop().create_future()
+        self.buffer.append(header + b"\t" + body + b"\n")
+        self.waiters.append(future)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush())
+        await future
+        if sum(map(len, self.pending.values())) >= self.checkpoint_every and (
+            self.checkpointer is None or self.checkpointer.done()
+        ):
+            self.checkpointer = asyncio.create_task(self.checkpoint())
+            self.checkpointer.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+
+    async def _flush(self) -> None:
+        while self.buffer:
+            if self.window:
+                await asyncio.sleep(self.window)
+            records, waiters = self.buffer, self.waiters
+            self.buffer, self.waiters = [], []
+            try:
+                async with self.lock:
+                    await aios.wrap(_append_sync)(self.current, b"".join(records))
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def checkpoint(self) -> None:
+        """Write the logged documents to their collections and drop the applied logs.
+
+        Documents are replaced atomically where the storage allows it, and synced to disk before the logs are dropped, so a crash never loses a write the logs held. Writes made during a checkpoint go to a new log and are applied by the next one.
+        """
+        # Imported here, the storages import this module.
+        from .storage import get_storage
+
+        async with self.checkpoint_lock:
+            async with self.lock:
+                logs = await self._logs()
+                self.sequence += 1
+                snapshot = {
+                    collection: dict(entries)
+                    for collection, entries in self.pending.items()
+                    if entries
+                }
+            for collection, entries in snapshot.items():
+                storage = await get_storage(os.path.join(self.path, collection))
+                if isinstance(storage, LoggedStorage):
+                    storage = storage.storage
+                # Readers of documents which are no longer pending must not see them half
+                # written.
+                write = getattr(storage, "rewrite", storage.write)
+                for id, body in entries.items():
+                    if body is None:
+                        try:
+                            await storage.delete(id)
+                        except NotFound:
+                            pass
+                    else:
+                        await write(id, json.loads(body))
+                await storage.sync(list(entries))
+                pending = self.pending[collection]
+                for id, body in entries.items():
+                    # Documents written meanwhile wait for the next checkpoint.
+                    if id in pending and pending[id] is body:
+                        del pending[id]
+            for name in logs:
+                await aios.remove(os.path.join(self.directory, name))
+
+
+class LoggedStorage:
+    """Wraps the storage of a collection so its writes go through a :class:`WriteAheadLog`.
+
+    Reads see the logged documents before they are checkpointed.
+    """
+
+    def __init__(self, wal: WriteAheadLog, collection: str, storage) -> None:
+        self.wal = wal
+        self.collection = collection
+        self.storage = storage
+        self.path = storage.path
+        self.kind = storage.kind
+
+    @property
+    def codec(self):
+        return self.storage.codec
+
+    @property
+    def pending(self) -> dict[str, bytes | None]:
+        return self.wal.pending.setdefault(self.collection, {})
+
+    def doc_path(self, id: str) -> str:
+        return self.storage.doc_path(id)
+
+    async def ids(self) -> list[str]:
+        pending = self.pending
+        ids = [id for id in await self.storage.ids() if id not in pending]
+        return ids + [id for id, body in pending.items() if body is not None]
+
+    async def count(self) -> int:
+        # Only the logged documents are checked against the storage, which a running
+        # checkpoint would be changing meanwhile.
+        async with self.wal.checkpoint_lock:
+            count = await self.storage.count()
+            pending = list(self.pending.items())
+            stored = await asyncio.gather(
+                *(self.storage.exists(id) for id, _ in pending)
+            )
+        for (id, body), exists in zip(pending, stored):
+            if body is None and exists:
+                count -= 1
+            elif body is not None and not exists:
+                count += 1
+        return count
+
+    async def exists(self, id: str) -> bool:
+        if id in self.pending:
+            return self.pending[id] is not None
+        return await self.storage.exists(id)
+
+    async def read(self, id: str) -> dict:
+        if id in self.pending:
+            body = self.pending[id]
+            if body is None:
+                raise NotFound("No document found")
+            return json.loads(body)
+        return await self.storage.read(id)
+
+    async def read_raw(self, id: str) -> bytes:
+        if id in self.pending:
+            body = self.pending[id]
+            if body is None:
+                raise NotFound("No document found")
+            return body
+        return await self.storage.read_raw(id)
+
+    async def read_many(
+        self, ids: list[str], concurrency: int = 16, ordered: bool = True
+    ) -> Generator[tuple[str, dict], None, None]:
+        # Runs of ids which are not logged are read from the storage as a whole. The body
+        # of a logged document is taken when it is met, a checkpoint running while the
+        # run before it is read may drop it from pending.
+        run = []
+        for id in ids:
+            pending = self.pending
+            if id not in pending:
+                run.append(id)
+                continue
+            body = pending[id]
+            if run:
+                async for item in self.storage.read_many(run, concurrency, ordered):
+                    yield item
+                run = []
+            if body is not None:
+                yield id, json.loads(body)
+        if run:
+            async for item in self.storage.read_many(run, concurrency, ordered):
+                yield item
+
+    async def write(self, id: str, data: dict) -> None:
+        await self.wal.log(self.collection, "put", id, json.dumps(data).encode())
+
+    async def create(self, id: str, data: dict) -> None:
+        pending = self.pending
+        stored = id not in pending and await self.storage.exists(id)
+        # Nothing is awaited from this check until the document is pending, which log does
+        # first, so concurrent creators of an id can't both succeed.
+        exists = pending[id] is not None if id in pending else stored
+        if exists:
+            raise AlreadyExists("Document already exist")
+        await self.wal.log(self.collection, "put", id, json.dumps(data).encode())
+
+    async def delete(self, id: str) -> None:
+        if not await self.exists(id):
+            raise NotFound("No document found")
+        await self.wal.log(self.collection, "del", id)
+
+
+async def get_wal(path: str) -> WriteAheadLog | None:
+    """The write-ahead log of a database, None if it has none.
+
+    Args:
+        path: The path of the database.
+    """
+    key = os.path.normpath(path)
+    if key in _wals:
+        return _wals[key]
+    async with _opening.setdefault(key, asyncio.Lock()):
+        if key not in _wals:
+            wal = None
+            if await get_backend(key).isdir(os.path.join(key, WAL_DIR)):
+                wal = WriteAheadLog(key)
+                await wal.recover()
+            _wals[key] = wal
+    return _wals[key]
+
+
+async def enable_wal(
+    path: str, window: float = 0.002, checkpoint_every: int = 1000
+) -> WriteAheadLog:
+    """Start logging the writes of a database.
+
+    Args:
+        path: The path of the database.
+        window: Seconds to wait for more writers before syncing a group.
+        checkpoint_every: Start a checkpoint once this many documents are waiting for one.
+
+    Raises:
+        ValueError: If the database is in memory.
+    """
+    if isinstance(get_backend(path), MemoryBackend):
+        raise ValueError("In-memory databases have no write-ahead log")
+    await aios.makedirs(os.path.join(path, WAL_DIR), exist_ok=True)
+    wal = await get_wal(path)
+    if wal is None:
+        _wals.pop(os.path.normpath(path))
+        wal = await get_wal(path)
+    wal.window = window
+    wal.checkpoint_every = checkpoint_every
+    return wal
+
+
+async def disable_wal(path: str) -> None:
+    """Checkpoint and remove the write-ahead log of a database."""
+    wal = await get_wal(path)
+    if wal is None:
+        return
+    if wal.flusher is not None:
+        await wal.flusher
+    await wal.checkpoint()
+    await aios.wrap(shutil.rmtree)(wal.directory)
+    _wals[os.path.normpath(path)] = None